@@ -0,0 +1,42 @@
+import os
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import async_crud, crud
+from .cache import TTLCache
+
+
+# Whether a user may work in a project: they own it or it is shared with
+# them. Answers are cached per worker, for members and non-members alike,
+# so a check costs one dict lookup once warm and one indexed EXISTS when
+# not. Sharing changes invalidate the entry here and, through the event
+# bus, in the other workers; the TTL bounds anything missed.
+
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("AAT_MEMBERSHIP_CACHE_SIZE", 65536))
+MEMBERSHIP_CACHE_TTL = float(os.environ.get("AAT_MEMBERSHIP_CACHE_TTL", 300))
+
+
+class ProjectAccess:
+    def __init__(self, maxsize: int = MEMBERSHIP_CACHE_SIZE, ttl: float = MEMBERSHIP_CACHE_TTL):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def is_member(self, db: AsyncSession, project_id: str, user_id: int):
+        member = self.cache.get((project_id, user_id))
+        if member is None:
+            member = await async_crud.is_project_member(db, project_id, user_id)
+            self.cache.set((project_id, user_id), member)
+        return member
+
+    def is_member_sync(self, db: Session, project_id: str, user_id: int):
+        member = self.cache.get((project_id, user_id))
+        if member is None:
+            member = crud.is_project_member(db, project_id, user_id)
+            self.cache.set((project_id, user_id), member)
+        return member
+
+    def invalidate(self, project_id: str, user_id: int):
+        self.cache.invalidate((project_id, user_id))
+
+    def stats(self):
+        return self.cache.stats()
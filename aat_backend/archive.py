@@ -0,0 +1,408 @@
+import os
+import re
+import tarfile
+import tempfile
+import time
+import uuid
+import zlib
+
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from . import async_crud, schemas, serialization, storage
+from .database import AsyncSessionLocal
+
+
+# A project archive is a tar stream, written and read member by member so
+# neither side ever holds more than a chunk of a file or a page of
+# annotations:
+#
+#   project.json                 format, version, project name, files list
+#   blobs/<sha256>               file contents, once per distinct content
+#   files/<file id>              contents of files stored before hashing
+#   annotations/<page>.ndjson    one annotation per line, in id order
+#
+# project.json comes first so an import knows what to expect. An import
+# stores the blobs as they arrive and spools the annotation pages to a
+# temporary file; its database transaction only starts once the whole
+# stream is read, so the client's pace never holds it open. Archives may be
+# gzipped as a whole.
+
+FORMAT = "aat-project"
+VERSION = 1
+PAGE_SIZE = 1000
+GZIP_LEVEL = 1
+# project.json is read into memory; anything larger is not one of ours
+MAX_MANIFEST_SIZE = 64 * 1024 * 1024
+# An annotations page is parsed in memory too; exports write 1000 per page
+MAX_PAGE_SIZE = 256 * 1024 * 1024
+# PAX and GNU long name headers are read into memory; real ones are tiny
+MAX_HEADER_SIZE = 1024 * 1024
+
+BLOCK = tarfile.BLOCKSIZE
+END = bytes(2 * BLOCK)
+BLOB_NAME = re.compile(r"blobs/([0-9a-f]{64})")
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def _header(name: str, size: int, mtime: int):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    # PAX only adds an extended header when needed, e.g. for files over 8 GiB
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+def _padding(size: int):
+    return bytes(-size % BLOCK)
+
+def _member(name: str, data: bytes, mtime: int):
+    return _header(name, len(data), mtime) + data + _padding(len(data))
+
+def _stat(path: str):
+    try:
+        return os.path.getsize(storage.full_path(path))
+    except FileNotFoundError:
+        return None
+
+def _read(f, size: int):
+    chunk = f.read(size)
+    if len(chunk) != size:
+        raise ArchiveError(f"{f.name} changed while it was exported")
+    return chunk
+
+def _annotation_line(row):
+    # Same fields as Annotation.dict(), with the coordinates spliced in as
+    # stored instead of parsed and encoded again
+    fields = serialization.dumps({
+        "id": row.id,
+        "note": row.note,
+        "color": row.color,
+        "revision": row.revision,
+        "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+    })
+    return b'%s,"coordinates":%s}\n' % (fields[:-1], (row.coordinates or "null").encode())
+
+
+class ProjectArchive:
+    # Async iterator over the bytes of a project's archive. The counters are
+    # final once it is exhausted.
+    def __init__(self, project_id: str, include_files: bool = True):
+        self.project_id = project_id
+        self.include_files = include_files
+        self.files = 0
+        self.annotations = 0
+        self.size = 0
+
+    async def __aiter__(self):
+        async for chunk in self._chunks():
+            self.size += len(chunk)
+            yield chunk
+
+    async def _chunks(self):
+        mtime = int(time.time())
+        async with AsyncSessionLocal() as db:
+            project = await async_crud.get_project(db, self.project_id)
+            if project is None:
+                raise ArchiveError("Project not found")
+            name = project.name
+            rows = await async_crud.get_project_files(db, self.project_id)
+        # member name -> (blob path, size) of the contents to include
+        contents = {}
+        files = []
+        for file in rows:
+            member = f"blobs/{file.sha256}" if file.sha256 else f"files/{file.id}"
+            if self.include_files and member not in contents:
+                size = await run_in_threadpool(_stat, file.path)
+                if size is not None:
+                    contents[member] = (file.path, size)
+            files.append({
+                "filename": file.filename,
+                "sha256": file.sha256,
+                "size": file.size,
+                "member": member if member in contents else None,
+            })
+        self.files = len(files)
+        manifest = {"format": FORMAT, "version": VERSION, "project": {"id": self.project_id, "name": name}, "files": files}
+        yield _member("project.json", serialization.dumps(manifest), mtime)
+
+        for member, (path, size) in contents.items():
+            yield _header(member, size, mtime)
+            f = await run_in_threadpool(open, storage.full_path(path), "rb")
+            try:
+                for offset in range(0, size, storage.CHUNK_SIZE):
+                    yield await run_in_threadpool(_read, f, min(storage.CHUNK_SIZE, size - offset))
+            finally:
+                f.close()
+            yield _padding(size)
+
+        # A session per page: the client sets the pace, and a slow one must
+        # not hold a pooled connection for the whole download.
+        after, page = None, 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                rows = await async_crud.get_annotation_export_page(db, self.project_id, after, PAGE_SIZE)
+            if not rows:
+                break
+            lines = b"".join(map(_annotation_line, rows))
+            yield _member(f"annotations/{page:08d}.ndjson", lines, mtime)
+            self.annotations += len(rows)
+            after, page = rows[-1].id, page + 1
+        yield END
+
+
+async def gzipped(chunks, level: int = GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        if len(chunk) >= storage.CHUNK_SIZE:
+            data = await run_in_threadpool(compressor.compress, chunk)
+        else:
+            data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _Reader:
+    # Exact reads over an async iterator of request body chunks, gunzipped
+    # on the way when the stream starts with the gzip magic.
+    def __init__(self, chunks):
+        self.source = chunks.__aiter__()
+        self.buffer = bytearray()
+        self.decompressor = None
+        self.started = False
+        self.size = 0
+
+    async def _fill(self):
+        try:
+            chunk = await self.source.__anext__()
+        except StopAsyncIteration:
+            if self.decompressor is not None and not self.decompressor.eof:
+                raise ArchiveError("Archive is truncated")
+            return False
+        self.size += len(chunk)
+        if not self.started and chunk:
+            self.started = True
+            if chunk[:2] == b"\x1f\x8b":
+                self.decompressor = zlib.decompressobj(31)
+        if self.decompressor is not None:
+            try:
+                chunk = self.decompressor.decompress(chunk)
+            except zlib.error as e:
+                raise ArchiveError(f"Archive is not a valid gzip stream: {e}")
+        self.buffer += chunk
+        return True
+
+    async def chunks(self, size: int):
+        while size > 0:
+            if not self.buffer and not await self._fill():
+                raise ArchiveError("Archive is truncated")
+            chunk = bytes(self.buffer[:size])
+            del self.buffer[:len(chunk)]
+            size -= len(chunk)
+            yield chunk
+
+    async def read(self, size: int):
+        return b"".join([chunk async for chunk in self.chunks(size)])
+
+
+class _Member:
+    def __init__(self, reader: _Reader, name: str, size: int):
+        self.reader = reader
+        self.name = name
+        self.size = size
+        self.unread = size
+
+    async def chunks(self):
+        async for chunk in self.reader.chunks(self.unread):
+            self.unread -= len(chunk)
+            yield chunk
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.chunks()])
+
+
+def _pax_records(data: bytes):
+    # "<length> <key>=<value>\n" records, the length counting the whole record
+    records, position = {}, 0
+    while position < len(data):
+        length, space, _ = data[position:position + 32].partition(b" ")
+        length = int(length) if space and length.isdigit() else 0
+        record = data[position:position + length]
+        if length <= 0 or position + length > len(data) or not record.endswith(b"\n") or b"=" not in record:
+            raise ArchiveError("Invalid PAX header")
+        key, _, value = record.partition(b" ")[2][:-1].partition(b"=")
+        records[key.decode("utf-8", "surrogateescape")] = value.decode("utf-8", "surrogateescape")
+        position += length
+    return records
+
+async def _members(reader: _Reader):
+    # Regular files of the tar stream; anything else is skipped. The part
+    # of a member its reader did not consume is skipped too.
+    extended = {}
+    while True:
+        block = await reader.read(BLOCK)
+        if block == bytes(BLOCK):
+            return
+        try:
+            info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        except tarfile.HeaderError as e:
+            raise ArchiveError(f"Invalid tar header: {e}")
+        if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.GNUTYPE_LONGNAME):
+            if info.size > MAX_HEADER_SIZE:
+                raise ArchiveError("Tar extended header is too large")
+            data = await reader.read(info.size + len(_padding(info.size)))
+            if info.type == tarfile.XHDTYPE:
+                extended = _pax_records(data[:info.size])
+            elif info.type == tarfile.GNUTYPE_LONGNAME:
+                extended = {"path": data[:info.size].rstrip(b"\0").decode("utf-8", "surrogateescape")}
+            continue
+        size = extended.get("size", info.size) if info.isreg() else 0
+        if isinstance(size, str):
+            if not size.isdigit():
+                raise ArchiveError("Invalid size in PAX header")
+            size = int(size)
+        member = _Member(reader, extended.get("path", info.name), size)
+        extended = {}
+        if info.isreg():
+            yield member
+        async for _ in member.chunks():
+            pass
+        await reader.read(len(_padding(size)))
+
+
+async def _store(member: _Member):
+    writer = await run_in_threadpool(storage.BlobWriter)
+    try:
+        buffer = bytearray()
+        async for chunk in member.chunks():
+            buffer += chunk
+            if len(buffer) >= storage.CHUNK_SIZE:
+                await run_in_threadpool(writer.write, bytes(buffer))
+                buffer.clear()
+        await run_in_threadpool(writer.write, bytes(buffer))
+        return await run_in_threadpool(writer.commit)
+    except BaseException:
+        await run_in_threadpool(writer.abort)
+        raise
+
+def _annotations(data: bytes, member: str):
+    annotations = []
+    for number, line in enumerate(data.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            annotations.append(schemas.AnnotationCreate(**serialization.loads(line)))
+        except (ValueError, TypeError, ValidationError) as e:
+            raise ArchiveError(f"{member}, line {number}: {e}")
+    return annotations
+
+def _check_files(files):
+    # Before anything is stored: every entry is used as is later on
+    if not isinstance(files, list):
+        raise ArchiveError("Invalid project.json: files must be a list")
+    for file in files:
+        if (
+            not isinstance(file, dict)
+            or not isinstance(file.get("filename"), str)
+            or not isinstance(file.get("member"), (str, type(None)))
+            or not (file.get("sha256") is None or storage.is_digest(file["sha256"]))
+        ):
+            raise ArchiveError("Invalid entry in the files list of project.json")
+
+def _existing_blob(sha256: str | None, known: set):
+    # Only blobs the importer can already read: a digest alone must not
+    # give access to another project's file, or reveal that it exists
+    if sha256 is None or storage.blob_path(sha256) not in known:
+        return None
+    if storage.reuse(storage.blob_path(sha256)):
+        return storage.blob_path(sha256)
+    return None
+
+
+async def import_archive(chunks, user: schemas.User):
+    # Creates a new project owned by `user` from an archive stream. Blobs are
+    # stored as they arrive; every row is inserted in one transaction once
+    # the stream is read, so a failed import leaves no project behind (its
+    # blobs are removed by the orphan sweep).
+    started = time.perf_counter()
+    reader = _Reader(chunks)
+    members = _members(reader)
+    first = await anext(members, None)
+    if first is None or first.name != "project.json":
+        raise ArchiveError("project.json must be the first member")
+    if first.size > MAX_MANIFEST_SIZE:
+        raise ArchiveError("project.json is too large")
+    try:
+        manifest = serialization.loads(await first.read())
+        name = manifest["project"]["name"]
+        files = manifest["files"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ArchiveError(f"Invalid project.json: {e}")
+    if not isinstance(name, str) or not name.strip():
+        raise ArchiveError("Invalid project.json: the project name must be a non-empty string")
+    if manifest.get("format") != FORMAT or manifest.get("version") != VERSION:
+        raise ArchiveError(f"Not a {FORMAT} archive of version {VERSION}")
+    _check_files(files)
+
+    project_id = str(uuid.uuid4())
+    stored = {}
+    pages = []
+    annotations = 0
+    spool = await run_in_threadpool(tempfile.TemporaryFile)
+    try:
+        async for member in members:
+            if member.name.startswith(("blobs/", "files/")):
+                path, sha256, size = await _store(member)
+                match = BLOB_NAME.fullmatch(member.name)
+                if match and match[1] != sha256:
+                    raise ArchiveError(f"{member.name} does not match its contents")
+                stored[member.name] = (path, sha256, size)
+            elif member.name.startswith("annotations/"):
+                if member.size > MAX_PAGE_SIZE:
+                    raise ArchiveError(f"{member.name} is too large")
+                data = await member.read()
+                await run_in_threadpool(spool.write, data)
+                pages.append((member.name, len(data)))
+        await run_in_threadpool(spool.seek, 0)
+        async with AsyncSessionLocal() as db:
+            known = await async_crud.get_member_file_paths(db, user.id, [
+                storage.blob_path(file["sha256"]) for file in files if file.get("member") not in stored and file.get("sha256")
+            ])
+            file_ids = await _create_project(db, project_id, name, user, files, stored, known)
+            for member_name, size in pages:
+                data = await run_in_threadpool(spool.read, size)
+                page = await run_in_threadpool(_annotations, data, member_name)
+                await async_crud.import_annotations(db, project_id, user, page)
+                annotations += len(page)
+            await db.commit()
+    finally:
+        spool.close()
+    elapsed = time.perf_counter() - started
+    return {
+        "project_id": project_id,
+        "files": len(file_ids),
+        "missing_files": len(files) - len(file_ids),
+        "annotations": annotations,
+        "bytes": reader.size,
+        "seconds": elapsed,
+        "mb_per_second": reader.size / 1e6 / elapsed if elapsed else 0.0,
+    }, file_ids
+
+async def _create_project(db, project_id: str, name: str, user: schemas.User, files: list, stored: dict, known: set):
+    # File rows point at the blobs stored from this archive or, for files
+    # exported without contents, at an identical blob already stored here
+    # for a project the importer is a member of (`known`).
+    rows = []
+    for file in files:
+        if file.get("member") in stored:
+            path, sha256, size = stored[file["member"]]
+        elif path := await run_in_threadpool(_existing_blob, file.get("sha256"), known):
+            sha256, size = file["sha256"], file.get("size") if isinstance(file.get("size"), int) else None
+        else:
+            continue
+        rows.append({"path": path, "filename": file["filename"], "sha256": sha256, "size": size})
+    return await async_crud.import_project(db, project_id, name, user, rows)
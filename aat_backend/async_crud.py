@@ -0,0 +1,494 @@
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import Integer, Text, and_, case, cast, delete, exists, func, insert, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.attributes import set_committed_value
+from starlette.concurrency import run_in_threadpool
+
+from . import geometry, models, schemas
+
+
+# Async counterparts of the crud functions used on the event loop.
+
+async def get_user_auth(db: AsyncSession, username: str):
+    db_user = await db.scalar(select(models.User).where(models.User.username == username))
+    if db_user:
+        return schemas.UserAuth(**db_user.dict())
+    else:
+        return False
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    # user.hashed_password must already be hashed, see hashing.PasswordHasher
+    db_user = models.User(**user.dict())
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+async def get_project(db: AsyncSession, project_id):
+    return await db.get(models.Project, project_id)
+
+async def create_file(db: AsyncSession, file: schemas.FileCreate):
+    db_file = models.File(**file.dict())
+    db.add(db_file)
+    await db.commit()
+    await db.refresh(db_file)
+    return db_file
+
+async def get_project_files(db: AsyncSession, project_id: str):
+    return (await db.scalars(select(models.File).where(models.File.project_id == project_id).order_by(models.File.id))).all()
+
+async def get_file(db: AsyncSession, file_id: int):
+    return await db.get(models.File, file_id)
+
+async def set_file_processing(db: AsyncSession, path: str, status: str, info: dict):
+    # Derivatives belong to the blob, so every row sharing it is updated
+    await db.execute(update(models.File).where(models.File.path == path).values(processing_status=status, **info))
+    await db.commit()
+
+async def get_referenced_paths(db: AsyncSession, paths: list[str]):
+    referenced = set()
+    for start in range(0, len(paths), 500):
+        chunk = paths[start:start + 500]
+        referenced.update((await db.scalars(select(models.File.path).where(models.File.path.in_(chunk)))).all())
+    return referenced
+
+async def get_member_file_paths(db: AsyncSession, user_id: int, paths: list[str]):
+    # The ones among `paths` used by a file of a project the user is a member of
+    owned = select(models.Project.id).where(models.Project.owner_id == user_id)
+    shared = select(models.project_user.c.project_id).where(models.project_user.c.user_id == user_id)
+    found = set()
+    for start in range(0, len(paths), 500):
+        chunk = paths[start:start + 500]
+        found.update((await db.scalars(
+            select(models.File.path).distinct()
+            .where(models.File.path.in_(chunk), or_(models.File.project_id.in_(owned), models.File.project_id.in_(shared)))
+        )).all())
+    return found
+
+async def create_upload(db: AsyncSession, upload: schemas.UploadCreate, user: schemas.User, project_id: str):
+    now = datetime.utcnow()
+    db_upload = models.Upload(**upload.dict())
+    db_upload.id = str(uuid.uuid4())
+    db_upload.owner_id = user.id
+    db_upload.project_id = project_id
+    db_upload.created_at = db_upload.updated_at = now
+    db.add(db_upload)
+    await db.commit()
+    return db_upload
+
+async def get_upload(db: AsyncSession, upload_id: str):
+    return await db.get(models.Upload, upload_id)
+
+async def touch_upload(db: AsyncSession, upload: models.Upload):
+    upload.updated_at = datetime.utcnow()
+    await db.commit()
+
+async def delete_upload(db: AsyncSession, upload: models.Upload):
+    await db.delete(upload)
+    await db.commit()
+
+async def delete_uploads_before(db: AsyncSession, updated_before: datetime):
+    result = await db.scalars(
+        delete(models.Upload).where(models.Upload.updated_at < updated_before).returning(models.Upload.id)
+    )
+    ids = result.all()
+    await db.commit()
+    return ids
+
+async def get_upload_ids(db: AsyncSession):
+    return (await db.scalars(select(models.Upload.id))).all()
+
+async def is_project_member(db: AsyncSession, project_id: str, user_id: int):
+    owner = select(models.Project.id).where(models.Project.id == project_id, models.Project.owner_id == user_id)
+    shared = select(models.project_user.c.project_id).where(
+        models.project_user.c.project_id == project_id, models.project_user.c.user_id == user_id
+    )
+    return bool(await db.scalar(select(or_(exists(owner), exists(shared)))))
+
+async def get_annotation_revision(db: AsyncSession, project_id: str):
+    return await db.scalar(select(models.Project.annotation_revision).where(models.Project.id == project_id))
+
+async def next_annotation_revision(db: AsyncSession, project_id: str):
+    # Bumping the project's counter row-locks it until commit, so revisions
+    # of a project become visible in order. None if the project is unknown.
+    return await db.scalar(
+        update(models.Project)
+        .where(models.Project.id == project_id)
+        .values(annotation_revision=models.Project.annotation_revision + 1)
+        .returning(models.Project.annotation_revision)
+        .execution_options(synchronize_session=False)
+    )
+
+async def derived_columns(coordinates: list):
+    # geometry.derived_columns of each; simplifying a large shape takes long
+    # enough to stall every other request, so it runs in the threadpool
+    return await run_in_threadpool(lambda: [geometry.derived_columns(value) for value in coordinates])
+
+async def create_annotation(db: AsyncSession, annotation: schemas.AnnotationCreate, user: schemas.User, project_id: str):
+    [columns] = await derived_columns([annotation.coordinates])
+    revision = await next_annotation_revision(db, project_id)
+    if revision is None:
+        return None
+    db_annotation = models.Annotation(**annotation.dict())
+    db_annotation.owner_id = user.id
+    db_annotation.project_id = project_id
+    db_annotation.revision = revision
+    db_annotation.updated_at = datetime.utcnow()
+    db_annotation.deleted = False
+    for field, value in columns.items():
+        setattr(db_annotation, field, value)
+    db.add(db_annotation)
+    await db.commit()
+    await db.refresh(db_annotation)
+    # refresh() expires the deferred column; we know its value
+    set_committed_value(db_annotation, 'lods', columns['lods'])
+    return db_annotation
+
+async def get_annotations(
+    db: AsyncSession,
+    project_id: str,
+    since: int | None = None,
+    after: tuple | None = None,
+    limit: int | None = None,
+    bbox: tuple | None = None,
+    min_size: float = 0,
+    lods: bool = False,
+):
+    # Without `since`: live annotations ordered by id, `after` is (id,).
+    # With `since`: every change after that revision, tombstones included,
+    # ordered by (revision, id), `after` is (revision, id).
+    # `bbox` (x0, y0, x1, y1) keeps the annotations whose box intersects it,
+    # `min_size` the ones at least that wide or high. `lods` also loads the
+    # levels of detail.
+    query = select(models.Annotation).where(models.Annotation.project_id == project_id)
+    if lods:
+        query = query.options(undefer(models.Annotation.lods))
+    if bbox is not None:
+        query = query.where(*_in_viewport(db, bbox, live=since is None))
+    if min_size:
+        query = query.where(~_smaller_than(min_size))
+    if since is None:
+        query = query.where(models.Annotation.deleted.is_(False)).order_by(models.Annotation.id)
+        if after is not None:
+            query = query.where(models.Annotation.id > after[0])
+    else:
+        query = query.where(models.Annotation.revision > since).order_by(models.Annotation.revision, models.Annotation.id)
+        if after is not None:
+            query = query.where(tuple_(models.Annotation.revision, models.Annotation.id) > tuple_(*after))
+    if limit is not None:
+        query = query.limit(limit)
+    result = await db.scalars(query)
+    return result.all()
+
+def _intersects(columns, bbox: tuple):
+    x0, y0, x1, y1 = bbox
+    return columns.max_x >= x0, columns.min_x <= x1, columns.max_y >= y0, columns.min_y <= y1
+
+def _in_viewport(db: AsyncSession, bbox: tuple, live: bool = True):
+    conditions = list(_intersects(models.Annotation.__table__.c, bbox))
+    if live and db.bind.dialect.name == 'sqlite':
+        # Live boxes are mirrored in the R*Tree; tombstones are not
+        rtree = models.annotations_rtree.c
+        conditions.append(models.Annotation.id.in_(select(rtree.id).where(*_intersects(rtree, bbox))))
+    return conditions
+
+def _smaller_than(size: float):
+    annotations = models.Annotation.__table__.c
+    return (annotations.max_x - annotations.min_x < size) & (annotations.max_y - annotations.min_y < size)
+
+def _floor(value):
+    # FLOOR() is missing from many SQLite builds. CAST truncates there and
+    # rounds on PostgreSQL; either way, one less when it went up.
+    whole = cast(value, Integer)
+    return whole - case((value < whole, 1), else_=0)
+
+async def get_annotation_viewport(
+    db: AsyncSession, project_id: str, bbox: tuple, min_size: float, cell: float, limit: int | None = None, lods: bool = False
+):
+    # Shapes at least `min_size` wide or high are returned as they are; the
+    # smaller ones are only counted, per `cell`-sized grid square.
+    large = await get_annotations(db, project_id, limit=limit, bbox=bbox, min_size=min_size, lods=lods)
+    clusters = []
+    if min_size:
+        # Bucketed by the database: only one row per non-empty cell comes back
+        annotations = models.Annotation.__table__.c
+        x, y = (annotations.min_x + annotations.max_x) / 2, (annotations.min_y + annotations.max_y) / 2
+        rows = await db.execute(
+            select(
+                func.avg(x).label('x'), func.avg(y).label('y'), func.count().label('count'),
+                func.min(annotations.min_x).label('min_x'), func.min(annotations.min_y).label('min_y'),
+                func.max(annotations.max_x).label('max_x'), func.max(annotations.max_y).label('max_y'),
+            )
+            .where(annotations.project_id == project_id, annotations.deleted.is_(False), _smaller_than(min_size), *_in_viewport(db, bbox))
+            .group_by(_floor(x / cell), _floor(y / cell))
+        )
+        clusters = [dict(row._mapping) for row in rows]
+    return {'annotations': large, 'clusters': clusters}
+
+async def get_annotation(db: AsyncSession, annotation_id: int):
+    annotation = await db.get(models.Annotation, annotation_id)
+    return annotation if annotation is not None and not annotation.deleted else None
+
+async def update_annotation(db: AsyncSession, annotation_id: int, annotation: schemas.AnnotationCreate):
+    existing_annotation = await get_annotation(db, annotation_id)
+
+    if existing_annotation:
+        [columns] = await derived_columns([annotation.coordinates])
+        for field, value in annotation.dict().items():
+            setattr(existing_annotation, field, value)
+        for field, value in columns.items():
+            setattr(existing_annotation, field, value)
+        existing_annotation.revision = await next_annotation_revision(db, existing_annotation.project_id)
+        existing_annotation.updated_at = datetime.utcnow()
+
+        await db.commit()
+
+    return existing_annotation
+
+async def delete_annotation(db: AsyncSession, annotation: models.Annotation):
+    # Soft delete: the tombstone tells incremental readers what went away
+    annotation.deleted = True
+    annotation.revision = await next_annotation_revision(db, annotation.project_id)
+    annotation.updated_at = datetime.utcnow()
+    await db.commit()
+
+def _annotation_dict(
+    annotation_id: int, annotation: schemas.AnnotationCreate | None, revision: int, updated_at: datetime,
+    deleted: bool = False, lods: dict | None = None,
+):
+    # Like models.Annotation.dict_with_lods
+    data = {'id': annotation_id}
+    if annotation is not None:
+        data.update(annotation.dict(), lods=lods)
+    data.update(revision=revision, updated_at=updated_at.isoformat(), deleted=deleted)
+    return data
+
+async def apply_annotation_batch(db: AsyncSession, operations: list[schemas.AnnotationOperation], user: schemas.User, project_id: str):
+    # Applies creates, updates and deletes with one bulk statement each and a
+    # single commit, all under one revision. Returns the per-operation
+    # results and the changes to broadcast, both in request order.
+    results = [None] * len(operations)
+    ids = {operation.id for operation in operations if operation.op != 'create'}
+    # One revision for the whole batch, and updates and deletes run as
+    # separate statements: two operations on one annotation could not be
+    # applied (or broadcast) in order, so none of them is
+    counts = Counter(operation.id for operation in operations if operation.op != 'create')
+    repeated = {id for id, count in counts.items() if count > 1}
+    rows = await db.execute(
+        select(models.Annotation.id, models.Annotation.owner_id, models.Annotation.project_id)
+        .where(models.Annotation.id.in_(ids), models.Annotation.deleted.is_(False))
+    ) if ids else []
+    existing = {row.id: row for row in rows}
+
+    creates, updates, deletes = [], [], []
+    for index, operation in enumerate(operations):
+        if operation.op != 'delete' and operation.annotation is None:
+            results[index] = schemas.AnnotationOperationResult(op=operation.op, id=operation.id, status=422, detail="annotation is required")
+        elif operation.op == 'create':
+            creates.append(index)
+        elif operation.id in repeated:
+            results[index] = schemas.AnnotationOperationResult(op=operation.op, id=operation.id, status=422, detail="id appears more than once in the batch")
+        elif (row := existing.get(operation.id)) is None or row.project_id != project_id:
+            results[index] = schemas.AnnotationOperationResult(op=operation.op, id=operation.id, status=404, detail="Annotation not found")
+        elif row.owner_id != user.id:
+            results[index] = schemas.AnnotationOperationResult(op=operation.op, id=operation.id, status=403, detail="Forbidden")
+        else:
+            (updates if operation.op == 'update' else deletes).append(index)
+
+    if not (creates or updates or deletes):
+        return results, []
+    # Before the revision bump, which holds the write lock until the commit
+    derived = dict(zip(creates + updates, await derived_columns([
+        operations[index].annotation.coordinates for index in creates + updates
+    ])))
+    revision = await next_annotation_revision(db, project_id)
+    if revision is None:
+        for index in creates:
+            results[index] = schemas.AnnotationOperationResult(op='create', status=404, detail="Project not found")
+        return results, []
+    now = datetime.utcnow()
+    stamp = {'revision': revision, 'updated_at': now}
+
+    changes = {}
+    if creates:
+        values = [
+            dict(
+                operations[index].annotation.dict(),
+                owner_id=user.id,
+                project_id=project_id,
+                deleted=False,
+                **derived[index],
+                **stamp,
+            )
+            for index in creates
+        ]
+        new_ids = await db.scalars(
+            insert(models.Annotation).returning(models.Annotation.id, sort_by_parameter_order=True), values
+        )
+        for index, annotation_id in zip(creates, new_ids):
+            results[index] = schemas.AnnotationOperationResult(op='create', id=annotation_id, status=201)
+            changes[index] = {'action': 'created', 'annotation': _annotation_dict(
+                annotation_id, operations[index].annotation, revision, now, lods=derived[index]['lods']
+            )}
+    if updates:
+        await db.execute(update(models.Annotation), [
+            {
+                'id': operations[index].id,
+                **operations[index].annotation.dict(),
+                **derived[index],
+                **stamp,
+            }
+            for index in updates
+        ])
+        for index in updates:
+            annotation_id = operations[index].id
+            results[index] = schemas.AnnotationOperationResult(op='update', id=annotation_id, status=200)
+            changes[index] = {'action': 'updated', 'annotation': _annotation_dict(
+                annotation_id, operations[index].annotation, revision, now, lods=derived[index]['lods']
+            )}
+    if deletes:
+        await db.execute(
+            update(models.Annotation)
+            .where(models.Annotation.id.in_([operations[index].id for index in deletes]))
+            .values(deleted=True, **stamp)
+            .execution_options(synchronize_session=False)
+        )
+        for index in deletes:
+            annotation_id = operations[index].id
+            results[index] = schemas.AnnotationOperationResult(op='delete', id=annotation_id, status=204)
+            changes[index] = {'action': 'deleted', 'annotation': _annotation_dict(annotation_id, None, revision, now, deleted=True)}
+    await db.commit()
+    return results, [changes[index] for index in sorted(changes)]
+
+
+async def import_project(db: AsyncSession, project_id: str, name: str, user: schemas.User, files: list[dict]):
+    # Part of an archive import's transaction, which the caller commits.
+    # Imported annotations all get revision 1. Returns the new file ids.
+    await db.execute(insert(models.Project).values(id=project_id, name=name, owner_id=user.id, annotation_revision=1))
+    if not files:
+        return []
+    file_ids = await db.scalars(
+        insert(models.File).returning(models.File.id, sort_by_parameter_order=True),
+        [dict(file, project_id=project_id) for file in files],
+    )
+    return file_ids.all()
+
+async def import_annotations(db: AsyncSession, project_id: str, user: schemas.User, annotations: list[schemas.AnnotationCreate]):
+    # A Core executemany: the ORM's bulk insert does per-row bookkeeping
+    # that nothing here needs
+    if not annotations:
+        return
+    now = datetime.utcnow()
+    derived = await derived_columns([annotation.coordinates for annotation in annotations])
+    await db.execute(models.Annotation.__table__.insert(), [
+        dict(
+            note=annotation.note,
+            color=annotation.color,
+            coordinates=annotation.coordinates,
+            owner_id=user.id,
+            project_id=project_id,
+            revision=1,
+            updated_at=now,
+            deleted=False,
+            **columns,
+        )
+        for annotation, columns in zip(annotations, derived)
+    ])
+
+async def get_annotation_export_page(db: AsyncSession, project_id: str, after: int | None, limit: int):
+    # Live annotations like get_annotations, but rows with the coordinates
+    # still as the JSON text the database holds, to be copied out verbatim
+    annotations = models.Annotation.__table__.c
+    query = (
+        select(
+            annotations.id, annotations.note, annotations.color, annotations.revision, annotations.updated_at,
+            cast(annotations.coordinates, Text).label('coordinates'),
+        )
+        .where(annotations.project_id == project_id, annotations.deleted.is_(False))
+        .order_by(annotations.id)
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.where(annotations.id > after)
+    return (await db.execute(query)).all()
+
+
+async def create_job(
+    db: AsyncSession,
+    kind: str,
+    payload: dict | None = None,
+    owner_id: int | None = None,
+    max_attempts: int = 5,
+    unless_created_after: datetime | None = None,
+):
+    # With `unless_created_after`, an existing job of the same kind created
+    # since then is returned instead, which keeps periodic jobs periodic
+    # however many workers schedule them.
+    now = datetime.utcnow()
+    if unless_created_after is not None:
+        existing = await db.scalar(
+            select(models.Job)
+            .where(models.Job.kind == kind, models.Job.created_at > unless_created_after)
+            .order_by(models.Job.id.desc())
+            .limit(1)
+        )
+        if existing is not None:
+            return existing
+    job = models.Job(
+        kind=kind,
+        payload=payload or {},
+        status='queued',
+        attempts=0,
+        max_attempts=max_attempts,
+        run_at=now,
+        created_at=now,
+        owner_id=owner_id,
+    )
+    db.add(job)
+    await db.commit()
+    return job
+
+async def get_job(db: AsyncSession, job_id: int):
+    return await db.get(models.Job, job_id)
+
+def _claimable(now: datetime):
+    # Queued and due, or running under a lease its worker stopped renewing
+    return or_(
+        and_(models.Job.status == 'queued', models.Job.run_at <= now),
+        and_(models.Job.status == 'running', models.Job.locked_until < now),
+    )
+
+async def claim_job(db: AsyncSession, worker_id: str, lease: timedelta):
+    # Claims are a conditional UPDATE, so two workers racing for the same
+    # job cannot both win; the loser moves on to the next candidate.
+    now = datetime.utcnow()
+    candidates = (await db.scalars(
+        select(models.Job.id).where(_claimable(now)).order_by(models.Job.run_at, models.Job.id).limit(8)
+    )).all()
+    for job_id in candidates:
+        job = await db.scalar(
+            update(models.Job)
+            .where(models.Job.id == job_id, _claimable(now))
+            .values(status='running', locked_by=worker_id, locked_until=now + lease, attempts=models.Job.attempts + 1)
+            .returning(models.Job)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        if job is not None:
+            return job
+    return None
+
+async def update_job(db: AsyncSession, job_id: int, worker_id: str, **values):
+    # Only the worker holding the job may change it
+    result = await db.execute(
+        update(models.Job)
+        .where(models.Job.id == job_id, models.Job.locked_by == worker_id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount == 1
@@ -1,9 +1,9 @@
 import uuid
+from sqlalchemy import exists, or_, select, union
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
-from passlib.hash import bcrypt
+from sqlalchemy.orm import Session, joinedload, selectinload
 
-from . import models, schemas
+from . import models, schemas, storage
 
 
 def get_user_auth(db: Session, username: str):
@@ -21,25 +21,46 @@ def get_user(db: Session, username: str):
         return False
 
 def create_user(db: Session, user: schemas.UserCreate):
-    user.hashed_password = bcrypt.hash(user.hashed_password)
+    # user.hashed_password must already be hashed, see hashing.PasswordHasher
     db_user = models.User(**user.dict())
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
     return db_user
 
-def get_projects(db: Session, user: schemas.User):
-    projects = db.query(models.Project).filter(
-        (models.Project.owner_id == user.id) |
-        (models.Project.shared_users.any(id=user.id))
-    ).all()
-    return projects
+# Everything schemas.Project serializes, loaded in a fixed number of queries
+project_load_options = (
+    joinedload(models.Project.owner),
+    selectinload(models.Project.files),
+    selectinload(models.Project.shared_users),
+)
+
+def get_projects(db: Session, user: schemas.User, limit: int | None = None, after: str | None = None):
+    project_ids = union(
+        select(models.Project.id).where(models.Project.owner_id == user.id),
+        select(models.project_user.c.project_id).where(models.project_user.c.user_id == user.id),
+    ).subquery()
+    query = db.query(models.Project).filter(
+        models.Project.id.in_(select(project_ids.c[0]))
+    ).options(*project_load_options).order_by(models.Project.id)
+    if after is not None:
+        query = query.filter(models.Project.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
 
 def get_project_from_uuid(db: Session, project_uuid):
     return db.query(models.Project).filter(models.Project.uuid == project_uuid).first()
 
 def get_project(db: Session, project_id):
-    return db.query(models.Project).filter(models.Project.id == project_id).first()
+    return db.query(models.Project).filter(models.Project.id == project_id).options(*project_load_options).first()
+
+def is_project_member(db: Session, project_id: str, user_id: int):
+    owner = select(models.Project.id).where(models.Project.id == project_id, models.Project.owner_id == user_id)
+    shared = select(models.project_user.c.project_id).where(
+        models.project_user.c.project_id == project_id, models.project_user.c.user_id == user_id
+    )
+    return bool(db.scalar(select(or_(exists(owner), exists(shared)))))
 
 def create_project(db: Session, project: schemas.ProjectCreate, user: schemas.User):
     db_project = models.Project(**project.dict())
@@ -61,39 +82,14 @@ def create_file(db: Session, file: schemas.FileCreate):
     return db_file
 
 def delete_file(db: Session, file: models.File):
+    path = file.path
     db.delete(file)
     db.commit()
+    # Blobs are shared between File rows with the same content, and an
+    # upload of the same content may be about to share this one
+    if db.query(models.File.id).filter(models.File.path == path).first() is None:
+        storage.remove_unless_fresh(path)
     
-def create_annotation(db: Session, annotation: schemas.AnnotationCreate, user: schemas.User, project_id: str):
-    db_annotation = models.Annotation(**annotation.dict())
-    db_annotation.owner_id = user.id
-    db_annotation.project_id = project_id
-    db.add(db_annotation)
-    db.commit()
-    db.refresh(db_annotation)
-    return db_annotation
-
-def get_annotations(db: Session, project_id: str):
-    return db.query(models.Annotation).filter(models.Annotation.project_id == project_id).all()
-
-def get_annotation(db: Session, annotation_id: str):
-    return db.query(models.Annotation).filter(models.Annotation.id == annotation_id).first()
-
-def update_annotation(db: Session, annotation_id: int, annotation: schemas.AnnotationCreate):
-    existing_annotation = db.query(models.Annotation).filter(models.Annotation.id == annotation_id).first()
-
-    if existing_annotation:
-        for field, value in annotation.dict().items():
-            setattr(existing_annotation, field, value)
-
-        db.commit()
-
-    return existing_annotation
-
-def delete_annotation(db: Session, annotation: models.Annotation):
-    db.delete(annotation)
-    db.commit()
-
 def add_shared_user(db: Session, user: schemas.User, project_id: str):
     try:
         db.execute(models.project_user.insert().values(project_id=project_id, user_id=user.id))
@@ -0,0 +1,134 @@
+import abc
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+
+# memory:// keeps events inside one process, sqlite:///path shares them
+# between the uvicorn workers of one host, redis://host:port/db between hosts.
+EVENT_BUS_URL = os.environ.get("AAT_EVENT_BUS_URL", "memory://")
+
+CHANNEL = "aat:annotations"
+
+
+class EventBus(abc.ABC):
+    @abc.abstractmethod
+    async def publish(self, event: dict):
+        ...
+
+    @abc.abstractmethod
+    def subscribe(self):
+        # Async iterator over every event published after the call,
+        # including the ones published by this process.
+        ...
+
+    async def close(self):
+        pass
+
+
+class LocalEventBus(EventBus):
+    def __init__(self):
+        self.queues: set[asyncio.Queue] = set()
+
+    async def publish(self, event: dict):
+        for queue in self.queues:
+            queue.put_nowait(event)
+
+    async def subscribe(self):
+        queue = asyncio.Queue()
+        self.queues.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.queues.discard(queue)
+
+
+class SQLiteEventBus(EventBus):
+    # Append-only event log in a WAL-mode SQLite file. Writers never block
+    # readers, so every worker can poll it cheaply.
+    def __init__(self, path: str, poll_interval: float = 0.05, retention: float = 60.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # One connection for the bus's lifetime, used from threadpool threads
+        # one at a time (sqlite3 connections are not safe to share otherwise)
+        self.conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, payload TEXT NOT NULL)"
+            )
+
+    def _insert(self, payload: str):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO events (created_at, payload) VALUES (?, ?)", (now, payload))
+            self.conn.execute("DELETE FROM events WHERE created_at < ?", (now - self.retention,))
+
+    def _last_id(self):
+        with self.lock, self.conn:
+            return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _read_after(self, last_id: int):
+        with self.lock, self.conn:
+            return self.conn.execute("SELECT id, payload FROM events WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+
+    async def publish(self, event: dict):
+        await run_in_threadpool(self._insert, json.dumps(event))
+
+    async def subscribe(self):
+        last_id = await run_in_threadpool(self._last_id)
+        while True:
+            rows = await run_in_threadpool(self._read_after, last_id)
+            for last_id, payload in rows:
+                yield json.loads(payload)
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+    async def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class RedisEventBus(EventBus):
+    # `client` lets a fake (e.g. fakeredis.aioredis.FakeRedis) stand in for a server.
+    def __init__(self, url: str = None, client=None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.client = client
+
+    async def publish(self, event: dict):
+        await self.client.publish(CHANNEL, json.dumps(event))
+
+    async def subscribe(self):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield json.loads(message["data"])
+        finally:
+            await pubsub.unsubscribe(CHANNEL)
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_event_bus(url: str = EVENT_BUS_URL) -> EventBus:
+    if url.startswith("memory://"):
+        return LocalEventBus()
+    if url.startswith("sqlite:///"):
+        return SQLiteEventBus(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisEventBus(url)
+    raise ValueError(f"Unsupported event bus url: {url}")
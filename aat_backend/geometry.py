@@ -0,0 +1,258 @@
+import functools
+import math
+import os
+from numbers import Real
+
+
+# Annotation coordinates are free-form JSON. Points are recognised wherever
+# they appear as [x, y, ...] number lists or {"x": .., "y": ..} objects, and
+# {"x", "y", "width", "height"} objects count as rectangles.
+
+# Levels of detail: level n is the coordinates with every point sequence
+# (polygon, polyline) simplified so that no point moves more than the n-th
+# tolerance, in coordinate units. Sequences shorter than LOD_MIN_POINTS are
+# left alone, and a level is only stored when it has at most
+# LOD_MIN_REDUCTION of the points of the level below it.
+LOD_TOLERANCES = tuple(float(value) for value in os.environ.get("AAT_LOD_TOLERANCES", "1,4,16,64").split(",") if value.strip())
+LOD_MIN_POINTS = int(os.environ.get("AAT_LOD_MIN_POINTS", 64))
+LOD_MIN_REDUCTION = 0.75
+
+def _is_number(value):
+    # Exact type checks first: an ABC isinstance costs more than the rest of
+    # a point's handling, and parsed JSON only ever holds ints and floats.
+    if type(value) is int:
+        return True
+    if type(value) is float:
+        return math.isfinite(value)
+    return isinstance(value, Real) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def iter_points(value):
+    if isinstance(value, dict):
+        x, y = value.get("x"), value.get("y")
+        if _is_number(x) and _is_number(y):
+            yield x, y
+            width, height = value.get("width"), value.get("height")
+            if _is_number(width) and _is_number(height):
+                yield x + width, y + height
+            return
+        for item in value.values():
+            yield from iter_points(item)
+    elif isinstance(value, (list, tuple)):
+        if len(value) >= 2 and _is_number(value[0]) and _is_number(value[1]):
+            yield value[0], value[1]
+            return
+        for item in value:
+            # Inline for the common list of [x, y] lists: a generator per
+            # point would cost more than the point itself
+            if type(item) is list and len(item) >= 2 and _is_number(item[0]) and _is_number(item[1]):
+                yield item[0], item[1]
+            else:
+                yield from iter_points(item)
+
+
+def bounding_box(coordinates):
+    # (min_x, min_y, max_x, max_y), or None when there are no points
+    points = iter_points(coordinates)
+    first = next(points, None)
+    if first is None:
+        return None
+    min_x = max_x = first[0]
+    min_y = max_y = first[1]
+    for x, y in points:
+        if x < min_x:
+            min_x = x
+        elif x > max_x:
+            max_x = x
+        if y < min_y:
+            min_y = y
+        elif y > max_y:
+            max_y = y
+    return float(min_x), float(min_y), float(max_x), float(max_y)
+
+
+def bbox_columns(coordinates):
+    box = bounding_box(coordinates)
+    if box is None:
+        return {"min_x": None, "min_y": None, "max_x": None, "max_y": None}
+    return dict(zip(("min_x", "min_y", "max_x", "max_y"), box))
+
+
+def parse_bbox(value: str):
+    parts = [float(part) for part in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox needs four numbers")
+    x0, y0, x1, y1 = parts
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def _is_point(value):
+    return type(value) is list and len(value) >= 2 and _is_number(value[0]) and _is_number(value[1])
+
+
+def _point_sequence(value: list):
+    # The (x, y) of a list of [x, y, ...] lists or {"x", "y"} objects, or
+    # None when it is anything else
+    if len(value) < 2:
+        return None
+    if all(map(_is_point, value)):
+        return [(item[0], item[1]) for item in value]
+    if all(type(item) is dict and _is_number(item.get("x")) and _is_number(item.get("y")) and "width" not in item for item in value):
+        return [(item["x"], item["y"]) for item in value]
+    return None
+
+
+def normalize(value):
+    # Coordinates as they are stored: numbers must be finite, and repeated
+    # consecutive points (a mouse that did not move) are dropped. Values
+    # are otherwise kept as sent, at full precision.
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if value and type(value[0]) is list and all(map(_is_point, value)):
+            return [point for index, point in enumerate(value) if index == 0 or point != value[index - 1]]
+        return [normalize(item) for item in value]
+    if type(value) is float and not math.isfinite(value):
+        raise ValueError("coordinates must be finite numbers")
+    return value
+
+
+@functools.cache
+def _numpy():
+    # Optional, and only needed once a large shape is simplified, so it is
+    # not imported with the app
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _douglas_peucker_numpy(points, tolerance: float):
+    # All open segments are split together, one vectorized pass over the
+    # points per level of the recursion instead of one per segment
+    np = _numpy()
+    xy = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+    starts, ends = np.array([0]), np.array([len(xy) - 1])
+    while starts.size:
+        inner = ends - starts - 1
+        open_segments = inner > 0
+        starts, ends, inner = starts[open_segments], ends[open_segments], inner[open_segments]
+        if not starts.size:
+            break
+        # Every interior point, with the number of the segment it is in
+        segment = np.repeat(np.arange(starts.size), inner)
+        first = np.cumsum(inner) - inner
+        index = np.arange(inner.sum()) - first[segment] + starts[segment] + 1
+        origin = xy[starts][segment]
+        direction = xy[ends][segment] - origin
+        offsets = xy[index] - origin
+        length = np.hypot(direction[:, 0], direction[:, 1])
+        cross = np.abs(direction[:, 0] * offsets[:, 1] - direction[:, 1] * offsets[:, 0])
+        # A closed ring (zero length): distance to its start point
+        distances = np.where(length > 0, cross / np.where(length > 0, length, 1), np.hypot(offsets[:, 0], offsets[:, 1]))
+        farthest = np.maximum.reduceat(distances, first)
+        candidates = np.flatnonzero(distances == farthest[segment])
+        _, first_candidate = np.unique(segment[candidates], return_index=True)
+        split = index[candidates[first_candidate]]
+        splitting = farthest > tolerance
+        split = split[splitting]
+        keep[split] = True
+        starts, ends = np.concatenate((starts[splitting], split)), np.concatenate((split, ends[splitting]))
+    return np.flatnonzero(keep).tolist()
+
+
+def _douglas_peucker_python(points, tolerance: float):
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        (x0, y0), (x1, y1) = points[start], points[end]
+        dx, dy = x1 - x0, y1 - y0
+        length = math.hypot(dx, dy)
+        farthest, distance = start, -1.0
+        for index in range(start + 1, end):
+            x, y = points[index]
+            if length == 0:
+                d = math.hypot(x - x0, y - y0)
+            else:
+                d = abs(dx * (y - y0) - dy * (x - x0)) / length
+            if d > distance:
+                farthest, distance = index, d
+        if distance > tolerance:
+            keep[farthest] = True
+            stack.append((start, farthest))
+            stack.append((farthest, end))
+    return [index for index, kept in enumerate(keep) if kept]
+
+
+def douglas_peucker(points, tolerance: float):
+    # Indices of the points kept; vectorized with NumPy when it is installed
+    if _numpy() is not None:
+        return _douglas_peucker_numpy(points, tolerance)
+    return _douglas_peucker_python(points, tolerance)
+
+
+def _sequence_lengths(value):
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from _sequence_lengths(item)
+    elif isinstance(value, list):
+        points = _point_sequence(value)
+        if points is None:
+            for item in value:
+                yield from _sequence_lengths(item)
+        else:
+            yield len(points)
+
+
+def simplify(value, tolerance: float, counts: list | None = None):
+    # A copy of `value` with its long point sequences simplified; `counts`
+    # collects the number of points of every sequence, simplified or not
+    if isinstance(value, dict):
+        return {key: simplify(item, tolerance, counts) for key, item in value.items()}
+    if isinstance(value, list):
+        points = _point_sequence(value)
+        if points is None:
+            return [simplify(item, tolerance, counts) for item in value]
+        if len(points) >= LOD_MIN_POINTS:
+            value = [value[index] for index in douglas_peucker(points, tolerance)]
+        if counts is not None:
+            counts.append(len(value))
+        return value
+    return value
+
+
+def levels_of_detail(coordinates, tolerances: tuple = LOD_TOLERANCES):
+    # {"1": coordinates, ...} for the levels worth storing, or None. Each
+    # level simplifies the one below it, which is much faster on large
+    # shapes and keeps the drift within the sum of the tolerances.
+    counts = list(_sequence_lengths(coordinates))
+    if not counts or max(counts) < LOD_MIN_POINTS:
+        return None
+    levels, previous, previous_count = {}, coordinates, sum(counts)
+    for level, tolerance in enumerate(tolerances, 1):
+        counts = []
+        simplified = simplify(previous, tolerance, counts)
+        if sum(counts) <= previous_count * LOD_MIN_REDUCTION:
+            levels[str(level)] = simplified
+            previous, previous_count = simplified, sum(counts)
+    return levels or None
+
+
+def at_level_of_detail(coordinates, levels: dict | None, lod: int):
+    # The closest stored level at or below `lod`; level 0 is the original
+    if not lod or not levels:
+        return coordinates
+    stored = [int(level) for level in levels if int(level) <= lod]
+    return levels[str(max(stored))] if stored else coordinates
+
+
+def derived_columns(coordinates):
+    # Everything stored alongside the coordinates of an annotation
+    return {**bbox_columns(coordinates), "lods": levels_of_detail(coordinates)}
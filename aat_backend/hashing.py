@@ -0,0 +1,66 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import metrics
+
+
+# bcrypt takes ~250ms of CPU per call, so it never runs on the event loop.
+# "thread" is enough because bcrypt releases the GIL; "process" isolates it
+# completely at the cost of one interpreter per worker.
+HASH_POOL = os.environ.get("AAT_HASH_POOL", "thread")
+HASH_WORKERS = int(os.environ.get("AAT_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# Calls allowed to wait for a free worker before we answer 503.
+HASH_QUEUE_SIZE = int(os.environ.get("AAT_HASH_QUEUE_SIZE", 32))
+
+
+@functools.cache
+def context():
+    # Built on first use (in the pool process, with "process"), so importing
+    # this module does not load passlib and bcrypt
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _hash(password: str):
+    return context().hash(password)
+
+def _verify(password: str, hashed_password: str):
+    return context().verify(password, hashed_password)
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, kind: str = HASH_POOL, workers: int = HASH_WORKERS, queue_size: int = HASH_QUEUE_SIZE):
+        executor_class = ProcessPoolExecutor if kind == "process" else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=workers)
+        self.capacity = workers + queue_size
+        self.in_flight = 0
+
+    async def _run(self, operation: str, fn, *args):
+        # Only touched from the event loop, so a plain counter is enough.
+        if self.in_flight >= self.capacity:
+            metrics.BCRYPT_REJECTED.inc()
+            raise PoolSaturated()
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+            metrics.BCRYPT_LATENCY.observe(time.perf_counter() - started, operation=operation)
+
+    async def hash(self, password: str):
+        return await self._run("hash", _hash, password)
+
+    async def verify(self, password: str, hashed_password: str):
+        return await self._run("verify", _verify, password, hashed_password)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import math
+import os
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING
+
+from . import async_crud, storage
+from .database import AsyncSessionLocal
+
+# Pillow is only needed where images are processed: imported there, so web
+# workers that never handle an upload do not load it
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+# Uploaded images get a thumbnail and an XYZ tile pyramid, stored next to
+# their blob in <path>.d/:
+#
+#   info.json                 size, levels and tile format
+#   thumbnail.<ext>           at most THUMBNAIL_SIZE on the long side
+#   tiles/<z>/<x>/<y>.<ext>   TILE_SIZE squares, smaller at the right and
+#                             bottom edges
+#
+# z = 0 holds the whole image in one tile and every level doubles the
+# resolution up to the full size. Like the blob, this is shared by every
+# File row with the same content.
+
+TILE_SIZE = 256
+THUMBNAIL_SIZE = 256
+# Decoding and tiling are CPU bound; they run in separate processes so that
+# request handling in this one is unaffected.
+IMAGE_WORKERS = int(os.environ.get("AAT_IMAGE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# Larger images are refused rather than decoded into memory. Checked on the
+# header: Pillow itself only warns below twice its MAX_IMAGE_PIXELS.
+MAX_PIXELS = int(os.environ.get("AAT_IMAGE_MAX_PIXELS", 250_000_000))
+
+executor: ProcessPoolExecutor | None = None
+
+
+def tile_levels(width: int, height: int):
+    return max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE))) + 1
+
+def tile_path(path: str, z: int, x: int, y: int, tile_format: str):
+    return os.path.join(storage.derived_dir(path), "tiles", str(z), str(x), f"{y}.{tile_format}")
+
+def thumbnail_path(path: str, tile_format: str):
+    return os.path.join(storage.derived_dir(path), f"thumbnail.{tile_format}")
+
+
+def _save(image: "Image.Image", target: str, tile_format: str):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if tile_format == "jpg":
+        image.save(target, "JPEG", quality=85)
+    else:
+        image.save(target, "PNG")
+
+def generate(source: str, target: str):
+    # Blocking; runs in the process pool. Returns the contents of info.json.
+    from PIL import Image, ImageOps
+
+    info_path = os.path.join(target, "info.json")
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            return json.load(f)
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    with Image.open(source) as opened:
+        # open() only reads the header
+        if opened.width * opened.height > MAX_PIXELS:
+            raise ValueError(f"{opened.width}x{opened.height} is more than {MAX_PIXELS} pixels")
+        image = ImageOps.exif_transpose(opened)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    tile_format = "png" if has_alpha else "jpg"
+    width, height = image.size
+    levels = tile_levels(width, height)
+
+    # Built under a temporary name, so a crash never leaves a partial pyramid
+    # that looks finished; the first of two concurrent runs wins.
+    building = f"{target}.{uuid.uuid4().hex}.partial"
+    try:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        _save(thumbnail, os.path.join(building, f"thumbnail.{tile_format}"), tile_format)
+
+        level = image
+        for z in range(levels - 1, -1, -1):
+            for x in range(math.ceil(level.width / TILE_SIZE)):
+                for y in range(math.ceil(level.height / TILE_SIZE)):
+                    box = (x * TILE_SIZE, y * TILE_SIZE, min((x + 1) * TILE_SIZE, level.width), min((y + 1) * TILE_SIZE, level.height))
+                    _save(level.crop(box), os.path.join(building, "tiles", str(z), str(x), f"{y}.{tile_format}"), tile_format)
+            if z:
+                level = level.resize((math.ceil(level.width / 2), math.ceil(level.height / 2)), Image.Resampling.BOX)
+
+        info = {"width": width, "height": height, "tile_levels": levels, "tile_size": TILE_SIZE, "tile_format": tile_format}
+        with open(os.path.join(building, "info.json"), "w") as f:
+            json.dump(info, f)
+        try:
+            os.rename(building, target)
+        except OSError:
+            if not os.path.exists(info_path):
+                raise
+    finally:
+        shutil.rmtree(building, ignore_errors=True)
+    return info
+
+
+async def process_file(file_id: int):
+    # Run after a file is stored. Files that are not images (or too large to
+    # decode) are marked failed and keep being served whole only.
+    global executor
+    async with AsyncSessionLocal() as db:
+        file = await async_crud.get_file(db, file_id)
+        if file is None or file.processing_status == "ready":
+            return
+        path = file.path
+    from PIL import Image, UnidentifiedImageError
+
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    pool = executor
+    try:
+        info = await asyncio.get_running_loop().run_in_executor(
+            pool, generate, storage.full_path(path), storage.full_path(storage.derived_dir(path))
+        )
+        status = "ready"
+    except BrokenProcessPool:
+        # A pool process died (killed for memory, most likely) and the pool
+        # refuses all work from then on. The next file gets a new one; this
+        # job is retried, up to its max_attempts.
+        if executor is pool:
+            shutdown()
+        raise
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        info, status = {}, "failed"
+    async with AsyncSessionLocal() as db:
+        await async_crud.set_file_processing(db, path, status, info)
+
+def shutdown():
+    # The next process_file starts a new pool
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import random
+import socket
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from starlette.concurrency import run_in_threadpool
+
+from . import archive, async_crud, imaging, metrics, models, storage, uploads
+from .database import AsyncSessionLocal
+
+
+# Slow work is queued in the jobs table and run by workers: inside every
+# uvicorn worker (AAT_JOB_WORKERS > 0) and/or as `python -m aat_backend.worker`.
+# Jobs survive restarts; a job whose worker dies is picked up again once its
+# lease runs out. Failed attempts are retried with exponential backoff.
+
+JOB_WORKERS = int(os.environ.get("AAT_JOB_WORKERS", 2))
+POLL_INTERVAL = float(os.environ.get("AAT_JOB_POLL_INTERVAL", 1))
+LEASE = timedelta(seconds=float(os.environ.get("AAT_JOB_LEASE", 60)))
+BACKOFF_BASE = 2
+BACKOFF_MAX = 600
+# The worker's own loops back off this long at most while the database fails
+LOOP_BACKOFF_MAX = 60
+
+# Blobs and temporary files younger than this are never swept: their File
+# row may not be committed yet.
+ORPHAN_GRACE = timedelta(seconds=storage.FRESH_SECONDS)
+EXPORT_TTL = timedelta(hours=float(os.environ.get("AAT_EXPORT_TTL_HOURS", 168)))
+
+# kind -> how often workers schedule it
+PERIODIC = {
+    "collect_uploads": timedelta(hours=1),
+    "sweep_orphans": timedelta(hours=float(os.environ.get("AAT_SWEEP_INTERVAL_HOURS", 24))),
+}
+
+handlers = {}
+# Workers running in this process; they are woken up by jobs queued here
+# instead of waiting for their next poll.
+local_workers = set()
+
+
+def handler(kind: str):
+    def register(fn):
+        handlers[kind] = fn
+        return fn
+    return register
+
+
+async def enqueue(db, kind: str, payload: dict | None = None, owner_id: int | None = None, **options):
+    job = await async_crud.create_job(db, kind, payload, owner_id=owner_id, **options)
+    for worker in local_workers:
+        worker.wakeup.set()
+    return job
+
+def backoff(attempts: int):
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+
+class Worker:
+    def __init__(self, concurrency: int = JOB_WORKERS, poll_interval: float = POLL_INTERVAL):
+        self.id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.running: set[int] = set()
+        self.wakeup = asyncio.Event()
+
+    async def run(self):
+        # Runs until cancelled
+        local_workers.add(self)
+        try:
+            await asyncio.gather(
+                *(self._work() for _ in range(self.concurrency)),
+                self._renew_leases(),
+                self._schedule(),
+            )
+        finally:
+            local_workers.discard(self)
+
+    async def _failed(self, loop: str, failures: int):
+        # The loops run under one gather: an exception escaping any of them
+        # would stop the whole worker, with nobody to notice
+        metrics.log.exception("job worker %s: %s failed (%d in a row)", self.id, loop, failures)
+        await asyncio.sleep(min(self.poll_interval * 2 ** failures, LOOP_BACKOFF_MAX))
+
+    async def _work(self):
+        failures = 0
+        while True:
+            try:
+                async with AsyncSessionLocal() as db:
+                    job = await async_crud.claim_job(db, self.id, LEASE)
+                if job is None:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    # A job whose result could not be saved runs again when
+                    # its lease is over
+                    await self.execute(job)
+                failures = 0
+            except Exception:
+                failures += 1
+                await self._failed("claiming or finishing a job", failures)
+
+    async def execute(self, job: models.Job):
+        self.running.add(job.id)
+        try:
+            if job.attempts > job.max_attempts:
+                # Claimed again after its worker kept dying
+                raise RuntimeError("gave up after the job's workers stopped responding")
+            result = await handlers[job.kind](job)
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back without counting the attempt
+            await asyncio.shield(self._update(
+                job, status="queued", run_at=datetime.utcnow(), attempts=job.attempts - 1, locked_by=None
+            ))
+            raise
+        except Exception as e:
+            error = "".join(traceback.format_exception_only(e)).strip()
+            if job.attempts >= job.max_attempts or job.kind not in handlers:
+                await self._update(job, status="failed", error=error, finished_at=datetime.utcnow(), locked_by=None)
+            else:
+                run_at = datetime.utcnow() + backoff(job.attempts)
+                await self._update(job, status="queued", error=error, run_at=run_at, locked_by=None)
+        else:
+            await self._update(job, status="done", result=result, error=None, finished_at=datetime.utcnow(), locked_by=None)
+        finally:
+            self.running.discard(job.id)
+
+    async def _update(self, job: models.Job, **values):
+        async with AsyncSessionLocal() as db:
+            await async_crud.update_job(db, job.id, self.id, **values)
+
+    async def _renew_leases(self):
+        # Already on a short period, which is also its retry
+        while True:
+            await asyncio.sleep(LEASE.total_seconds() / 3)
+            for job_id in list(self.running):
+                try:
+                    async with AsyncSessionLocal() as db:
+                        await async_crud.update_job(db, job_id, self.id, locked_until=datetime.utcnow() + LEASE)
+                except Exception:
+                    metrics.log.exception("job worker %s: renewing the lease of job %d failed", self.id, job_id)
+
+    async def _schedule(self):
+        failures = 0
+        while True:
+            try:
+                async with AsyncSessionLocal() as db:
+                    for kind, interval in PERIODIC.items():
+                        await enqueue(db, kind, unless_created_after=datetime.utcnow() - interval)
+            except Exception:
+                failures += 1
+                await self._failed("scheduling periodic jobs", failures)
+                continue
+            failures = 0
+            await asyncio.sleep(min(PERIODIC.values()).total_seconds())
+
+
+@handler("process_file")
+async def process_file(job: models.Job):
+    await imaging.process_file(job.payload["file_id"])
+
+
+@handler("collect_uploads")
+async def collect_uploads(job: models.Job):
+    await uploads.collect_garbage()
+
+
+@handler("sweep_orphans")
+async def sweep_orphans(job: models.Job):
+    # Blobs no File row points to: left behind when a delete or an upload
+    # failed halfway. Also clears old temporary files and expired exports.
+    before = time.time() - ORPHAN_GRACE.total_seconds()
+    candidates = await run_in_threadpool(storage.stale_blobs, before)
+    async with AsyncSessionLocal() as db:
+        referenced = await async_crud.get_referenced_paths(db, candidates)
+    removed = 0
+    for path in candidates:
+        # Unless an upload reused it since it was listed
+        if path not in referenced and await run_in_threadpool(storage.remove_unless_fresh, path, before):
+            removed += 1
+    tmp = await run_in_threadpool(storage.remove_stale_files, "tmp", before)
+    exports = await run_in_threadpool(storage.remove_stale_files, "exports", time.time() - EXPORT_TTL.total_seconds())
+    return {"blobs": removed, "tmp": tmp, "exports": exports}
+
+
+def export_path(job_id: int):
+    return os.path.join("exports", f"{job_id}.tar.gz")
+
+@handler("export_project")
+async def export_project(job: models.Job):
+    # The project's archive (see archive.py), gzipped. File contents are
+    # left out unless the job asks for them: they are already stored, and
+    # GET /projects/{id}/archive streams them without a copy on disk.
+    project_id = job.payload["project_id"]
+    path = storage.full_path(export_path(job.id))
+    await run_in_threadpool(os.makedirs, os.path.dirname(path), exist_ok=True)
+    partial = storage.full_path(export_path(job.id) + ".partial")
+    project_archive = archive.ProjectArchive(project_id, include_files=job.payload.get("files", False))
+    f = await run_in_threadpool(open, partial, "wb")
+    try:
+        async for chunk in archive.gzipped(project_archive):
+            await run_in_threadpool(f.write, chunk)
+        await run_in_threadpool(f.close)
+        await run_in_threadpool(os.replace, partial, path)
+    except BaseException:
+        f.close()
+        await run_in_threadpool(storage.remove, export_path(job.id) + ".partial")
+        raise
+    return {"path": export_path(job.id), "annotations": project_archive.annotations, "files": project_archive.files}
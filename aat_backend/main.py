@@ -1,19 +1,30 @@
+import asyncio
 import os
-import uuid
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from typing import Annotated
 
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, UploadFile
-from fastapi.responses import FileResponse, RedirectResponse, Response
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, Query, status, Request, WebSocket, WebSocketDisconnect, UploadFile, BackgroundTasks
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 
 
-from . import crud, models, schemas
-from .database import engine, get_db
+from starlette.concurrency import run_in_threadpool
+
+from . import access, archive, async_crud, crud, geometry, imaging, jobs, metrics, models, schemas, serialization, storage, uploads
+from .cache import TTLCache
+from .database import SessionLocal, async_engine, engine, get_async_db, get_db
+from .events import create_event_bus
+from .hashing import PasswordHasher, PoolSaturated
+from .responses import file_response
+from .rooms import RoomManager
 
 
 # to get a string like this run:
@@ -22,28 +33,124 @@ SECRET_KEY="48d56adc96ef62fd6d10a01ce9da241929b554f4976eed59159fa2a091031b76"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
 
+# Authenticated users are cached by username so get_current_user skips the DB.
+USER_CACHE_SIZE = int(os.environ.get("AAT_USER_CACHE_SIZE", 4096))
+USER_CACHE_TTL = float(os.environ.get("AAT_USER_CACHE_TTL", 60))
+# When enabled, tokens carry the user id and display fields, so requests
+# made with them need neither the cache nor the DB.
+JWT_USER_CLAIMS = os.environ.get("AAT_JWT_USER_CLAIMS", "0") == "1"
+# Longest wait before subscribing to the event bus again after it failed
+EVENT_BUS_RETRY_MAX = 30
 
-models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+# The schema is managed by alembic (`alembic upgrade head`), not at import.
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
+router = APIRouter()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+metrics.instrument_engine(engine, "sync")
+metrics.instrument_engine(async_engine.sync_engine, "async")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# File routes also serve <img> and links, which cannot send headers
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+
+# Built by start_components() when an app starts and shut down when it
+# stops, so every app (another create_app(), a test client) gets its own
+# instead of the executors and event bus a previous one closed. One app
+# serves at a time per process.
+password_hasher: PasswordHasher | None = None
+user_cache: TTLCache | None = None
+project_access: access.ProjectAccess | None = None
+rooms: RoomManager | None = None
+event_bus = None
+
+def start_components():
+    global password_hasher, user_cache, project_access, rooms, event_bus
+    password_hasher = PasswordHasher()
+    user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+    project_access = access.ProjectAccess()
+    rooms = RoomManager()
+    event_bus = create_event_bus()
+
+async def stop_components():
+    rooms.close()
+    await event_bus.close()
+    password_hasher.shutdown()
+    imaging.shutdown()
+
+async def publish_annotation(project_id: str, action: str, annotation: dict):
+    await event_bus.publish({'project_id': project_id, 'action': action, 'annotation': annotation})
 
-def authenticate_user(db, username: str, password: str):
-    user = crud.get_user_auth(db, username)
+async def publish_annotation_batch(project_id: str, changes: list[dict]):
+    await event_bus.publish({'project_id': project_id, 'action': 'batch', 'changes': changes})
+
+async def publish_membership(project_id: str, user_id: int):
+    # Other workers may have cached the user as a non-member
+    await event_bus.publish({'project_id': project_id, 'action': 'membership', 'user_id': user_id})
+
+async def consume_annotation_events():
+    # Subscribes again when the bus fails (Redis restarting, a locked SQLite
+    # file), backing off while it keeps failing. Events published meanwhile
+    # do not reach this worker's sockets.
+    failures = 0
+    while True:
+        try:
+            async for event in event_bus.subscribe():
+                failures = 0
+                if event['action'] == 'membership':
+                    project_access.invalidate(event['project_id'], event['user_id'])
+                elif event['action'] == 'batch':
+                    await rooms.publish_batch(event['project_id'], event['changes'])
+                else:
+                    await rooms.publish(event['project_id'], event['action'], event['annotation'])
+        except Exception:
+            failures += 1
+            metrics.log.exception("event bus subscription failed (%d in a row)", failures)
+            await asyncio.sleep(min(0.1 * 2 ** failures, EVENT_BUS_RETRY_MAX))
+
+async def write_metrics_snapshots():
+    while True:
+        await run_in_threadpool(metrics.write_snapshot)
+        await asyncio.sleep(metrics.SNAPSHOT_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_components()
+    app.state.event_consumer = asyncio.create_task(consume_annotation_events())
+    app.state.job_worker = asyncio.create_task(jobs.Worker().run()) if jobs.JOB_WORKERS > 0 else None
+    app.state.metrics_writer = asyncio.create_task(write_metrics_snapshots()) if metrics.METRICS_DIR else None
+    yield
+    app.state.event_consumer.cancel()
+    await asyncio.gather(app.state.event_consumer, return_exceptions=True)
+    if app.state.job_worker is not None:
+        # Running jobs are handed back to the queue
+        app.state.job_worker.cancel()
+        await asyncio.gather(app.state.job_worker, return_exceptions=True)
+    if app.state.metrics_writer is not None:
+        app.state.metrics_writer.cancel()
+        metrics.remove_snapshot()
+    await stop_components()
+
+async def password_pool_saturated(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many logins in progress, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+async def validation_error(request, exc):
+    try:
+        return await request_validation_exception_handler(request, exc)
+    except ValueError:
+        # The rejected input itself isn't JSON (NaN coordinates), so leave it out
+        errors = [{key: value for key, value in error.items() if key not in ("input", "ctx")} for error in exc.errors()]
+        return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content={"detail": errors})
+
+async def authenticate_user(db, username: str, password: str):
+    user = await async_crud.get_user_auth(db, username)
     if not user:
         return False
-    if not pwd_context.verify(password, user.hashed_password):
+    if not await password_hasher.verify(password, user.hashed_password):
         return False
     return user
 
@@ -57,10 +164,7 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(
-    token: Annotated[str, Depends(oauth2_scheme)],
-    db: Annotated[Session, Depends(get_db)]
-):
+def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -74,22 +178,72 @@ async def get_current_user(
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = crud.get_user(db, username=token_data.username)
+    if "uid" in payload:
+        return schemas.User(
+            id=payload["uid"],
+            username=username,
+            firstname=payload.get("firstname"),
+            lastname=payload.get("lastname"),
+        )
+    user = user_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
+        with SessionLocal() as db:
+            user = crud.get_user(db, username=token_data.username)
+        if not user:
+            raise credentials_exception
+        user_cache.set(token_data.username, user)
     return user
 
+async def get_project_member(
+    project_id: str,
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    # Routes under /projects/{project_id} depend on this instead of
+    # get_current_user. Non-members get the same 404 as for a project that
+    # does not exist.
+    if not await project_access.is_member(db, project_id, current_user.id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Project not found")
+    # Some routes go on to stream a body; don't hold a connection meanwhile
+    await db.commit()
+    return current_user
+
+def get_file_user(
+    header_token: Annotated[str | None, Depends(optional_oauth2_scheme)],
+    token: str | None = None
+):
+    # Like get_current_user, with the token as ?token= when there is no
+    # Authorization header (as for the websocket)
+    if not header_token and not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"},
+        )
+    return get_current_user(header_token or token)
+
+def get_member_file(db: Session, file_id: int, user: schemas.User):
+    # Files of projects the user is not a member of are as missing as any
+    file = crud.get_file(db, file_id)
+    if file is None or not project_access.is_member_sync(db, file.project_id, user.id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    return file
+
+async def get_member_annotation(db: AsyncSession, annotation_id: int, user: schemas.User):
+    annotation = await async_crud.get_annotation(db, annotation_id)
+    if annotation is None or not await project_access.is_member(db, annotation.project_id, user.id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Annotation not found")
+    return annotation
+
 
-@app.get("/", include_in_schema=False)
+@router.get("/", include_in_schema=False)
 async def redirect_to_docs():
     return RedirectResponse(url="/docs")
 
-@app.post("/token", response_model=schemas.Token)
+@router.post("/token", response_model=schemas.Token)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_async_db)]
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -97,45 +251,72 @@ async def login_for_access_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token_expires = timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
+    claims = {"sub": user.username}
+    if JWT_USER_CLAIMS:
+        claims.update(uid=user.id, firstname=user.firstname, lastname=user.lastname)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data=claims, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.get("/user", response_model=schemas.User)
+@router.get("/user", response_model=schemas.User)
 def get_user(current_user: Annotated[schemas.User, Depends(get_current_user)]):
     return current_user
 
-@app.post("/user", response_model=schemas.User)
-def create_user(
+@router.post("/user", response_model=schemas.User)
+async def create_user(
     user: schemas.UserCreate,
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_async_db)]
 ):
-    if crud.get_user_auth(db, user.username):
+    if await async_crud.get_user_auth(db, user.username):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists")
-    user_orm = crud.create_user(db, user)
+    user.hashed_password = await password_hasher.hash(user.hashed_password)
+    user_orm = await async_crud.create_user(db, user)
+    user_cache.invalidate(user_orm.username)
     return user_orm
 
-@app.get("/projects", response_model=list[schemas.Project])
+@router.get("/stats", include_in_schema=False)
+def get_stats():
+    return {"user_cache": user_cache.stats(), "membership_cache": project_access.stats(), "websockets": rooms.stats()}
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    body = await run_in_threadpool(metrics.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+@router.get("/projects", response_model=list[schemas.Project])
 def get_projects(
     current_user: Annotated[schemas.User, Depends(get_current_user)],
-    db: Annotated[Session, Depends(get_db)]
+    response: Response,
+    db: Annotated[Session, Depends(get_db)],
+    limit: Annotated[int | None, Query(ge=1, le=1000)] = None,
+    after: str | None = None
 ):
-    projects = crud.get_projects(db, current_user)
+    # Keyset pagination on project id; the next page starts after X-Next-Cursor
+    projects = crud.get_projects(db, current_user, limit=limit, after=after)
+    if limit is not None and len(projects) == limit:
+        response.headers["X-Next-Cursor"] = projects[-1].id
     return projects
 
-@app.get("/projects/{project_id}", response_model=schemas.Project)
+@router.get("/projects/{project_id}", response_model=schemas.Project)
 def get_projects(
     current_user: Annotated[schemas.User, Depends(get_current_user)],
     project_id: str,
+    background_tasks: BackgroundTasks,
     db: Annotated[Session, Depends(get_db)]
 ):
+    # Opening a project by its id is how it gets shared: the first visit
+    # makes the user a member, later ones only read.
     project = crud.get_project(db, project_id)
-    if project.owner_id != current_user.id and current_user.id not in project.shared_users:
+    if project is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Project not found")
+    if not project_access.is_member_sync(db, project_id, current_user.id):
         crud.add_shared_user(db, current_user, project_id)
+        project_access.invalidate(project_id, current_user.id)
+        background_tasks.add_task(publish_membership, project_id, current_user.id)
     return project
 
-@app.post("/projects")
+@router.post("/projects")
 def create_project(
     current_user: Annotated[schemas.User, Depends(get_current_user)],
     project: schemas.ProjectCreate,
@@ -144,104 +325,367 @@ def create_project(
     project = crud.create_project(db, project=project, user=current_user)
     return project
 
-@app.post("/projects/{project_id}/files")
-def create_project_files(
-    current_user: Annotated[schemas.User, Depends(get_current_user)],
+@router.post("/projects/{project_id}/files")
+async def create_project_files(
+    current_user: Annotated[schemas.User, Depends(get_project_member)],
     project_id: str,
     file: UploadFile,
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_async_db)]
 ):
-    project = crud.get_project(db, project_id)
-    if project:
-        uid = str(uuid.uuid4())
-        try:
-            contents = file.file.read()
-            path = f'{uid}{os.path.splitext(file.filename)[1]}'
-            with open(os.path.join('data', path), 'wb') as f:
-                f.write(contents)
-        except Exception:
-            return {"message": "There was an error uploading the file"}
-        finally:
-            file.file.close()
-        
-        file_sch = schemas.FileCreate(path=path, filename=file.filename, project_id=project_id)
-        file_orm = crud.create_file(db, file_sch)
-        return file_orm
-    else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Project not found")
+    started = time.perf_counter()
+    try:
+        path, sha256, size = await run_in_threadpool(storage.store_stream, file.file)
+    except Exception:
+        return {"message": "There was an error uploading the file"}
+    finally:
+        await file.close()
+    # The body was already spooled by the form parser; this is the store
+    metrics.record_upload("file", size, time.perf_counter() - started)
+    
+    file_sch = schemas.FileCreate(path=path, filename=file.filename, project_id=project_id, sha256=sha256, size=size)
+    file_orm = await async_crud.create_file(db, file_sch)
+    await jobs.enqueue(db, "process_file", {"file_id": file_orm.id}, owner_id=current_user.id)
+    return file_orm
 
-@app.get("/projects/{project_id}/annotations/", response_model=list[schemas.Annotation])
-def get_annotations(
-    current_user: Annotated[schemas.User, Depends(get_current_user)], 
+async def get_owned_upload(db: AsyncSession, upload_id: str, user: schemas.User):
+    upload = await async_crud.get_upload(db, upload_id)
+    if not upload:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+    if upload.owner_id != user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+    # Give the connection back before streaming or assembling large bodies
+    await db.commit()
+    return upload
+
+async def upload_status(upload: models.Upload):
+    received = await run_in_threadpool(uploads.received_ranges, upload.id)
+    return schemas.UploadStatus(
+        id=upload.id,
+        project_id=upload.project_id,
+        filename=upload.filename,
+        size=upload.size,
+        part_size=uploads.PART_SIZE,
+        bytes_received=sum(end - start for start, end in received),
+        received=received,
+        missing=uploads.missing_ranges(received, upload.size),
+    )
+
+@router.post("/projects/{project_id}/uploads", response_model=schemas.Upload)
+async def create_upload(
+    current_user: Annotated[schemas.User, Depends(get_project_member)],
     project_id: str,
-    db: Annotated[Session, Depends(get_db)]
+    upload: schemas.UploadCreate,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
 ):
-    return crud.get_annotations(db, project_id)
+    if upload.size < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid size")
+    upload_orm = await async_crud.create_upload(db, upload, current_user, project_id)
+    return schemas.Upload(
+        id=upload_orm.id,
+        project_id=project_id,
+        filename=upload_orm.filename,
+        size=upload_orm.size,
+        part_size=uploads.PART_SIZE,
+    )
 
-@app.post("/projects/{project_id}/annotations/", response_model=schemas.Annotation)
-def create_annotations(
-    current_user: Annotated[schemas.User, Depends(get_current_user)], 
+@router.get("/uploads/{upload_id}", response_model=schemas.UploadStatus)
+async def get_upload(
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    upload_id: str,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    upload = await get_owned_upload(db, upload_id, current_user)
+    return await upload_status(upload)
+
+@router.put("/uploads/{upload_id}/parts", response_model=schemas.UploadStatus)
+async def upload_part(
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    upload_id: str,
+    offset: int,
+    request: Request,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    upload = await get_owned_upload(db, upload_id, current_user)
+    if offset < 0 or offset > upload.size:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid offset")
+    started = time.perf_counter()
+    try:
+        size = await uploads.write_part(upload.id, offset, upload.size, request.stream())
+    except uploads.PartOutOfRange:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Part extends past the end of the upload")
+    metrics.record_upload("part", size, time.perf_counter() - started)
+    await async_crud.touch_upload(db, upload)
+    return await upload_status(upload)
+
+@router.post("/uploads/{upload_id}/commit", response_model=schemas.File)
+async def commit_upload(
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    upload_id: str,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    upload = await get_owned_upload(db, upload_id, current_user)
+    received = await run_in_threadpool(uploads.received_ranges, upload.id)
+    missing = uploads.missing_ranges(received, upload.size)
+    if missing:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={"missing": missing})
+    path, sha256, size = await run_in_threadpool(uploads.assemble, upload.id)
+    file_sch = schemas.FileCreate(path=path, filename=upload.filename, project_id=upload.project_id, sha256=sha256, size=size)
+    file_orm = await async_crud.create_file(db, file_sch)
+    await async_crud.delete_upload(db, upload)
+    await run_in_threadpool(uploads.discard, upload.id)
+    await jobs.enqueue(db, "process_file", {"file_id": file_orm.id}, owner_id=current_user.id)
+    return file_orm
+
+@router.delete("/uploads/{upload_id}")
+async def delete_upload(
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    upload_id: str,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    upload = await get_owned_upload(db, upload_id, current_user)
+    await async_crud.delete_upload(db, upload)
+    await run_in_threadpool(uploads.discard, upload.id)
+    return None
+
+@router.get("/projects/{project_id}/annotations/", response_model=list[schemas.Annotation])
+async def get_annotations(
+    current_user: Annotated[schemas.User, Depends(get_project_member)], 
+    project_id: str,
+    request: Request,
+    db: Annotated[AsyncSession, Depends(get_async_db)],
+    since: Annotated[int | None, Query(ge=0)] = None,
+    after: str | None = None,
+    limit: Annotated[int | None, Query(ge=1, le=10000)] = None,
+    bbox: str | None = None,
+    lod: Annotated[int, Query(ge=0)] = 0
+):
+    # X-Revision is read before the rows, so passing it back as `since`
+    # never skips a change (at worst one is sent twice).
+    # The cursor is "<id>" for full listings and "<revision>:<id>" with `since`.
+    # `lod` > 0 sends simplified coordinates, see geometry.levels_of_detail.
+    try:
+        cursor = tuple(int(part) for part in after.split(':')) if after else None
+    except ValueError:
+        cursor = None
+    if after and (cursor is None or len(cursor) != (1 if since is None else 2)):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    box = get_bbox(bbox) if bbox else None
+    revision = await async_crud.get_annotation_revision(db, project_id)
+    annotations = await async_crud.get_annotations(db, project_id, since=since, after=cursor, limit=limit, bbox=box, lods=lod > 0)
+    headers = {"X-Revision": str(revision or 0)}
+    if limit is not None and len(annotations) == limit:
+        last = annotations[-1]
+        headers["X-Next-Cursor"] = str(last.id) if since is None else f"{last.revision}:{last.id}"
+    return await serialization.encoded_response(request, serialization.annotation_list(annotations, lod), headers)
+
+def get_bbox(value: str):
+    try:
+        return geometry.parse_bbox(value)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="bbox must be x0,y0,x1,y1")
+
+@router.get("/projects/{project_id}/annotations/viewport", response_model=schemas.AnnotationViewport)
+async def get_annotation_viewport(
+    current_user: Annotated[schemas.User, Depends(get_project_member)],
+    project_id: str,
+    bbox: str,
+    request: Request,
+    db: Annotated[AsyncSession, Depends(get_async_db)],
+    min_size: Annotated[float, Query(ge=0)] = 0,
+    cell: Annotated[float | None, Query(gt=0)] = None,
+    limit: Annotated[int | None, Query(ge=1, le=10000)] = None,
+    lod: Annotated[int, Query(ge=0)] = 0
+):
+    # Annotations smaller than `min_size` in both directions come back as
+    # per-cell counts instead of shapes; cells default to 1/64 of the view.
+    box = get_bbox(bbox)
+    if cell is None:
+        cell = max(box[2] - box[0], box[3] - box[1]) / 64 or 1.0
+    viewport = await async_crud.get_annotation_viewport(db, project_id, box, min_size=min_size, cell=cell, limit=limit, lods=lod > 0)
+    viewport['annotations'] = serialization.annotation_list(viewport['annotations'], lod)
+    return await serialization.encoded_response(request, viewport)
+
+@router.post("/projects/{project_id}/annotations/", response_model=schemas.Annotation)
+async def create_annotations(
+    current_user: Annotated[schemas.User, Depends(get_project_member)], 
     project_id: str,
     annotation: schemas.AnnotationCreate, 
-    db: Annotated[Session, Depends(get_db)]
+    background_tasks: BackgroundTasks,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
 ):
-    annotation = crud.create_annotation(db, annotation=annotation, user=current_user, project_id=project_id)
+    annotation = await async_crud.create_annotation(db, annotation=annotation, user=current_user, project_id=project_id)
+    if annotation is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Project not found")
+    background_tasks.add_task(publish_annotation, project_id, 'created', annotation.dict_with_lods())
     return annotation
 
-@app.put("/annotations/{annotation_id}", response_model=schemas.Annotation)
-def create_annotations(
+@router.post("/projects/{project_id}/annotations/batch", response_model=list[schemas.AnnotationOperationResult])
+async def batch_annotations(
+    current_user: Annotated[schemas.User, Depends(get_project_member)],
+    project_id: str,
+    batch: schemas.AnnotationBatch,
+    background_tasks: BackgroundTasks,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    results, changes = await async_crud.apply_annotation_batch(db, batch.operations, current_user, project_id)
+    if changes:
+        background_tasks.add_task(publish_annotation_batch, project_id, changes)
+    return results
+
+@router.put("/annotations/{annotation_id}", response_model=schemas.Annotation)
+async def create_annotations(
     current_user: Annotated[schemas.User, Depends(get_current_user)], 
-    annotation_id: str,
+    annotation_id: int,
     annotation: schemas.AnnotationCreate, 
-    db: Annotated[Session, Depends(get_db)]
+    background_tasks: BackgroundTasks,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
 ):
-    ann = crud.get_annotation(db, annotation_id)
-    if ann:
-        if ann.owner_id == current_user.id:
-            return crud.update_annotation(db, annotation_id, annotation)
-        else:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
-    else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Annotation not found")
+    ann = await get_member_annotation(db, annotation_id, current_user)
+    if ann.owner_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+    ann = await async_crud.update_annotation(db, annotation_id, annotation)
+    background_tasks.add_task(publish_annotation, ann.project_id, 'updated', ann.dict_with_lods())
+    return ann
 
-@app.get("/files/{file_id}")
+@router.get("/files/{file_id}")
 def get_file(
-    # current_user: Annotated[schemas.User, Depends(get_current_user)], 
-    file_id: str,
+    current_user: Annotated[schemas.User, Depends(get_file_user)],
+    file_id: int,
+    request: Request,
     db: Annotated[Session, Depends(get_db)]
 ):
-    file = crud.get_file(db, file_id)
-    if file:
-        file_path = os.path.join('data', file.path)
-        if os.path.exists(file_path):
-            return FileResponse(path=file_path, media_type='application/octet-stream', status_code=status.HTTP_200_OK)
-        else:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
-    else:
+    file = get_member_file(db, file_id, current_user)
+    file_path = storage.full_path(file.path)
+    if not os.path.exists(file_path):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    return file_response(request, file_path, file.filename, file.sha256)
+
+def get_processed_file(db: Session, file_id: int, user: schemas.User):
+    file = get_member_file(db, file_id, user)
+    if file.processing_status != "ready":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No thumbnail or tiles for this file")
+    return file
 
-@app.delete("/files/{file_id}")
+def derived_response(request: Request, file: models.File, path: str, name: str):
+    # Derived from an immutable blob, so immutable too when the blob is hashed
+    full_path = storage.full_path(path)
+    if not os.path.exists(full_path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Tile not found")
+    return file_response(request, full_path, f"{name}.{file.tile_format}", f"{file.sha256}-{name}" if file.sha256 else None)
+
+@router.get("/files/{file_id}/thumbnail")
+def get_file_thumbnail(
+    current_user: Annotated[schemas.User, Depends(get_file_user)],
+    file_id: int,
+    request: Request,
+    db: Annotated[Session, Depends(get_db)]
+):
+    file = get_processed_file(db, file_id, current_user)
+    return derived_response(request, file, imaging.thumbnail_path(file.path, file.tile_format), "thumbnail")
+
+@router.get("/files/{file_id}/tiles/{z}/{x}/{y}")
+def get_file_tile(
+    current_user: Annotated[schemas.User, Depends(get_file_user)],
+    file_id: int,
+    z: int,
+    x: int,
+    y: int,
+    request: Request,
+    db: Annotated[Session, Depends(get_db)]
+):
+    # z = 0 is the whole image in one tile; z = tile_levels - 1 is full size
+    file = get_processed_file(db, file_id, current_user)
+    if not 0 <= z < file.tile_levels or x < 0 or y < 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Tile not found")
+    return derived_response(request, file, imaging.tile_path(file.path, z, x, y, file.tile_format), f"{z}-{x}-{y}")
+
+@router.get("/projects/{project_id}/archive")
+async def get_project_archive(
+    current_user: Annotated[schemas.User, Depends(get_project_member)],
+    project_id: str,
+    files: bool = True,
+    gzip: bool = False
+):
+    # Streamed as it is read, see archive.py. File contents are mostly
+    # compressed already, so gzip only pays off without them.
+    body = archive.ProjectArchive(project_id, include_files=files)
+    filename = f"{project_id}.tar"
+    if gzip:
+        body, filename = archive.gzipped(body), filename + ".gz"
+    return StreamingResponse(
+        body,
+        media_type="application/gzip" if gzip else "application/x-tar",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@router.post("/projects/import", response_model=schemas.ProjectImport, status_code=status.HTTP_201_CREATED)
+async def import_project(
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    request: Request,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    # The body is an archive from GET /projects/{id}/archive, optionally
+    # gzipped; it becomes a new project owned by the caller.
+    try:
+        result, file_ids = await archive.import_archive(request.stream(), current_user)
+    except archive.ArchiveError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    metrics.record_upload("import", result["bytes"], result["seconds"])
+    for file_id in file_ids:
+        await jobs.enqueue(db, "process_file", {"file_id": file_id}, owner_id=current_user.id)
+    return result
+
+@router.post("/projects/{project_id}/exports", response_model=schemas.Job, status_code=status.HTTP_202_ACCEPTED)
+async def export_project(
+    current_user: Annotated[schemas.User, Depends(get_project_member)],
+    project_id: str,
+    db: Annotated[AsyncSession, Depends(get_async_db)],
+    files: bool = False
+):
+    # Runs as a job; poll GET /jobs/{id} and download GET /jobs/{id}/result
+    return await jobs.enqueue(db, "export_project", {"project_id": project_id, "files": files}, owner_id=current_user.id)
+
+async def get_owned_job(db: AsyncSession, job_id: int, user: schemas.User):
+    job = await async_crud.get_job(db, job_id)
+    if not job or job.owner_id != user.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+@router.get("/jobs/{job_id}", response_model=schemas.Job)
+async def get_job(
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    job_id: int,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    return await get_owned_job(db, job_id, current_user)
+
+@router.get("/jobs/{job_id}/result")
+async def get_job_result(
+    current_user: Annotated[schemas.User, Depends(get_current_user)],
+    job_id: int,
+    request: Request,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
+):
+    job = await get_owned_job(db, job_id, current_user)
+    path = (job.result or {}).get("path") if job.status == "done" else None
+    if not path or not os.path.exists(storage.full_path(path)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No result for this job")
+    return file_response(request, storage.full_path(path), f"{job.payload['project_id']}.tar.gz")
+
+@router.delete("/files/{file_id}")
 def delete_file(
     current_user: Annotated[schemas.User, Depends(get_current_user)], 
-    file_id: str,
+    file_id: int,
     db: Annotated[Session, Depends(get_db)]
 ):
-    file = crud.get_file(db, file_id)
-    if file:
-        if file.project.owner_id == current_user.id:
-            file_path = os.path.join('data', file.path)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                crud.delete_file(db, file)
-                return None
-            else:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
-        else:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can delete the files")
-    else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    file = get_member_file(db, file_id, current_user)
+    if file.project.owner_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only owner can delete the files")
+    # The row goes first; the blob is only removed once nothing references it
+    crud.delete_file(db, file)
+    return None
 
-# @app.get("/projects/{project_id}/data")
+# @router.get("/projects/{project_id}/data")
 # def get_project(
 #     # current_user: Annotated[schemas.User, Depends(get_current_user)],
 #     project_id: int,
@@ -254,51 +698,97 @@ def delete_file(
 #     else:
 #         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='File not found')
 
-@app.delete("/annotations/{annotation_id}")
-def delete_annotations(
+@router.delete("/annotations/{annotation_id}")
+async def delete_annotations(
     current_user: Annotated[schemas.User, Depends(get_current_user)], 
     annotation_id: int, 
-    db: Annotated[Session, Depends(get_db)]
+    background_tasks: BackgroundTasks,
+    db: Annotated[AsyncSession, Depends(get_async_db)]
 ):
-    annotation = crud.get_annotation(db, annotation_id)
-    if annotation:
-        if annotation.owner_id == current_user.id:
-            crud.delete_annotation(db, annotation)
-            return None
-        else:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
-    else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Annotation not found")
+    annotation = await get_member_annotation(db, annotation_id, current_user)
+    if annotation.owner_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+    await async_crud.delete_annotation(db, annotation)
+    background_tasks.add_task(publish_annotation, annotation.project_id, 'deleted', annotation.dict())
+    return None
 
-connected_websockets = set()
-latest_message = None
-@app.websocket("/projects/{project_id}/annotations")
-async def websocket_endpoint(websocket: WebSocket, project_id: str, db: Annotated[Session, Depends(get_db)]):
-    global latest_message
-    await websocket.accept()
-    connected_websockets.add(websocket)
-    if latest_message:
-        try:
-            await websocket.send_json(latest_message)
-        except WebSocketDisconnect:
-            print("Websocket disconnected")
+@router.websocket("/projects/{project_id}/annotations")
+async def websocket_endpoint(
+    websocket: WebSocket,
+    project_id: str,
+    db: Annotated[AsyncSession, Depends(get_async_db)],
+    token: str | None = None,
+    lod: Annotated[int, Query(ge=0)] = 0
+):
+    # Browsers cannot set headers on websockets, so the access token comes
+    # as ?token=. Without membership the handshake is refused. With `lod`,
+    # the socket gets simplified coordinates like the REST reads.
+    try:
+        user = await run_in_threadpool(get_current_user, token) if token else None
+    except HTTPException:
+        user = None
+    if user is None or not await project_access.is_member(db, project_id, user.id):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    # Clients asking for the aat.msgpack subprotocol get binary MessagePack frames
+    subprotocol = next((
+        name for name in websocket.scope.get('subprotocols', [])
+        if name in serialization.SUBPROTOCOLS and serialization.msgpack is not None
+    ), None)
+    media_type = serialization.SUBPROTOCOLS.get(subprotocol, serialization.JSON)
+    await websocket.accept(subprotocol=subprotocol)
+
+    async def load():
+        revision = await async_crud.get_annotation_revision(db, project_id)
+        annotations = await async_crud.get_annotations(db, project_id=project_id, lods=True)
+        # The socket outlives the read; don't keep a pooled connection with it
+        await db.commit()
+        return revision or 0, [annotation.dict_with_lods() for annotation in annotations]
+
+    try:
+        room = await rooms.join(project_id, websocket, load, media_type, lod)
+    except WebSocketDisconnect:
+        return
     try:
         while True:
-            message = await websocket.receive_text()
-            print(message)
-            annotations_orm = crud.get_annotations(db, project_id=project_id)
-            annotations = [annotation.dict() for annotation in annotations_orm]
-            latest_message = annotations
-            for ws in connected_websockets:
-                try:
-                    print(ws)
-                    await ws.send_json(annotations)
-                except WebSocketDisconnect:
-                    print("Websocket disconnected")
-                    connected_websockets.remove(ws)
-            # await websocket.send_json(annotations)
-            # await asyncio.sleep(5)
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(message.get('code', 1000))
+            data = message['bytes'] if message.get('bytes') is not None else message.get('text')
+            current = room.is_current(websocket, data, media_type)
+            metrics.sample_log(
+                "websocket_message", project_id=project_id, user_id=user.id, size=len(data or ''),
+                current=current, version=room.version,
+            )
+            if not current:
+                room.resync(websocket)
     except WebSocketDisconnect:
-        print("Websocket disconnected")
+        pass
     finally:
-        connected_websockets.remove(websocket)
\ No newline at end of file
+        rooms.leave(room, websocket)
+
+
+def create_app():
+    # uvicorn aat_backend.main:app, or --factory aat_backend.main:create_app
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Allows all origins
+        allow_credentials=True,
+        allow_methods=["*"],  # Allows all methods
+        allow_headers=["*"],  # Allows all headers
+        expose_headers=["X-Next-Cursor", "X-Revision"],
+    )
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.add_exception_handler(PoolSaturated, password_pool_saturated)
+    app.add_exception_handler(RequestValidationError, validation_error)
+    app.include_router(router)
+    return app
+
+def __getattr__(name):
+    # `aat_backend.main:app` is built on first access rather than at import
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,322 @@
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+
+# Counters, gauges and histograms rendered in the Prometheus text format on
+# /metrics. Every worker process keeps its own; with AAT_METRICS_DIR set,
+# each also writes a snapshot there every few seconds and /metrics adds up
+# the fresh snapshots of all workers, so a scrape that lands on any worker
+# sees the whole host. Without it, /metrics only covers the worker that
+# answers. The counters of a worker that stops leave the totals, which
+# Prometheus reads as a counter reset.
+
+METRICS_DIR = os.environ.get("AAT_METRICS_DIR")
+SNAPSHOT_INTERVAL = 5
+# Fraction of routine events (requests, websocket messages) that are logged;
+# slow requests always are.
+LOG_SAMPLE_RATE = float(os.environ.get("AAT_LOG_SAMPLE_RATE", 0.01))
+SLOW_REQUEST_SECONDS = float(os.environ.get("AAT_SLOW_REQUEST_SECONDS", 1))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+THROUGHPUT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+log = logging.getLogger("aat_backend")
+if not log.handlers:
+    # uvicorn only configures its own loggers
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    log.addHandler(_handler)
+    log.setLevel(os.environ.get("AAT_LOG_LEVEL", "INFO"))
+    log.propagate = False
+
+registry = []
+
+
+def _key(metric, labels: dict):
+    return tuple(str(labels.get(name, "")) for name in metric.labelnames)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        # Sync routes record from threadpool threads
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _key(self, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[_key(self, labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = _key(self, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        # Stored per bucket, plus sum and count; made cumulative on render
+        key = _key(self, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+
+HTTP_REQUESTS = Counter("aat_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("aat_http_request_duration_seconds", "Time from request to the end of the response body", ("method", "route"))
+DB_QUERIES_PER_REQUEST = Histogram("aat_db_queries_per_request", "SQL statements run per HTTP request", ("method", "route"), COUNT_BUCKETS)
+DB_TIME_PER_REQUEST = Histogram("aat_db_seconds_per_request", "Time spent in SQL statements per HTTP request", ("method", "route"))
+DB_QUERIES = Counter("aat_db_queries_total", "SQL statements run, in requests or not", ("engine",))
+DB_QUERY_LATENCY = Histogram("aat_db_query_duration_seconds", "Duration of single SQL statements", ("engine",))
+WS_CONNECTIONS = Gauge("aat_websocket_connections", "Open annotation websockets")
+WS_ROOMS = Gauge("aat_websocket_rooms", "Projects with at least one open websocket")
+WS_FANOUT = Histogram("aat_websocket_broadcast_seconds", "Time to encode a broadcast and queue it for every socket of a room")
+WS_RECIPIENTS = Histogram("aat_websocket_broadcast_recipients", "Sockets a broadcast was queued for", (), (1, 2, 5, 10, 20, 50, 100, 500, 1000))
+WS_SEND_LATENCY = Histogram("aat_websocket_send_seconds", "Time from queueing a message for a socket to the end of its send")
+WS_COALESCED = Counter("aat_websocket_coalesced_total", "Changes merged into a later change of the same annotation before broadcast")
+WS_RESYNCS = Counter("aat_websocket_slow_resyncs_total", "Sockets that fell behind and were sent a snapshot instead of their backlog")
+WS_DROPPED = Counter("aat_websocket_dropped_total", "Sockets closed because a send timed out")
+BCRYPT_LATENCY = Histogram("aat_bcrypt_seconds", "Password hash or verify, including the wait for a pool worker", ("operation",), (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+BCRYPT_REJECTED = Counter("aat_bcrypt_rejected_total", "Logins refused because the hashing pool was saturated")
+UPLOAD_BYTES = Counter("aat_upload_bytes_total", "Bytes received in uploads", ("kind",))
+UPLOAD_THROUGHPUT = Histogram("aat_upload_mb_per_second", "Throughput of single uploads", ("kind",), THROUGHPUT_BUCKETS)
+
+
+def record_upload(kind: str, size: int, elapsed: float):
+    UPLOAD_BYTES.inc(size, kind=kind)
+    if elapsed > 0 and size:
+        UPLOAD_THROUGHPUT.observe(size / 1e6 / elapsed, kind=kind)
+
+
+def sample_log(event_name: str, always: bool = False, **fields):
+    # One JSON object per line, for a fraction of the calls
+    if always or (LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE):
+        if log.isEnabledFor(logging.INFO):
+            log.info(json.dumps({"event": event_name, **fields}, default=str))
+
+
+# SQL statements are counted on the engines and attributed to the request
+# running in the current context; run_in_threadpool copies the context, so
+# sync routes are covered too.
+_request_queries: ContextVar[list | None] = ContextVar("aat_request_queries", default=None)
+
+
+def instrument_engine(engine, name: str):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("aat_query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["aat_query_started"].pop()
+        elapsed = time.perf_counter() - started
+        DB_QUERIES.inc(engine=name)
+        DB_QUERY_LATENCY.observe(elapsed, engine=name)
+        queries = _request_queries.get()
+        if queries is not None:
+            queries[0] += 1
+            queries[1] += elapsed
+
+    def handle_error(context):
+        started = context.connection.info.get("aat_query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+class MetricsMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware, which would buffer
+    # streaming responses. Routes are labelled by their path template;
+    # requests that match none share one label.
+    def __init__(self, app):
+        self.app = app
+        self.templates = {}
+
+    def _route(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        template = self.templates.get(endpoint)
+        if template is None:
+            router = scope["app"].router
+            template = next((route.path for route in router.routes if getattr(route, "endpoint", None) is endpoint), "unmatched")
+            self.templates[endpoint] = template
+        return template
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        queries = [0, 0.0]
+        token = _request_queries.set(queries)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_queries.reset(token)
+            elapsed = time.perf_counter() - started
+            method, route = scope["method"], self._route(scope)
+            HTTP_REQUESTS.inc(method=method, route=route, status=status_code)
+            HTTP_LATENCY.observe(elapsed, method=method, route=route)
+            DB_QUERIES_PER_REQUEST.observe(queries[0], method=method, route=route)
+            DB_TIME_PER_REQUEST.observe(queries[1], method=method, route=route)
+            sample_log(
+                "request",
+                always=elapsed >= SLOW_REQUEST_SECONDS,
+                method=method,
+                route=route,
+                status=status_code,
+                seconds=round(elapsed, 6),
+                queries=queries[0],
+                query_seconds=round(queries[1], 6),
+            )
+
+
+def snapshot():
+    return {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in registry}
+
+
+def _snapshot_path(pid: int):
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+def write_snapshot():
+    # Blocking; the other workers read it for their /metrics
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _snapshot_path(os.getpid())
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def remove_snapshot():
+    try:
+        os.remove(_snapshot_path(os.getpid()))
+    except (FileNotFoundError, TypeError):
+        pass
+
+
+def _other_snapshots():
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return []
+    own, fresh_after = f"{os.getpid()}.json", time.time() - 3 * SNAPSHOT_INTERVAL
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        path = os.path.join(METRICS_DIR, name)
+        if not name.endswith(".json") or name == own:
+            continue
+        try:
+            if os.path.getmtime(path) < fresh_after:
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(metric, values: dict, entries: list):
+    for key, value in entries:
+        key = tuple(key)
+        current = values.get(key)
+        if current is None:
+            values[key] = value
+        elif isinstance(value, list):
+            values[key] = [a + b for a, b in zip(current, value)]
+        else:
+            values[key] = current + value
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra: str = ""):
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    # Blocking when AAT_METRICS_DIR is set (reads the other snapshots)
+    others = _other_snapshots()
+    lines = []
+    for metric in registry:
+        values = metric.snapshot()
+        for other in others:
+            _merge(metric, values, other.get(metric.name, []))
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        if not metric.labelnames and not values and metric.kind != "histogram":
+            values = {(): 0}
+        for key, value in sorted(values.items()):
+            if metric.kind != "histogram":
+                lines.append(f"{metric.name}{_labels(metric.labelnames, key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ("+Inf",), value):
+                cumulative += count
+                le = 'le="' + (bound if bound == "+Inf" else _number(float(bound))) + '"'
+                lines.append(f"{metric.name}_bucket{_labels(metric.labelnames, key, le)} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(metric.labelnames, key)} {_number(value[-2])}")
+            lines.append(f"{metric.name}_count{_labels(metric.labelnames, key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
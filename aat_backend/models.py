@@ -1,11 +1,12 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, JSON, Table
-from sqlalchemy.orm import relationship
+from sqlalchemy import DDL, BigInteger, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, String, JSON, Table, Text, event, false
+from sqlalchemy.orm import deferred, relationship
 
+from . import geometry
 from .database import Base
 
 project_user = Table('project_user', Base.metadata,
     Column('project_id', ForeignKey('projects.id'), primary_key=True),
-    Column('user_id', ForeignKey('users.id'), primary_key=True)
+    Column('user_id', ForeignKey('users.id'), primary_key=True, index=True)
 )
 
 
@@ -36,7 +37,9 @@ class Project(Base):
 
     id = Column(String, primary_key=True)
     name = Column(String)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    # Last revision handed out to one of the project's annotations
+    annotation_revision = Column(BigInteger, nullable=False, default=0, server_default='0')
 
     owner = relationship("User", back_populates="projects")
     files = relationship("File", back_populates="project")
@@ -52,26 +55,125 @@ class Annotation(Base):
     coordinates = Column(JSON)
     color = Column(String)
     project_id = Column(String, ForeignKey("projects.id"))
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    revision = Column(BigInteger, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime)
+    deleted = Column(Boolean, nullable=False, default=False, server_default=false())
+    # Bounding box of `coordinates`, see geometry.bounding_box
+    min_x = Column(Float)
+    min_y = Column(Float)
+    max_x = Column(Float)
+    max_y = Column(Float)
+    # Simplified copies of `coordinates`, see geometry.levels_of_detail; only
+    # loaded when a reader asks for a level of detail
+    lods = deferred(Column(JSON))
 
     owner = relationship("User", back_populates="annotations")
     # project = relationship("Project", back_populates="annotations")
 
-    def dict(self):
+    # Also serves plain project_id lookups, so project_id has no index of its own
+    __table_args__ = (
+        Index('ix_annotations_project_id_id', 'project_id', 'id'),
+        Index('ix_annotations_project_id_revision', 'project_id', 'revision'),
+    )
+
+    def dict(self, lod: int = 0):
         return {
             'id': self.id,
             'note': self.note,
-            'coordinates': self.coordinates,
-            'color': self.color
+            'coordinates': geometry.at_level_of_detail(self.coordinates, self.lods, lod) if lod else self.coordinates,
+            'color': self.color,
+            'revision': self.revision,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'deleted': self.deleted,
         }
 
+    def dict_with_lods(self):
+        # For the websocket rooms, which serve every level from memory
+        return {**self.dict(), 'lods': self.lods}
+
+
+# On SQLite, live annotation bounding boxes are mirrored into an R*Tree by
+# triggers. It lives outside Base.metadata because it is a virtual table.
+annotations_rtree = Table('annotations_rtree', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('min_x', Float),
+    Column('max_x', Float),
+    Column('min_y', Float),
+    Column('max_y', Float),
+)
+
+ANNOTATIONS_RTREE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS annotations_rtree USING rtree(id, min_x, max_x, min_y, max_y)",
+    "CREATE TRIGGER IF NOT EXISTS annotations_rtree_insert AFTER INSERT ON annotations "
+    "WHEN NEW.min_x IS NOT NULL AND NOT NEW.deleted BEGIN "
+    "INSERT OR REPLACE INTO annotations_rtree VALUES (NEW.id, NEW.min_x, NEW.max_x, NEW.min_y, NEW.max_y); END",
+    "CREATE TRIGGER IF NOT EXISTS annotations_rtree_update AFTER UPDATE ON annotations BEGIN "
+    "DELETE FROM annotations_rtree WHERE id = OLD.id; "
+    "INSERT INTO annotations_rtree SELECT NEW.id, NEW.min_x, NEW.max_x, NEW.min_y, NEW.max_y "
+    "WHERE NEW.min_x IS NOT NULL AND NOT NEW.deleted; END",
+    "CREATE TRIGGER IF NOT EXISTS annotations_rtree_delete AFTER DELETE ON annotations BEGIN "
+    "DELETE FROM annotations_rtree WHERE id = OLD.id; END",
+]
+
+for statement in ANNOTATIONS_RTREE_DDL:
+    event.listen(Annotation.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
 
 class File(Base):
     __tablename__ = "files"
 
     id = Column(Integer, primary_key=True)
-    path = Column(String)
+    path = Column(String, index=True)
     filename = Column(String)
-    project_id = Column(String, ForeignKey("projects.id"))
+    sha256 = Column(String)
+    size = Column(BigInteger)
+    project_id = Column(String, ForeignKey("projects.id"), index=True)
+    # Thumbnail and tile pyramid, see imaging.py; status is None until
+    # processed, then "ready" or "failed" (not an image)
+    processing_status = Column(String)
+    width = Column(Integer)
+    height = Column(Integer)
+    tile_levels = Column(Integer)
+    tile_size = Column(Integer)
+    tile_format = Column(String)
 
     project = relationship("Project", back_populates="files")
+
+
+class Upload(Base):
+    __tablename__ = "uploads"
+
+    id = Column(String, primary_key=True)
+    filename = Column(String)
+    size = Column(BigInteger)
+    project_id = Column(String, ForeignKey("projects.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+
+
+class Job(Base):
+    # Durable work queue, see jobs.py. A job is claimed by setting it to
+    # "running" with a lease that its worker renews; queued jobs wait for
+    # run_at, which also carries the retry backoff.
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)
+    payload = Column(JSON)
+    status = Column(String)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer)
+    run_at = Column(DateTime)
+    locked_by = Column(String)
+    locked_until = Column(DateTime)
+    created_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    result = Column(JSON)
+    error = Column(Text)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+
+    __table_args__ = (
+        Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
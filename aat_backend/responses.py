@@ -0,0 +1,148 @@
+import mimetypes
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from .storage import CHUNK_SIZE
+
+
+# Beyond this many ranges in one request we just send the whole file.
+MAX_RANGES = 32
+
+
+def parse_range(header: str, size: int):
+    # Returns a list of inclusive (start, end) pairs, [] when none of the
+    # ranges can be satisfied, or None when the header should be ignored.
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if start > end and start < size:
+                    return None
+            else:
+                if not last:
+                    return None
+                start, end = max(size - int(last), 0), size - 1
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges if len(ranges) <= MAX_RANGES else None
+
+
+def iter_file(path: str, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def iter_multipart(path: str, parts: list):
+    for header, start, end in parts:
+        yield header
+        yield from iter_file(path, start, end)
+        yield b"\r\n"
+
+
+def etag_matches(header: str, etag: str):
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def not_modified_since(header: str, mtime: float):
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def file_response(request: Request, path: str, filename: str, sha256: str | None = None):
+    stat = os.stat(path)
+    size = stat.st_size
+    # Content-addressed blobs never change, so their hash is the validator and
+    # they can be cached for good, by the browser only: every file is behind
+    # a membership check. Legacy files fall back to size + mtime.
+    if sha256:
+        etag = f'"{sha256}"'
+        cache_control = "private, max-age=31536000, immutable"
+    else:
+        etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+        cache_control = "private, no-cache"
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if (if_none_match and etag_matches(if_none_match, etag)) or (
+        not if_none_match and if_modified_since and not_modified_since(if_modified_since, stat.st_mtime)
+    ):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() not in (etag, headers["Last-Modified"]):
+        range_header = None
+    ranges = parse_range(range_header, size) if range_header else None
+
+    if ranges is None:
+        return FileResponse(path, media_type=media_type, headers=headers)
+    if not ranges:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={**headers, "Content-Range": f"bytes */{size}"},
+        )
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+        return StreamingResponse(
+            iter_file(path, start, end),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type=media_type,
+            headers=headers,
+        )
+
+    boundary = uuid.uuid4().hex
+    parts = [
+        (
+            f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n".encode(),
+            start,
+            end,
+        )
+        for start, end in ranges
+    ]
+    closing = f"--{boundary}--\r\n".encode()
+    length = sum(len(header) + end - start + 1 + 2 for header, start, end in parts) + len(closing)
+    headers["Content-Length"] = str(length)
+
+    def body():
+        yield from iter_multipart(path, parts)
+        yield closing
+
+    return StreamingResponse(
+        body(),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+        headers=headers,
+    )
@@ -0,0 +1,382 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import deque
+
+from fastapi import WebSocket, WebSocketDisconnect, status
+
+from . import geometry, metrics, serialization
+
+
+# Changes to a room within this window go out as one message, with repeated
+# changes to one annotation (a dragged vertex) merged into the last; 0 sends
+# each change right away.
+BROADCAST_WINDOW = float(os.environ.get("AAT_WS_BROADCAST_WINDOW_MS", 25)) / 1000
+# Messages waiting for one socket; a socket that falls further behind gets
+# the current snapshot instead of the backlog.
+SEND_QUEUE_SIZE = int(os.environ.get("AAT_WS_SEND_QUEUE_SIZE", 64))
+# A socket that cannot take a single message in this time is closed.
+SEND_TIMEOUT = float(os.environ.get("AAT_WS_SEND_TIMEOUT", 10))
+
+
+async def send_message(websocket: WebSocket, data: str | bytes):
+    if isinstance(data, bytes):
+        await websocket.send_bytes(data)
+    else:
+        await websocket.send_text(data)
+
+
+class Snapshot:
+    # Queued in place of a message: the room's state is encoded when it is
+    # sent, so it covers every change made while it waited.
+    def __init__(self, message_type: str):
+        self.message_type = message_type
+
+
+class Client:
+    # One socket of a room, fed by its own task so that broadcasting only
+    # queues and a slow socket holds up nobody but itself.
+    def __init__(self, room: 'Room', websocket: WebSocket, media_type: str, lod: int = 0, queue_size: int = SEND_QUEUE_SIZE):
+        self.room = room
+        self.websocket = websocket
+        self.media_type = media_type
+        self.lod = lod
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        # Versions of the last messages sent to this socket. The changes of
+        # the broadcast window are applied to the room before they are sent,
+        # so a client is judged against these rather than the room's version.
+        self.sent_versions = deque(maxlen=queue_size + 1)
+        self.snapshot_pending = False
+        self.task = asyncio.create_task(self.run())
+
+    def push(self, data: str | bytes, version: int):
+        if self.snapshot_pending:
+            # The snapshot it is waiting for will include this change
+            return
+        try:
+            self.queue.put_nowait((time.perf_counter(), data, version))
+        except asyncio.QueueFull:
+            metrics.WS_RESYNCS.inc()
+            metrics.sample_log("websocket_resync", always=True, project_id=self.room.project_id, queued=self.queue.qsize())
+            self.snapshot('resync')
+
+    def snapshot(self, message_type: str = 'resync'):
+        # Replaces whatever is queued, which the snapshot supersedes
+        if self.snapshot_pending:
+            return
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.snapshot_pending = True
+        self.queue.put_nowait((time.perf_counter(), Snapshot(message_type), None))
+
+    async def run(self):
+        while True:
+            queued_at, data, version = await self.queue.get()
+            if isinstance(data, Snapshot):
+                self.snapshot_pending = False
+                data, version = self.room.encoded_snapshot(data.message_type, self.media_type, self.lod), self.room.version
+            try:
+                await asyncio.wait_for(send_message(self.websocket, data), SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                metrics.WS_DROPPED.inc()
+                metrics.sample_log("websocket_dropped", always=True, project_id=self.room.project_id)
+                self.room.remove(self.websocket)
+                await self._close()
+                return
+            except (WebSocketDisconnect, RuntimeError, OSError):
+                self.room.remove(self.websocket)
+                return
+            self.sent_versions.append(version)
+            metrics.WS_SEND_LATENCY.observe(time.perf_counter() - queued_at)
+
+    def is_current(self, version):
+        # Any version this socket was sent: the messages after it are on
+        # their way, in order
+        return version in self.sent_versions
+
+    async def _close(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER), SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def stop(self):
+        self.task.cancel()
+
+
+class Room:
+    # The room's version is the project's annotation revision, so it means
+    # the same thing on every worker and to incremental REST readers.
+    def __init__(self, project_id: str, annotations: list[dict], revision: int, window: float = BROADCAST_WINDOW):
+        self.project_id = project_id
+        self.clients: dict[WebSocket, Client] = {}
+        self.version = revision
+        self.loaded_revision = revision
+        self.annotations = {}
+        # Levels of detail of the annotations that have some, kept out of
+        # the annotations themselves so they are never sent
+        self.lods: dict[int, dict] = {}
+        for annotation in annotations:
+            self._store(annotation)
+        self.tombstones: dict[int, int] = {}
+        # Encoded snapshots, reused by every joiner until the next change
+        self.encoded: dict[tuple[str, str, int], str | bytes] = {}
+        # Changes applied but not broadcast yet, by annotation id
+        self.window = window
+        self.pending: dict[int, dict] = {}
+        self.flush_handle: asyncio.TimerHandle | None = None
+
+    def _store(self, annotation: dict):
+        if 'lods' in annotation:
+            annotation = dict(annotation)
+            lods = annotation.pop('lods')
+        else:
+            lods = None
+        if lods:
+            self.lods[annotation['id']] = lods
+        else:
+            self.lods.pop(annotation['id'], None)
+        self.annotations[annotation['id']] = annotation
+        return annotation
+
+    def _at_lod(self, annotation: dict, lod: int):
+        lods = self.lods.get(annotation['id']) if lod else None
+        if not lods:
+            return annotation
+        return {**annotation, 'coordinates': geometry.at_level_of_detail(annotation['coordinates'], lods, lod)}
+
+    def at_lod(self, message: dict, lod: int):
+        # The message with the coordinates a socket at `lod` gets
+        if not lod or not self.lods:
+            return message
+        if 'annotations' in message:
+            return {**message, 'annotations': [self._at_lod(annotation, lod) for annotation in message['annotations']]}
+        if 'changes' in message:
+            return {**message, 'changes': [
+                {**change, 'annotation': self._at_lod(change['annotation'], lod)} for change in message['changes']
+            ]}
+        return {**message, 'annotation': self._at_lod(message['annotation'], lod)}
+
+    def snapshot(self, message_type: str = 'snapshot', lod: int = 0):
+        return self.at_lod({
+            'type': message_type,
+            'version': self.version,
+            'annotations': list(self.annotations.values()),
+        }, lod)
+
+    def encoded_snapshot(self, message_type: str = 'snapshot', media_type: str = serialization.JSON, lod: int = 0):
+        key = message_type, media_type, lod
+        if key not in self.encoded:
+            self.encoded[key] = serialization.wire(self.snapshot(message_type, lod), media_type)
+        return self.encoded[key]
+
+    def _change(self, action: str, annotation: dict):
+        # Events may arrive after the snapshot that already contains them,
+        # twice, or out of order between workers; anything not newer than
+        # what the room holds for that annotation is skipped.
+        annotation_id, revision = annotation['id'], annotation['revision']
+        current = self.annotations.get(annotation_id)
+        known = current['revision'] if current else self.tombstones.get(annotation_id, self.loaded_revision)
+        # A batch can update and then delete one annotation under one revision.
+        # Returns the annotation as it is broadcast, or None.
+        if revision < known or (revision == known and not (action == 'deleted' and current)):
+            return None
+        if action == 'deleted':
+            self.annotations.pop(annotation_id, None)
+            self.lods.pop(annotation_id, None)
+            self.tombstones[annotation_id] = revision
+            annotation = {key: value for key, value in annotation.items() if key != 'lods'}
+        else:
+            annotation = self._store(annotation)
+            self.tombstones.pop(annotation_id, None)
+        self.version = max(self.version, revision)
+        self.encoded.clear()
+        return annotation
+
+    def apply(self, action: str, annotation: dict):
+        annotation = self._change(action, annotation)
+        if annotation is not None:
+            self._queue(action, annotation)
+            self._schedule()
+
+    def apply_batch(self, changes: list[dict]):
+        for change in changes:
+            annotation = self._change(change['action'], change['annotation'])
+            if annotation is not None:
+                self._queue(change['action'], annotation)
+        self._schedule()
+
+    def _queue(self, action: str, annotation: dict):
+        previous = self.pending.pop(annotation['id'], None)
+        if previous is not None:
+            metrics.WS_COALESCED.inc()
+            if previous['action'] == 'created' and action == 'updated':
+                action = 'created'
+        self.pending[annotation['id']] = {'action': action, 'annotation': annotation}
+
+    def _schedule(self):
+        if not self.pending or self.flush_handle is not None:
+            return
+        if self.window <= 0:
+            self.flush()
+        else:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        # One change keeps its own message type, several make a batch
+        self.flush_handle = None
+        changes = list(self.pending.values())
+        self.pending.clear()
+        if len(changes) == 1:
+            message = {'type': changes[0]['action'], 'version': self.version, 'annotation': changes[0]['annotation']}
+        elif changes:
+            message = {'type': 'batch', 'version': self.version, 'changes': changes}
+        else:
+            return
+        self.broadcast(message)
+
+    def is_current(self, websocket: WebSocket, message: str | bytes, media_type: str = serialization.JSON):
+        # Clients echo the last version they applied; anything else
+        # (including legacy plain-text pings) gets a resync.
+        try:
+            data = serialization.decode(message, media_type)
+        except Exception:
+            return False
+        client = self.clients.get(websocket)
+        return isinstance(data, dict) and client is not None and client.is_current(data.get('version'))
+
+    def broadcast(self, message: dict):
+        # Encoded once per media type and level of detail, whatever the
+        # number of sockets, and queued for each; the sends happen in the
+        # clients' tasks
+        started = time.perf_counter()
+        encoded = {}
+        for client in list(self.clients.values()):
+            key = client.media_type, client.lod
+            if key not in encoded:
+                encoded[key] = serialization.wire(self.at_lod(message, client.lod), client.media_type)
+            client.push(encoded[key], message['version'])
+        elapsed = time.perf_counter() - started
+        metrics.WS_FANOUT.observe(elapsed)
+        metrics.WS_RECIPIENTS.observe(len(self.clients))
+        metrics.sample_log(
+            "broadcast", project_id=self.project_id, type=message['type'], version=self.version,
+            sockets=len(self.clients), seconds=round(elapsed, 6),
+        )
+
+    def resync(self, websocket: WebSocket):
+        client = self.clients.get(websocket)
+        if client is not None:
+            client.snapshot('resync')
+
+    def add(self, websocket: WebSocket, media_type: str, lod: int = 0):
+        client = self.clients[websocket] = Client(self, websocket, media_type, lod)
+        metrics.WS_CONNECTIONS.inc()
+        client.snapshot('snapshot')
+
+    def remove(self, websocket: WebSocket):
+        client = self.clients.pop(websocket, None)
+        if client is not None:
+            metrics.WS_CONNECTIONS.dec()
+        return client
+
+    def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for websocket in list(self.clients):
+            self.remove(websocket).stop()
+
+
+class Loading:
+    # A room whose snapshot is being read. The snapshot may miss changes
+    # committed while it is read, so they are kept to be applied on top.
+    def __init__(self):
+        self.changes: list[dict] = []
+        self.ready = asyncio.Event()
+
+
+class RoomManager:
+    # One room per project. Late joiners get the room's in-memory snapshot,
+    # everyone else only receives the annotation that changed.
+    def __init__(self):
+        self.rooms: dict[str, Room] = {}
+        self.loading: dict[str, Loading] = {}
+
+    async def join(self, project_id: str, websocket: WebSocket, load, media_type: str = serialization.JSON, lod: int = 0):
+        while (room := self.rooms.get(project_id)) is None:
+            loading = self.loading.get(project_id)
+            if loading is None:
+                room = await self._open(project_id, load)
+                break
+            # Another socket is reading the snapshot; if that fails, try again
+            await loading.ready.wait()
+        # The snapshot is the first thing queued for the socket
+        room.add(websocket, media_type, lod)
+        return room
+
+    async def _open(self, project_id: str, load):
+        loading = self.loading[project_id] = Loading()
+        try:
+            revision, annotations = await load()
+            room = Room(project_id, annotations, revision)
+            self.rooms[project_id] = room
+            metrics.WS_ROOMS.set(len(self.rooms))
+            # What was published while loading; the revisions skip the
+            # changes the snapshot already has
+            room.apply_batch(loading.changes)
+            return room
+        finally:
+            del self.loading[project_id]
+            loading.ready.set()
+
+    def leave(self, room: Room, websocket: WebSocket):
+        client = room.remove(websocket)
+        if client is not None:
+            client.stop()
+        if not room.clients and self.rooms.get(room.project_id) is room:
+            del self.rooms[room.project_id]
+            room.close()
+            metrics.WS_ROOMS.set(len(self.rooms))
+
+    def close(self):
+        # When the app stops; the sockets are going away with it
+        for room in self.rooms.values():
+            room.close()
+        self.rooms.clear()
+        metrics.WS_ROOMS.set(0)
+
+    def stats(self, top: int = 20):
+        # The busiest rooms; per-project series would be unbounded in /metrics.
+        # /stats is public and knowing a project id is enough to join it, so
+        # rooms are named by a hash of the id instead.
+        busiest = sorted(self.rooms.values(), key=lambda room: len(room.clients), reverse=True)[:top]
+        return {
+            'rooms': len(self.rooms),
+            'connections': sum(len(room.clients) for room in self.rooms.values()),
+            'busiest': [
+                {
+                    'project': hashlib.sha256(room.project_id.encode()).hexdigest()[:16], 'sockets': len(room.clients), 'version': room.version,
+                    'annotations': len(room.annotations), 'pending': len(room.pending),
+                    'queued': sum(client.queue.qsize() for client in room.clients.values()),
+                }
+                for room in busiest
+            ],
+        }
+
+    async def publish(self, project_id: str, action: str, annotation: dict):
+        room = self.rooms.get(project_id)
+        if room is None:
+            if project_id in self.loading:
+                self.loading[project_id].changes.append({'action': action, 'annotation': annotation})
+            # Otherwise nobody is listening; the next joiner loads a fresh snapshot.
+            return
+        room.apply(action, annotation)
+
+    async def publish_batch(self, project_id: str, changes: list[dict]):
+        room = self.rooms.get(project_id)
+        if room is not None:
+            room.apply_batch(changes)
+        elif project_id in self.loading:
+            self.loading[project_id].changes.extend(changes)
@@ -1,4 +1,9 @@
-from pydantic import BaseModel
+from datetime import datetime
+from typing import Literal
+
+from pydantic import BaseModel, validator
+
+from . import geometry
 
 
 class Token(BaseModel):
@@ -42,15 +47,45 @@ class FileBase(BaseModel):
 
 class FileCreate(FileBase):
     project_id: str
+    sha256: str | None = None
+    size: int | None = None
 
 
 class File(FileBase):
     id: int
+    sha256: str | None = None
+    size: int | None = None
+    processing_status: str | None = None
+    width: int | None = None
+    height: int | None = None
+    tile_levels: int | None = None
+    tile_size: int | None = None
+    tile_format: str | None = None
     
     class Config:
         orm_mode = True
 
 
+class UploadCreate(BaseModel):
+    filename: str
+    size: int
+
+
+class Upload(UploadCreate):
+    id: str
+    project_id: str
+    part_size: int
+
+    class Config:
+        orm_mode = True
+
+
+class UploadStatus(Upload):
+    bytes_received: int
+    received: list[list[int]]
+    missing: list[list[int]]
+
+
 class AnnotationBase(BaseModel):
     note: str
     coordinates: dict
@@ -59,17 +94,56 @@ class AnnotationBase(BaseModel):
 
 class AnnotationCreate(AnnotationBase):
     # project_id: str
-    pass
+
+    @validator('coordinates')
+    def normalize_coordinates(cls, value):
+        # Stored as normalized, see geometry.normalize
+        return geometry.normalize(value)
 
 
 class Annotation(AnnotationBase):
     id: int
+    revision: int = 0
+    updated_at: datetime | None = None
+    deleted: bool = False
     # owner: User
     
     class Config:
         orm_mode = True
 
 
+class AnnotationOperation(BaseModel):
+    op: Literal['create', 'update', 'delete']
+    id: int | None = None
+    annotation: AnnotationCreate | None = None
+
+
+class AnnotationBatch(BaseModel):
+    operations: list[AnnotationOperation]
+
+
+class AnnotationOperationResult(BaseModel):
+    op: str
+    id: int | None = None
+    status: int
+    detail: str | None = None
+
+
+class AnnotationCluster(BaseModel):
+    x: float
+    y: float
+    count: int
+    min_x: float
+    min_y: float
+    max_x: float
+    max_y: float
+
+
+class AnnotationViewport(BaseModel):
+    annotations: list[Annotation]
+    clusters: list[AnnotationCluster]
+
+
 class ProjectBase(BaseModel):
     name: str
 
@@ -86,4 +160,31 @@ class Project(ProjectBase):
 
 
 class ProjectCreate(ProjectBase):
-    pass
\ No newline at end of file
+    pass
+
+
+class ProjectImport(BaseModel):
+    project_id: str
+    files: int
+    # Listed in project.json without their contents, and not stored here
+    missing_files: int
+    annotations: int
+    bytes: int
+    seconds: float
+    mb_per_second: float
+
+
+class Job(BaseModel):
+    id: int
+    kind: str
+    status: str
+    attempts: int
+    max_attempts: int
+    created_at: datetime
+    run_at: datetime | None = None
+    finished_at: datetime | None = None
+    result: dict | None = None
+    error: str | None = None
+
+    class Config:
+        orm_mode = True
\ No newline at end of file
@@ -0,0 +1,217 @@
+import gzip
+import json
+import sys
+from array import array
+from itertools import chain
+
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import orjson
+except ImportError:  # installed with fastapi[all]
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Annotation lists are encoded straight from the ORM rows: they come from our
+# own database, so validating them through schemas.Annotation again only
+# costs time. Every payload is encoded once and the bytes are reused, for
+# REST responses as well as for every socket in a room.
+
+# Bodies smaller than this are sent as they are; compressing them costs
+# more than it saves. Coordinates are mostly digits, so gzip level 1 gets
+# within a few percent of level 6 at a third of the time.
+COMPRESS_MIN_SIZE = 16 * 1024
+GZIP_LEVEL = 1
+BROTLI_QUALITY = 4
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MEDIA_TYPES = {JSON: JSON, MSGPACK: MSGPACK, "application/x-msgpack": MSGPACK}
+# Websocket subprotocol -> media type; without one, sockets speak JSON.
+SUBPROTOCOLS = {"aat.msgpack": MSGPACK}
+
+# In MessagePack, lists of [x, y] points inside "coordinates" are packed as
+# flat little-endian arrays: int32 when every value is an integer that fits
+# (lossless), float32 for floats (about 7 significant digits). Anything
+# else (bools, larger integers) is left as a plain list.
+POINTS_INT32 = 1
+POINTS_FLOAT32 = 2
+# Integers float32 holds exactly
+FLOAT32_EXACT = 2 ** 24
+# Responses with at least this many items (annotations, clusters) are
+# encoded in the threadpool: about COMPRESS_MIN_SIZE of small annotations,
+# and MessagePack packing is pure Python
+THREADPOOL_MIN_ITEMS = 100
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+
+def loads(data: bytes | str):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _points(value: list):
+    # None leaves the points a plain list, so bools and integers int32 (or,
+    # next to floats, float32) cannot hold exactly keep their values
+    try:
+        if not all(map((2).__eq__, map(len, value))):
+            return None
+    except TypeError:
+        return None
+    flat = list(chain.from_iterable(value))
+    types = set(map(type, flat))
+    if types == {int}:
+        try:
+            code, values = POINTS_INT32, array("i", flat)
+        except OverflowError:
+            return None
+    elif types == {float} or types == {int, float}:
+        integers = (item for item in flat if type(item) is int)
+        if not all(-FLOAT32_EXACT <= item <= FLOAT32_EXACT for item in integers):
+            return None
+        try:
+            code, values = POINTS_FLOAT32, array("f", flat)
+        except OverflowError:
+            return None
+    else:
+        return None
+    if sys.byteorder == "big":
+        values.byteswap()
+    return msgpack.ExtType(code, values.tobytes())
+
+def _pack_coordinates(value):
+    if isinstance(value, dict):
+        return {key: _pack_coordinates(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if value and isinstance(value[0], list):
+            packed = _points(value)
+            if packed is not None:
+                return packed
+        return [_pack_coordinates(item) for item in value]
+    return value
+
+def _pack(value):
+    if isinstance(value, dict):
+        return {
+            key: _pack_coordinates(item) if key == "coordinates" else _pack(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_pack(item) for item in value]
+    return value
+
+def _unpack_points(code: int, data: bytes):
+    if code not in (POINTS_INT32, POINTS_FLOAT32):
+        return msgpack.ExtType(code, data)
+    values = array("i" if code == POINTS_INT32 else "f")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    flat = iter(values.tolist())
+    return list(map(list, zip(flat, flat)))
+
+
+def encode(value, media_type: str = JSON) -> bytes:
+    if media_type == MSGPACK:
+        return msgpack.packb(_pack(value))
+    return dumps(value)
+
+def decode(data: bytes | str, media_type: str = JSON):
+    if media_type == MSGPACK and isinstance(data, bytes):
+        return msgpack.unpackb(data, ext_hook=_unpack_points)
+    return loads(data)
+
+def wire(value, media_type: str = JSON):
+    # What a websocket sends: JSON as a text frame, MessagePack as binary.
+    data = encode(value, media_type)
+    return data if media_type == MSGPACK else data.decode()
+
+
+def annotation_list(annotations, lod: int = 0) -> list[dict]:
+    if lod:
+        return [annotation.dict(lod) for annotation in annotations]
+    return [annotation.dict() for annotation in annotations]
+
+
+def _accepted_with_quality(header: str):
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            yield name.strip().lower(), quality
+
+def _accepted(header: str):
+    return (name for name, _ in _accepted_with_quality(header))
+
+def accepted_media_type(request: Request):
+    # The first acceptable type we can produce, in the client's order of
+    # preference; JSON when there is none.
+    accepted = sorted(
+        _accepted_with_quality(request.headers.get("accept", "")), key=lambda item: -item[1]
+    )
+    for name, _ in accepted:
+        media_type = MEDIA_TYPES.get(name)
+        if media_type == MSGPACK and msgpack is None:
+            continue
+        if media_type:
+            return media_type
+    return JSON
+
+def accepted_encoding(request: Request):
+    accepted = set(_accepted(request.headers.get("accept-encoding", "")))
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _items(value):
+    if isinstance(value, dict):
+        return sum(len(item) for item in value.values() if isinstance(item, list))
+    return len(value) if isinstance(value, list) else 0
+
+
+async def encoded_response(request: Request, value, headers: dict | None = None):
+    # JSON, or MessagePack when the Accept header asks for it
+    media_type = accepted_media_type(request)
+    if _items(value) >= THREADPOOL_MIN_ITEMS:
+        body = await run_in_threadpool(encode, value, media_type)
+    else:
+        body = encode(value, media_type)
+    headers = {**(headers or {}), "Vary": "Accept, Accept-Encoding"}
+    encoding = accepted_encoding(request) if len(body) >= COMPRESS_MIN_SIZE else None
+    if encoding:
+        body = await run_in_threadpool(compress, body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=media_type, headers=headers)
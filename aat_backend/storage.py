@@ -0,0 +1,160 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+
+
+DATA_DIR = os.environ.get("AAT_DATA_DIR", "data")
+CHUNK_SIZE = 1024 * 1024
+DIGEST = re.compile(r"[0-9a-f]{64}")
+# Blobs written or reused this recently may belong to a File row that is
+# not committed yet, so they are never removed
+FRESH_SECONDS = 3600
+
+
+# Uploaded files are stored once per content under data/blobs/<aa>/<sha256>,
+# so the same image uploaded to several projects shares one blob. File.path
+# is relative to DATA_DIR; rows created before this layout keep their
+# data/<uuid><ext> paths and are handled the same way.
+
+def full_path(path: str):
+    return os.path.join(DATA_DIR, path)
+
+def is_digest(value):
+    return isinstance(value, str) and DIGEST.fullmatch(value) is not None
+
+def blob_path(sha256: str):
+    # The digest becomes part of a path: anything else could point outside
+    # the blob store
+    if not is_digest(sha256):
+        raise ValueError(f"Not a sha256 digest: {sha256!r}")
+    return os.path.join("blobs", sha256[:2], sha256)
+
+def derived_dir(path: str):
+    # Thumbnails and tiles generated from the file at `path`
+    return path + ".d"
+
+
+@contextlib.contextmanager
+def blob_lock(path: str):
+    # Held, across processes, while an upload decides to reuse a blob and
+    # while a delete decides to remove one. Striped by the first two
+    # characters of the name, so there are at most 256 lock files.
+    lock_dir = full_path("locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, os.path.basename(path)[:2] + ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def reuse(path: str):
+    # True when the blob exists; it is then fresh again, so no delete or
+    # sweep removes it before the row about to be created refers to it
+    with blob_lock(path):
+        try:
+            os.utime(full_path(path))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class BlobWriter:
+    # Streams chunks into a temporary file while hashing them, then moves
+    # the file to its content address.
+    def __init__(self):
+        tmp_dir = full_path("tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        self.file.close()
+        sha256 = self.sha256.hexdigest()
+        path = blob_path(sha256)
+        target = full_path(path)
+        with blob_lock(path):
+            if os.path.exists(target):
+                os.remove(self.file.name)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(self.file.name, target)
+            os.utime(target)
+        return path, sha256, self.size
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+
+def store_stream(stream):
+    # Blocking; call it from the threadpool.
+    writer = BlobWriter()
+    try:
+        while chunk := stream.read(CHUNK_SIZE):
+            writer.write(chunk)
+        return writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+
+def remove_unless_fresh(path: str, fresh_since: float | None = None):
+    # For blobs no row refers to any more. Not when an upload wrote or
+    # reused it since `fresh_since` (FRESH_SECONDS ago by default): its row
+    # may be on the way. Those are left to the orphan sweep.
+    if fresh_since is None:
+        fresh_since = time.time() - FRESH_SECONDS
+    with blob_lock(path):
+        if os.path.exists(full_path(path)) and not _older(full_path(path), fresh_since):
+            return False
+        remove(path)
+        return True
+
+def remove(path: str):
+    try:
+        os.remove(full_path(path))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(full_path(derived_dir(path)), ignore_errors=True)
+
+
+def _older(path: str, before: float):
+    try:
+        return os.path.getmtime(path) < before
+    except FileNotFoundError:
+        return False
+
+def stale_blobs(before: float):
+    # Blob paths (relative, like File.path) last written before `before`,
+    # including the ones only left as a derived directory.
+    root = full_path("blobs")
+    paths = set()
+    for prefix in os.listdir(root) if os.path.isdir(root) else []:
+        for name in os.listdir(os.path.join(root, prefix)):
+            if name.endswith(".partial") or not _older(os.path.join(root, prefix, name), before):
+                continue
+            paths.add(os.path.join("blobs", prefix, name.removesuffix(".d")))
+    return sorted(paths)
+
+def remove_stale_files(directory: str, before: float):
+    # Files and directories directly under data/<directory> older than `before`
+    root = full_path(directory)
+    removed = 0
+    for name in os.listdir(root) if os.path.isdir(root) else []:
+        path = os.path.join(root, name)
+        if _older(path, before):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+            removed += 1
+    return removed
@@ -0,0 +1,128 @@
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+
+from starlette.concurrency import run_in_threadpool
+
+from . import async_crud, storage
+from .database import AsyncSessionLocal
+
+
+# Resumable uploads stage every part as data/staging/<upload_id>/<offset>.
+# A part only gets its final name once its body has been fully received, so
+# a dropped connection leaves nothing behind that looks complete. Parts can
+# arrive in any order, in parallel, and may overlap when clients retry.
+
+PART_SIZE = 8 * 1024 * 1024
+UPLOAD_TTL = timedelta(hours=float(os.environ.get("AAT_UPLOAD_TTL_HOURS", 24)))
+
+
+class PartOutOfRange(Exception):
+    pass
+
+
+def staging_dir(upload_id: str):
+    return storage.full_path(os.path.join("staging", upload_id))
+
+def _parts(upload_id: str):
+    directory = staging_dir(upload_id)
+    if not os.path.isdir(directory):
+        return []
+    parts = []
+    for name in os.listdir(directory):
+        if name.isdigit():
+            parts.append((int(name), os.path.getsize(os.path.join(directory, name))))
+    return sorted(parts)
+
+def received_ranges(upload_id: str):
+    # Merged [start, end) byte ranges covered by the finished parts.
+    ranges = []
+    for offset, length in _parts(upload_id):
+        end = offset + length
+        if ranges and offset <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        elif length:
+            ranges.append([offset, end])
+    return ranges
+
+def missing_ranges(ranges: list, size: int):
+    missing, position = [], 0
+    for start, end in ranges:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+async def write_part(upload_id: str, offset: int, size: int, chunks):
+    directory = staging_dir(upload_id)
+    await run_in_threadpool(os.makedirs, directory, exist_ok=True)
+    final = os.path.join(directory, str(offset))
+    partial = os.path.join(directory, f"{offset}.{uuid.uuid4().hex}.partial")
+    f = await run_in_threadpool(open, partial, "wb")
+    try:
+        written, buffer = 0, bytearray()
+        async for chunk in chunks:
+            written += len(chunk)
+            if offset + written > size:
+                raise PartOutOfRange()
+            buffer += chunk
+            if len(buffer) >= storage.CHUNK_SIZE:
+                await run_in_threadpool(f.write, bytes(buffer))
+                buffer.clear()
+        await run_in_threadpool(f.write, bytes(buffer))
+        await run_in_threadpool(f.close)
+        await run_in_threadpool(os.replace, partial, final)
+    except BaseException:
+        f.close()
+        await run_in_threadpool(_remove, partial)
+        raise
+    return written
+
+def _remove(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def assemble(upload_id: str):
+    # Blocking; streams the parts in offset order into a blob, skipping
+    # bytes already written by an overlapping part.
+    directory = staging_dir(upload_id)
+    writer = storage.BlobWriter()
+    try:
+        position = 0
+        for offset, length in _parts(upload_id):
+            if offset + length <= position:
+                continue
+            with open(os.path.join(directory, str(offset)), "rb") as part:
+                part.seek(position - offset)
+                while chunk := part.read(storage.CHUNK_SIZE):
+                    writer.write(chunk)
+            position = offset + length
+        return writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+
+def discard(upload_id: str):
+    shutil.rmtree(staging_dir(upload_id), ignore_errors=True)
+
+def staged_upload_ids():
+    directory = storage.full_path("staging")
+    return os.listdir(directory) if os.path.isdir(directory) else []
+
+
+async def collect_garbage():
+    # Drops upload sessions that have not received a part for UPLOAD_TTL,
+    # and staging directories whose session no longer exists.
+    # Staging is listed first so sessions created meanwhile are never orphans.
+    staged = await run_in_threadpool(staged_upload_ids)
+    async with AsyncSessionLocal() as db:
+        expired = await async_crud.delete_uploads_before(db, datetime.utcnow() - UPLOAD_TTL)
+        live = set(await async_crud.get_upload_ids(db))
+    orphaned = [upload_id for upload_id in staged if upload_id not in live]
+    for upload_id in set(expired) | set(orphaned):
+        await run_in_threadpool(discard, upload_id)
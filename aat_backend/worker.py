@@ -0,0 +1,38 @@
+"""Runs queued jobs outside the web server.
+
+    python -m aat_backend.worker --concurrency 4
+
+Start the web server with AAT_JOB_WORKERS=0 to leave all jobs to these
+processes, or keep both; any number of workers can share one queue.
+"""
+import argparse
+import asyncio
+import signal
+
+from . import imaging, jobs, metrics
+
+
+async def run(concurrency: int):
+    worker = jobs.Worker(concurrency)
+    task = asyncio.create_task(worker.run())
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+    metrics.log.info("job worker %s running %d jobs at a time", worker.id, concurrency)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        imaging.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=max(jobs.JOB_WORKERS, 1))
+    args = parser.parse_args()
+    asyncio.run(run(args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
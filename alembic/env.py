@@ -1,3 +1,4 @@
+import os
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -14,12 +15,22 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# Migrate the database the application uses; alembic.ini holds the default
+if os.environ.get("AAT_DATABASE_URL"):
+    config.set_main_option("sqlalchemy.url", os.environ["AAT_DATABASE_URL"].replace("%", "%%"))
+
 # add your model's MetaData object here
 # for 'autogenerate' support
 from aat_backend.models import Base
 target_metadata = Base.metadata
 # target_metadata = None
 
+
+def include_name(name, type_, parent_names):
+    # The annotations R*Tree and its shadow tables are maintained by the
+    # migrations' raw DDL, not by autogenerate.
+    return not (type_ == "table" and name.startswith("annotations_rtree"))
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -42,6 +53,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_name=include_name,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -65,7 +77,7 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata, include_name=include_name
         )
 
         with context.begin_transaction():
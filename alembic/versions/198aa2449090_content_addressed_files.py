@@ -0,0 +1,31 @@
+"""content addressed files
+
+Revision ID: 198aa2449090
+Revises: 1c0bfe885084
+Create Date: 2026-10-18 07:56:10.087867
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '198aa2449090'
+down_revision: Union[str, None] = '1c0bfe885084'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('files', sa.Column('sha256', sa.String(), nullable=True))
+    op.add_column('files', sa.Column('size', sa.BigInteger(), nullable=True))
+    op.create_index(op.f('ix_files_path'), 'files', ['path'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_files_path'), table_name='files')
+    with op.batch_alter_table('files') as batch_op:
+        batch_op.drop_column('size')
+        batch_op.drop_column('sha256')
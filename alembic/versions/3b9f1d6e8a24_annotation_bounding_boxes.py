@@ -0,0 +1,119 @@
+"""annotation bounding boxes
+
+Revision ID: 3b9f1d6e8a24
+Revises: 7e0b9a3d5c12
+Create Date: 2026-10-18 08:05:53.829245
+
+"""
+import math
+from numbers import Real
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b9f1d6e8a24'
+down_revision: Union[str, None] = '7e0b9a3d5c12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_PAGE = 1000
+
+# As of this revision, copied rather than imported so that later changes to
+# the app cannot change what this migration does.
+RTREE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS annotations_rtree USING rtree(id, min_x, max_x, min_y, max_y)",
+    "CREATE TRIGGER IF NOT EXISTS annotations_rtree_insert AFTER INSERT ON annotations "
+    "WHEN NEW.min_x IS NOT NULL AND NOT NEW.deleted BEGIN "
+    "INSERT OR REPLACE INTO annotations_rtree VALUES (NEW.id, NEW.min_x, NEW.max_x, NEW.min_y, NEW.max_y); END",
+    "CREATE TRIGGER IF NOT EXISTS annotations_rtree_update AFTER UPDATE ON annotations BEGIN "
+    "DELETE FROM annotations_rtree WHERE id = OLD.id; "
+    "INSERT INTO annotations_rtree SELECT NEW.id, NEW.min_x, NEW.max_x, NEW.min_y, NEW.max_y "
+    "WHERE NEW.min_x IS NOT NULL AND NOT NEW.deleted; END",
+    "CREATE TRIGGER IF NOT EXISTS annotations_rtree_delete AFTER DELETE ON annotations BEGIN "
+    "DELETE FROM annotations_rtree WHERE id = OLD.id; END",
+]
+
+
+def _is_number(value):
+    return isinstance(value, Real) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _points(value):
+    # [x, y, ...] lists, {"x", "y"} objects, and {"x", "y", "width", "height"}
+    # rectangles, wherever they appear
+    if isinstance(value, dict):
+        x, y = value.get("x"), value.get("y")
+        if _is_number(x) and _is_number(y):
+            yield x, y
+            width, height = value.get("width"), value.get("height")
+            if _is_number(width) and _is_number(height):
+                yield x + width, y + height
+            return
+        for item in value.values():
+            yield from _points(item)
+    elif isinstance(value, (list, tuple)):
+        if len(value) >= 2 and _is_number(value[0]) and _is_number(value[1]):
+            yield value[0], value[1]
+            return
+        for item in value:
+            yield from _points(item)
+
+
+def _bbox_columns(coordinates):
+    points = list(_points(coordinates))
+    if not points:
+        return {'min_x': None, 'min_y': None, 'max_x': None, 'max_y': None}
+    xs, ys = [float(x) for x, _ in points], [float(y) for _, y in points]
+    return {'min_x': min(xs), 'min_y': min(ys), 'max_x': max(xs), 'max_y': max(ys)}
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('annotations') as batch_op:
+        batch_op.add_column(sa.Column('min_x', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('min_y', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('max_x', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('max_y', sa.Float(), nullable=True))
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        for statement in RTREE_DDL:
+            op.execute(statement)
+
+    # Backfill by pages of ids; on SQLite the update trigger fills the
+    # R*Tree as it goes.
+    annotations = sa.table(
+        'annotations',
+        sa.column('id', sa.Integer), sa.column('coordinates', sa.JSON),
+        sa.column('min_x', sa.Float), sa.column('min_y', sa.Float),
+        sa.column('max_x', sa.Float), sa.column('max_y', sa.Float),
+    )
+    after = 0
+    while True:
+        page = bind.execute(
+            sa.select(annotations.c.id, annotations.c.coordinates)
+            .where(annotations.c.id > after).order_by(annotations.c.id).limit(BACKFILL_PAGE)
+        ).all()
+        if not page:
+            break
+        after = page[-1].id
+        bind.execute(
+            annotations.update().where(annotations.c.id == sa.bindparam('_id')).values(
+                min_x=sa.bindparam('min_x'), min_y=sa.bindparam('min_y'),
+                max_x=sa.bindparam('max_x'), max_y=sa.bindparam('max_y'),
+            ),
+            [{'_id': row.id, **_bbox_columns(row.coordinates)} for row in page],
+        )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        for name in ('insert', 'update', 'delete'):
+            op.execute(f'DROP TRIGGER IF EXISTS annotations_rtree_{name}')
+        op.execute('DROP TABLE IF EXISTS annotations_rtree')
+    with op.batch_alter_table('annotations') as batch_op:
+        batch_op.drop_column('max_y')
+        batch_op.drop_column('max_x')
+        batch_op.drop_column('min_y')
+        batch_op.drop_column('min_x')
@@ -0,0 +1,44 @@
+"""annotation revisions
+
+Revision ID: 7e0b9a3d5c12
+Revises: a41f6c2e9b07
+Create Date: 2026-10-18 08:02:53.589207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7e0b9a3d5c12'
+down_revision: Union[str, None] = 'a41f6c2e9b07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('projects', sa.Column('annotation_revision', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('annotations', sa.Column('revision', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('annotations', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('annotations', sa.Column('deleted', sa.Boolean(), server_default=sa.false(), nullable=False))
+    op.create_index('ix_annotations_project_id_revision', 'annotations', ['project_id', 'revision'], unique=False)
+
+    # Existing annotations become revision 1, so ?since=0 returns them too;
+    # new changes start at 2 in projects that have some
+    op.execute('UPDATE annotations SET revision = 1')
+    op.execute(
+        'UPDATE projects SET annotation_revision = 1 '
+        'WHERE EXISTS (SELECT 1 FROM annotations WHERE annotations.project_id = projects.id)'
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_annotations_project_id_revision', table_name='annotations')
+    with op.batch_alter_table('annotations') as batch_op:
+        batch_op.drop_column('deleted')
+        batch_op.drop_column('updated_at')
+        batch_op.drop_column('revision')
+    with op.batch_alter_table('projects') as batch_op:
+        batch_op.drop_column('annotation_revision')
@@ -0,0 +1,38 @@
+"""file thumbnails and tiles
+
+Revision ID: 9c4e7a1f2d63
+Revises: 3b9f1d6e8a24
+Create Date: 2026-10-18 08:28:07.991806
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c4e7a1f2d63'
+down_revision: Union[str, None] = '3b9f1d6e8a24'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('files') as batch_op:
+        batch_op.add_column(sa.Column('processing_status', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('width', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('height', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('tile_levels', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('tile_size', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('tile_format', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('files') as batch_op:
+        batch_op.drop_column('tile_format')
+        batch_op.drop_column('tile_size')
+        batch_op.drop_column('tile_levels')
+        batch_op.drop_column('height')
+        batch_op.drop_column('width')
+        batch_op.drop_column('processing_status')
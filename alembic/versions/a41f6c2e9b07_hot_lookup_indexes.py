@@ -0,0 +1,33 @@
+"""hot lookup indexes
+
+Revision ID: a41f6c2e9b07
+Revises: 5d3e2b7c41a8
+Create Date: 2026-10-18 07:59:39.947317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a41f6c2e9b07'
+down_revision: Union[str, None] = '5d3e2b7c41a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_annotations_project_id_id', 'annotations', ['project_id', 'id'], unique=False)
+    op.create_index(op.f('ix_annotations_owner_id'), 'annotations', ['owner_id'], unique=False)
+    op.create_index(op.f('ix_files_project_id'), 'files', ['project_id'], unique=False)
+    op.create_index(op.f('ix_projects_owner_id'), 'projects', ['owner_id'], unique=False)
+    op.create_index(op.f('ix_project_user_user_id'), 'project_user', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_project_user_user_id'), table_name='project_user')
+    op.drop_index(op.f('ix_projects_owner_id'), table_name='projects')
+    op.drop_index(op.f('ix_files_project_id'), table_name='files')
+    op.drop_index(op.f('ix_annotations_owner_id'), table_name='annotations')
+    op.drop_index('ix_annotations_project_id_id', table_name='annotations')
@@ -0,0 +1,153 @@
+"""annotation levels of detail
+
+Revision ID: b8d2f4a6c031
+Revises: 4f2a8d0c6b19
+Create Date: 2026-10-18 09:20:41.517302
+
+"""
+import math
+from numbers import Real
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8d2f4a6c031'
+down_revision: Union[str, None] = '4f2a8d0c6b19'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_PAGE = 1000
+
+# As of this revision, copied rather than imported so that later changes to
+# the app, or AAT_LOD_TOLERANCES, cannot change what this migration does.
+TOLERANCES = (1.0, 4.0, 16.0, 64.0)
+MIN_POINTS = 64
+MIN_REDUCTION = 0.75
+
+
+def _is_number(value):
+    return isinstance(value, Real) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _is_point(value):
+    return type(value) is list and len(value) >= 2 and _is_number(value[0]) and _is_number(value[1])
+
+
+def _point_sequence(value: list):
+    # The (x, y) of a list of [x, y, ...] lists or {"x", "y"} objects, or None
+    if len(value) < 2:
+        return None
+    if all(map(_is_point, value)):
+        return [(item[0], item[1]) for item in value]
+    if all(type(item) is dict and _is_number(item.get("x")) and _is_number(item.get("y")) and "width" not in item for item in value):
+        return [(item["x"], item["y"]) for item in value]
+    return None
+
+
+def _douglas_peucker(points, tolerance: float):
+    # Indices of the points kept
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        (x0, y0), (x1, y1) = points[start], points[end]
+        dx, dy = x1 - x0, y1 - y0
+        length = math.hypot(dx, dy)
+        farthest, distance = start, -1.0
+        for index in range(start + 1, end):
+            x, y = points[index]
+            if length == 0:
+                d = math.hypot(x - x0, y - y0)
+            else:
+                d = abs(dx * (y - y0) - dy * (x - x0)) / length
+            if d > distance:
+                farthest, distance = index, d
+        if distance > tolerance:
+            keep[farthest] = True
+            stack.append((start, farthest))
+            stack.append((farthest, end))
+    return [index for index, kept in enumerate(keep) if kept]
+
+
+def _sequence_lengths(value):
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from _sequence_lengths(item)
+    elif isinstance(value, list):
+        points = _point_sequence(value)
+        if points is None:
+            for item in value:
+                yield from _sequence_lengths(item)
+        else:
+            yield len(points)
+
+
+def _simplify(value, tolerance: float, counts: list):
+    if isinstance(value, dict):
+        return {key: _simplify(item, tolerance, counts) for key, item in value.items()}
+    if isinstance(value, list):
+        points = _point_sequence(value)
+        if points is None:
+            return [_simplify(item, tolerance, counts) for item in value]
+        if len(points) >= MIN_POINTS:
+            value = [value[index] for index in _douglas_peucker(points, tolerance)]
+        counts.append(len(value))
+        return value
+    return value
+
+
+def _levels_of_detail(coordinates):
+    # {"1": coordinates, ...} for the levels worth storing, or None
+    counts = list(_sequence_lengths(coordinates))
+    if not counts or max(counts) < MIN_POINTS:
+        return None
+    levels, previous, previous_count = {}, coordinates, sum(counts)
+    for level, tolerance in enumerate(TOLERANCES, 1):
+        counts = []
+        simplified = _simplify(previous, tolerance, counts)
+        if sum(counts) <= previous_count * MIN_REDUCTION:
+            levels[str(level)] = simplified
+            previous, previous_count = simplified, sum(counts)
+    return levels or None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('annotations') as batch_op:
+        batch_op.add_column(sa.Column('lods', sa.JSON(), nullable=True))
+
+    # Backfill by pages of ids; only shapes large enough get levels
+    bind = op.get_bind()
+    annotations = sa.table(
+        'annotations',
+        sa.column('id', sa.Integer), sa.column('coordinates', sa.JSON), sa.column('lods', sa.JSON),
+    )
+    after = 0
+    while True:
+        page = bind.execute(
+            sa.select(annotations.c.id, annotations.c.coordinates)
+            .where(annotations.c.id > after).order_by(annotations.c.id).limit(BACKFILL_PAGE)
+        ).all()
+        if not page:
+            break
+        after = page[-1].id
+        rows = [
+            {'_id': row.id, 'lods': lods}
+            for row in page
+            if row.coordinates and (lods := _levels_of_detail(row.coordinates)) is not None
+        ]
+        if rows:
+            bind.execute(
+                annotations.update().where(annotations.c.id == sa.bindparam('_id')).values(lods=sa.bindparam('lods')),
+                rows,
+            )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('annotations') as batch_op:
+        batch_op.drop_column('lods')
@@ -0,0 +1,53 @@
+"""N single annotation creates against one N-item batch.
+
+    python benchmarks/annotation_batch.py --count 10000
+
+Drives the app in-process against a throwaway SQLite database.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.testclient import TestClient
+
+from aat_backend import models
+from aat_backend.database import engine
+from aat_backend.main import app
+
+
+def annotation(i: int):
+    return {"note": f"box {i}", "coordinates": {"points": [[i, i], [i + 10, i], [i + 10, i + 10], [i, i + 10]]}, "color": "red"}
+
+
+def main(args):
+    models.Base.metadata.create_all(bind=engine)
+    with TestClient(app) as client:
+        client.post("/user", json={"username": "bench", "hashed_password": "bench"})
+        token = client.post("/token", data={"username": "bench", "password": "bench"}).json()["access_token"]
+        client.headers["Authorization"] = f"Bearer {token}"
+        project_id = client.post("/projects", json={"name": "batch"}).json()["id"]
+
+        started = time.perf_counter()
+        for i in range(args.count):
+            client.post(f"/projects/{project_id}/annotations/", json=annotation(i)).raise_for_status()
+        single = time.perf_counter() - started
+
+        operations = [{"op": "create", "annotation": annotation(i)} for i in range(args.count)]
+        started = time.perf_counter()
+        client.post(f"/projects/{project_id}/annotations/batch", json={"operations": operations}).raise_for_status()
+        batch = time.perf_counter() - started
+
+    print(f"{args.count} single requests: {single:7.2f}s ({args.count / single:8.0f} annotations/s)")
+    print(f"one {args.count}-item batch:  {batch:7.2f}s ({args.count / batch:8.0f} annotations/s)")
+    print(f"speedup: {single / batch:.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10_000)
+    main(parser.parse_args())
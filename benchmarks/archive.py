@@ -0,0 +1,111 @@
+"""Throughput of project archive export and import, in MB/s.
+
+    python benchmarks/archive.py --files 20 --file-size 16 --annotations 100000
+
+Seeds a project in a temporary data directory and SQLite database with
+`--files` random files of `--file-size` MiB and `--annotations` polygons,
+then times:
+
+* export: iterating archive.ProjectArchive, with and without gzip;
+* import: archive.import_archive fed the exported bytes in 64 KiB chunks,
+  the size uvicorn hands request bodies over in.
+
+Bytes are counted as they go over the wire (compressed when gzipped).
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+REQUEST_CHUNK = 64 * 1024
+
+
+def configure():
+    directory = tempfile.mkdtemp()
+    os.environ["AAT_DATA_DIR"] = os.path.join(directory, "data")
+    os.environ["AAT_DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ["AAT_JOB_WORKERS"] = "0"
+
+
+async def seed(args):
+    from sqlalchemy import insert
+
+    from aat_backend import async_crud, models, schemas, storage
+    from aat_backend.database import AsyncSessionLocal, async_engine
+
+    async with async_engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+    user = schemas.User(id=1, username="bench")
+    rng = random.Random(0)
+    async with AsyncSessionLocal() as db:
+        await db.execute(insert(models.User).values(id=1, username="bench"))
+        await db.execute(insert(models.Project).values(id="bench", name="bench", owner_id=1))
+        for i in range(args.files):
+            writer = storage.BlobWriter()
+            for _ in range(args.file_size):
+                writer.write(os.urandom(1024 * 1024))
+            path, sha256, size = writer.commit()
+            db.add(models.File(path=path, filename=f"{i}.bin", sha256=sha256, size=size, project_id="bench"))
+        await db.commit()
+        annotations = [
+            schemas.AnnotationCreate(
+                note=f"cell {i}",
+                color="#ff0000",
+                coordinates={"points": [[rng.uniform(0, 1e5), rng.uniform(0, 1e5)] for _ in range(16)]},
+            )
+            for i in range(args.annotations)
+        ]
+        for start in range(0, len(annotations), 10000):
+            await async_crud.import_annotations(db, "bench", user, annotations[start:start + 10000])
+        await db.commit()
+    return user
+
+
+async def export(project_archive, gzip: bool):
+    from aat_backend import archive
+
+    chunks, size = [], 0
+    started = time.perf_counter()
+    async for chunk in archive.gzipped(project_archive) if gzip else project_archive:
+        chunks.append(chunk)
+        size += len(chunk)
+    return b"".join(chunks), time.perf_counter() - started
+
+
+async def feed(data: bytes):
+    for start in range(0, len(data), REQUEST_CHUNK):
+        yield data[start:start + REQUEST_CHUNK]
+
+
+def report(name: str, size: int, elapsed: float):
+    print(f"{name:<28} {size / 1e6:9.1f} MB in {elapsed:6.2f}s  {size / 1e6 / elapsed:8.1f} MB/s")
+
+
+async def main(args):
+    configure()
+    from aat_backend import archive
+    from aat_backend.database import async_engine
+
+    user = await seed(args)
+    print(f"{args.files} files x {args.file_size} MiB, {args.annotations} annotations\n")
+    for include_files, gzip in ((True, False), (True, True), (False, True)):
+        name = f"{'files' if include_files else 'annotations'}{', gzip' if gzip else ''}"
+        data, elapsed = await export(archive.ProjectArchive("bench", include_files=include_files), gzip)
+        report(f"export ({name})", len(data), elapsed)
+        result, _ = await archive.import_archive(feed(data), user)
+        report(f"import ({name})", result["bytes"], result["seconds"])
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=16, help="MiB per file")
+    parser.add_argument("--annotations", type=int, default=100000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,124 @@
+"""Query plans and timings of the hot lookups with and without indexes.
+
+    python benchmarks/index_plans.py --annotations 1000000
+
+Seeds a throwaway SQLite database, then runs every query twice: once with the
+secondary indexes dropped (the state before migration a41f6c2e9b07) and once
+with the indexes declared in models.py.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine, insert, text
+
+from aat_backend import models
+
+QUERIES = {
+    "annotations of a project": (
+        "SELECT * FROM annotations WHERE project_id = :project_id ORDER BY id",
+        {"project_id": "project-00007"},
+    ),
+    "annotations of a user": (
+        "SELECT id FROM annotations WHERE owner_id = :user_id",
+        {"user_id": 7},
+    ),
+    "files of a project": (
+        "SELECT * FROM files WHERE project_id = :project_id",
+        {"project_id": "project-00007"},
+    ),
+    "projects of a user": (
+        "SELECT id FROM projects WHERE owner_id = :user_id "
+        "UNION SELECT project_id FROM project_user WHERE user_id = :user_id",
+        {"user_id": 7},
+    ),
+}
+
+INDEXES = [
+    index
+    for table in models.Base.metadata.sorted_tables
+    for index in table.indexes
+    if table.name in ("annotations", "files", "projects", "project_user")
+]
+
+
+def seed(engine, args):
+    rng = random.Random(0)
+    project_ids = [f"project-{i:05d}" for i in range(args.projects)]
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"id": i, "username": f"user-{i}"} for i in range(args.users)])
+        conn.execute(insert(models.Project), [
+            {"id": project_id, "name": project_id, "owner_id": rng.randrange(args.users)} for project_id in project_ids
+        ])
+        conn.execute(insert(models.project_user), [
+            {"project_id": project_id, "user_id": user_id}
+            for project_id in project_ids
+            for user_id in rng.sample(range(args.users), 3)
+        ])
+        conn.execute(insert(models.File), [
+            {"path": f"blob-{i}", "filename": f"{i}.png", "project_id": rng.choice(project_ids)}
+            for i in range(args.projects * 10)
+        ])
+        batch = 50_000
+        for start in range(0, args.annotations, batch):
+            conn.execute(insert(models.Annotation), [
+                {
+                    "note": "",
+                    "coordinates": {"points": [[i % 1000, i % 777]]},
+                    "color": "red",
+                    "project_id": rng.choice(project_ids),
+                    "owner_id": rng.randrange(args.users),
+                }
+                for i in range(start, min(start + batch, args.annotations))
+            ])
+
+
+def measure(engine, repeat: int):
+    results = {}
+    with engine.connect() as conn:
+        for name, (sql, params) in QUERIES.items():
+            plan = [row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql), params)]
+            started = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql), params).fetchall()
+            results[name] = ((time.perf_counter() - started) / repeat * 1000, plan)
+    return results
+
+
+def main(args):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    started = time.perf_counter()
+    seed(engine, args)
+    print(f"seeded {args.annotations} annotations in {time.perf_counter() - started:.1f}s\n")
+
+    with engine.begin() as conn:
+        for index in INDEXES:
+            index.drop(conn)
+    before = measure(engine, args.repeat)
+    with engine.begin() as conn:
+        for index in INDEXES:
+            index.create(conn)
+        conn.execute(text("ANALYZE"))
+    after = measure(engine, args.repeat)
+
+    for name in QUERIES:
+        (before_ms, before_plan), (after_ms, after_plan) = before[name], after[name]
+        print(f"{name}: {before_ms:9.2f}ms -> {after_ms:7.2f}ms ({before_ms / max(after_ms, 1e-6):.0f}x)")
+        print(f"    before: {' | '.join(before_plan)}")
+        print(f"    after:  {' | '.join(after_plan)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annotations", type=int, default=1_000_000)
+    parser.add_argument("--projects", type=int, default=500)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,27 @@
+"""Load test of the API and websocket paths against a synthetic dataset.
+
+    python -m benchmarks.load                          # the app in-process
+    python -m benchmarks.load --target uvicorn --workers 4
+    python -m benchmarks.load --annotations 2000000 --dataset /tmp/aat-bench
+    python -m benchmarks.load --compare benchmarks/results/load-<commit>-<time>.json
+
+Seeds users, projects, annotations and files (see dataset.py), then runs
+each scenario in scenarios.py: login, GET /projects, annotation
+list/create/update, file upload/download and --ws-clients websockets
+receiving live changes. Results (throughput, p50/p99 latency, memory of
+the server) are printed and saved as JSON under benchmarks/results/,
+tagged with the commit, so runs can be compared with --compare.
+
+Targets:
+
+* inprocess: requests go through httpx.ASGITransport to the app in this
+  process; no network, and the memory figures include the load generator;
+* uvicorn: a server started for the run with --workers, on the same
+  database and data directory;
+* --url: a server already running; it must use the dataset's database and
+  data directory (AAT_DATABASE_URL, AAT_DATA_DIR), so seed with --seed-only
+  first and start it with those settings.
+
+A --dataset directory is seeded once and reused by later runs with the
+same directory; the scenarios add annotations and files to it.
+"""
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+from . import dataset as datasets
+from . import report, scenarios
+from .targets import ROOT, InProcess, Server
+
+sys.path.insert(0, ROOT)
+
+
+async def main(args):
+    dataset = datasets.load(args.dataset)
+    if dataset is None:
+        print(f"seeding {args.dataset}")
+        dataset = datasets.seed(args.dataset, args)
+        print(f"seeded in {dataset['seed_seconds']}s")
+    else:
+        print(f"reusing {args.dataset} ({dataset['parameters']})")
+    if args.seed_only:
+        return
+
+    if args.target == "inprocess" and args.url is None:
+        target = InProcess()
+    else:
+        if args.url is None and args.workers > 1:
+            # memory:// would only reach the sockets on the worker that took the write
+            os.environ.setdefault("AAT_EVENT_BUS_URL", f"sqlite:///{os.path.join(args.dataset, 'events.db')}")
+        target = Server(args.url, args.workers)
+    await target.start()
+    session = scenarios.Session(target, dataset, args)
+    results = {"environment": report.environment(), "target": {"name": target.name, "workers": args.workers, "url": args.url},
+               "dataset": dataset["parameters"], "arguments": vars(args), "scenarios": {}}
+    try:
+        if "login" not in args.scenarios:
+            for username in dataset["users"]:
+                await session.login(username)
+        for name in args.scenarios:
+            print(f"  {name}", flush=True)
+            result = await scenarios.SCENARIOS[name](session)
+            if result is not None:
+                results["scenarios"][name] = result
+    finally:
+        await target.stop()
+
+    report.print_results(results)
+    print(f"\nsaved {report.save(results, args.output)}")
+    if args.compare:
+        report.compare(results, args.compare)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    target = parser.add_argument_group("target")
+    target.add_argument("--target", choices=("inprocess", "uvicorn"), default="inprocess")
+    target.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    target.add_argument("--url", help="a running server instead of starting one")
+
+    data = parser.add_argument_group("dataset")
+    data.add_argument("--dataset", help="directory to seed or reuse (default: a new temporary one)")
+    data.add_argument("--database-url", help="instead of SQLite in the dataset directory; the database must be empty")
+    data.add_argument("--seed", type=int, default=0)
+    data.add_argument("--users", type=int, default=20)
+    data.add_argument("--projects", type=int, default=20)
+    data.add_argument("--annotations", type=int, default=200000, help="spread over the projects")
+    data.add_argument("--points", type=int, default=16, help="per annotation polygon")
+    data.add_argument("--live-annotations", type=int, default=1000, help="in the project the websockets join")
+    data.add_argument("--files", type=int, default=4)
+    data.add_argument("--file-size", type=int, default=64, help="MiB per file")
+    data.add_argument("--seed-only", action="store_true")
+
+    load = parser.add_argument_group("load")
+    load.add_argument("--scenarios", nargs="+", choices=list(scenarios.SCENARIOS), default=list(scenarios.SCENARIOS))
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--requests", type=int, default=2000, help="per scenario")
+    load.add_argument("--logins", type=int, default=100)
+    load.add_argument("--page-size", type=int, default=1000, help="annotations per list request")
+    load.add_argument("--uploads", type=int, default=20)
+    load.add_argument("--upload-size", type=int, default=16, help="MiB per upload")
+    load.add_argument("--downloads", type=int, default=20)
+    load.add_argument("--ws-clients", type=int, default=200)
+    load.add_argument("--ws-probes", type=int, default=20)
+
+    parser.add_argument("--output", help="results file (default: benchmarks/results/load-<commit>-<time>.json)")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+    if args.dataset is None:
+        args.dataset = tempfile.mkdtemp(prefix="aat-bench-")
+    args.dataset = os.path.abspath(args.dataset)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    datasets.configure(args.dataset, args.database_url)
+    asyncio.run(main(args))
@@ -0,0 +1,121 @@
+"""Synthetic dataset: users, projects, annotations and files.
+
+Rows are written straight to the database with Core executemany (going
+through the API would take hours for millions of annotations) and files
+through storage.BlobWriter, so the server finds them where it would have
+put them. Everything is derived from --seed, and the layout is saved to
+dataset.json next to the database so later runs can reuse it.
+"""
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime
+
+PASSWORD = "bench"
+INSERT_CHUNK = 20000
+
+
+def configure(directory: str, database_url: str | None = None):
+    # Must run before aat_backend is imported: its settings are read at import
+    os.makedirs(directory, exist_ok=True)
+    os.environ["AAT_DATA_DIR"] = os.path.join(directory, "data")
+    os.environ["AAT_DATABASE_URL"] = database_url or f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ.pop("AAT_ASYNC_DATABASE_URL", None)
+    # Thumbnail jobs for uploaded files would compete with the requests
+    os.environ.setdefault("AAT_JOB_WORKERS", "0")
+    # Under load every request is "slow"; the results say more than the log
+    os.environ.setdefault("AAT_LOG_LEVEL", "WARNING")
+
+
+def load(directory: str):
+    path = os.path.join(directory, "dataset.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def polygon(rng: random.Random, points: int):
+    x, y, size = rng.uniform(0, 1e5), rng.uniform(0, 1e5), rng.uniform(10, 500)
+    return {"points": [[x + rng.uniform(0, size), y + rng.uniform(0, size)] for _ in range(points)]}
+
+
+def seed(directory: str, args):
+    from sqlalchemy import func, insert, select
+
+    from aat_backend import geometry, hashing, models, storage
+    from aat_backend.database import engine
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    models.Base.metadata.create_all(bind=engine)
+    # One bcrypt hash shared by every user, or seeding alone would take minutes
+    hashed_password = hashing.context().hash(PASSWORD)
+    users = [f"bench-{i}" for i in range(args.users)]
+    projects = [{"id": str(uuid.UUID(int=rng.getrandbits(128))), "owner": i % args.users} for i in range(args.projects)]
+    live = {"id": str(uuid.UUID(int=rng.getrandbits(128))), "owner": 0}
+
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [
+            {"id": i + 1, "username": username, "hashed_password": hashed_password} for i, username in enumerate(users)
+        ])
+        conn.execute(insert(models.Project), [
+            {"id": project["id"], "name": f"project {i}", "owner_id": project["owner"] + 1, "annotation_revision": 1}
+            for i, project in enumerate(projects + [live])
+        ])
+        # Everyone can join the websocket project
+        conn.execute(models.project_user.insert(), [
+            {"project_id": live["id"], "user_id": i + 1} for i in range(1, args.users)
+        ])
+
+    table = models.Annotation.__table__
+    now = datetime.utcnow()
+    counts = [args.annotations // args.projects + (i < args.annotations % args.projects) for i in range(args.projects)]
+    for project, count in zip(projects + [live], counts + [args.live_annotations]):
+        for start in range(0, count, INSERT_CHUNK):
+            rows = []
+            for _ in range(min(INSERT_CHUNK, count - start)):
+                coordinates = polygon(rng, args.points)
+                rows.append(dict(
+                    note=f"cell {rng.getrandbits(32):08x}", color="#ff0000", coordinates=coordinates,
+                    owner_id=project["owner"] + 1, project_id=project["id"], revision=1, updated_at=now, deleted=False,
+                    **geometry.bbox_columns(coordinates),
+                ))
+            with engine.begin() as conn:
+                conn.execute(table.insert(), rows)
+        with engine.connect() as conn:
+            project["annotations"] = list(conn.execute(
+                select(func.min(table.c.id), func.max(table.c.id)).where(table.c.project_id == project["id"])
+            ).one())
+        print(f"  seeded {project['id']}: {count} annotations", flush=True)
+
+    files = []
+    for i in range(args.files):
+        project = projects[i % len(projects)]
+        writer = storage.BlobWriter()
+        for _ in range(args.file_size):
+            writer.write(rng.randbytes(1024 * 1024))
+        path, sha256, size = writer.commit()
+        with engine.begin() as conn:
+            file_id = conn.execute(insert(models.File).values(
+                path=path, filename=f"{i}.bin", sha256=sha256, size=size, project_id=project["id"],
+            )).inserted_primary_key[0]
+        files.append({"id": file_id, "project": project["id"], "size": size})
+
+    dataset = {
+        "users": users,
+        "password": PASSWORD,
+        "projects": projects,
+        "live_project": live,
+        "files": files,
+        "parameters": {
+            name: getattr(args, name)
+            for name in ("seed", "users", "projects", "annotations", "points", "live_annotations", "files", "file_size")
+        },
+        "seed_seconds": round(time.perf_counter() - started, 1),
+    }
+    with open(os.path.join(directory, "dataset.json"), "w") as f:
+        json.dump(dataset, f, indent=1)
+    return dataset
@@ -0,0 +1,91 @@
+"""Printing, saving and comparing results."""
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+from .targets import ROOT
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+COLUMNS = ("per_second", "p50_ms", "p99_ms", "mb_per_second", "errors")
+
+
+def commit():
+    try:
+        head = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ("-dirty" if dirty.strip() else "")
+
+
+def environment():
+    return {
+        "commit": commit(),
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {name: value for name, value in sorted(os.environ.items()) if name.startswith("AAT_")},
+    }
+
+
+def save(results: dict, path: str | None):
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"load-{results['environment']['commit'] or 'unknown'}-{stamp}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+    return path
+
+
+def line(name: str, result: dict):
+    cells = [f"{name:<18}"]
+    for column in COLUMNS:
+        value = result.get(column)
+        cells.append(f"{'' if value is None else value:>14}")
+    return "".join(cells)
+
+
+def header():
+    return f"{'scenario':<18}" + "".join(f"{column:>14}" for column in COLUMNS)
+
+
+def print_results(results: dict):
+    print()
+    print(header())
+    for name, result in results["scenarios"].items():
+        print(line(name, result))
+        memory = result["memory_mb"]
+        extra = f"memory MB start/peak/end {memory['start']}/{memory['peak']}/{memory['end']}" if memory else "memory not measured"
+        if "clients" in result:
+            extra += (
+                f", {result['clients']} clients, connect p50/p99 {result['connect_p50_ms']}/{result['connect_p99_ms']} ms"
+                f", {result['memory_per_client_kb']} KB per client"
+            )
+        print(f"{'':<18}{extra}")
+
+
+def compare(results: dict, path: str):
+    # Relative change against an earlier run; for latency lower is better
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f"\nagainst {path} ({baseline['environment'].get('commit')}):")
+    print(header())
+    for name, result in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if not before:
+            continue
+        cells = [f"{name:<18}"]
+        for column in COLUMNS:
+            old, new = before.get(column), result.get(column)
+            if column == "errors" or not old or new is None:
+                cells.append(f"{'' if new is None else f'{old} -> {new}':>14}")
+            else:
+                cells.append(f"{(new - old) / old * 100:>+13.1f}%")
+        print("".join(cells))
@@ -0,0 +1,305 @@
+"""The measured workloads.
+
+Each scenario runs `requests` operations spread over `concurrency` tasks
+and reports throughput, latency percentiles, errors and the memory of the
+target while it ran. An operation fails on any non-2xx response.
+"""
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+
+from .targets import rss
+
+MEMORY_INTERVAL = 0.1
+# How long a socket may take to see a probe before it counts as an error
+DELIVERY_TIMEOUT = 10
+
+
+def percentile(samples: list[float], fraction: float):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summary(latencies: list[float], elapsed: float, errors: int, size: int, memory: dict):
+    latencies = sorted(latencies)
+    result = {
+        "operations": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "per_second": round(len(latencies) / elapsed, 1) if elapsed else 0,
+    }
+    if latencies:
+        result.update(
+            p50_ms=round(percentile(latencies, 0.5) * 1000, 2),
+            p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+            mean_ms=round(statistics.fmean(latencies) * 1000, 2),
+            max_ms=round(latencies[-1] * 1000, 2),
+        )
+    if size:
+        result["mb_per_second"] = round(size / 1e6 / elapsed, 1)
+    result["memory_mb"] = memory
+    return result
+
+
+class MemorySampler:
+    # Resident memory of the target, sampled while a scenario runs
+    def __init__(self, target):
+        self.target = target
+        self.samples = []
+        self.task = None
+
+    async def _run(self):
+        while True:
+            self.samples.append(rss(self.target.pids()))
+            await asyncio.sleep(MEMORY_INTERVAL)
+
+    def __enter__(self):
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self.task.cancel()
+        self.samples.append(rss(self.target.pids()))
+
+    def result(self):
+        if not self.target.pids():
+            return None
+        return {
+            "start": round(self.samples[0] / 1e6, 1),
+            "peak": round(max(self.samples) / 1e6, 1),
+            "end": round(self.samples[-1] / 1e6, 1),
+        }
+
+
+async def run(target, operation, requests: int, concurrency: int):
+    # operation(i) returns the bytes it moved (or None)
+    latencies, errors, moved = [], [], [0]
+    counter = iter(range(requests))
+
+    async def task():
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                size = await operation(i)
+            except Exception as exc:
+                errors.append(exc)
+                continue
+            latencies.append(time.perf_counter() - started)
+            moved[0] += size or 0
+
+    with MemorySampler(target) as memory:
+        started = time.perf_counter()
+        await asyncio.gather(*(task() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    if errors:
+        print(f"    {len(errors)} errors, first: {errors[0]!r}")
+    return summary(latencies, elapsed, len(errors), moved[0], memory.result())
+
+
+class Session:
+    # Tokens of the dataset's users and the helpers the scenarios share
+    def __init__(self, target, dataset: dict, args):
+        self.target = target
+        self.http = target.http
+        self.dataset = dataset
+        self.args = args
+        self.tokens = {}
+
+    async def login(self, username: str):
+        response = await self.http.post("/token", data={"username": username, "password": self.dataset["password"]})
+        response.raise_for_status()
+        self.tokens[username] = response.json()["access_token"]
+
+    def headers(self, user: int):
+        return {"Authorization": f"Bearer {self.tokens[self.dataset['users'][user]]}"}
+
+    def project(self, i: int):
+        projects = self.dataset["projects"]
+        return projects[i % len(projects)]
+
+
+def annotation(i: int, note: str | None = None):
+    return {
+        "note": note or f"bench {i}",
+        "color": "#00ff00",
+        "coordinates": {"points": [[i, i], [i + 40, i], [i + 40, i + 30], [i, i + 30]]},
+    }
+
+
+async def login(session: Session):
+    users = session.dataset["users"]
+
+    async def operation(i):
+        await session.login(users[i % len(users)])
+
+    return await run(session.target, operation, max(session.args.logins, len(users)), session.args.concurrency)
+
+
+async def projects(session: Session):
+    users = len(session.dataset["users"])
+
+    async def operation(i):
+        response = await session.http.get("/projects", headers=session.headers(i % users))
+        response.raise_for_status()
+        return len(response.content)
+
+    return await run(session.target, operation, session.args.requests, session.args.concurrency)
+
+
+async def annotation_list(session: Session):
+    # A page of a (large) project, the way clients page through it
+    async def operation(i):
+        project = session.project(i)
+        response = await session.http.get(
+            f"/projects/{project['id']}/annotations/",
+            params={"limit": session.args.page_size},
+            headers=session.headers(project["owner"]),
+        )
+        response.raise_for_status()
+        return len(response.content)
+
+    return await run(session.target, operation, session.args.requests, session.args.concurrency)
+
+
+async def annotation_create(session: Session):
+    async def operation(i):
+        project = session.project(i)
+        response = await session.http.post(
+            f"/projects/{project['id']}/annotations/", json=annotation(i), headers=session.headers(project["owner"])
+        )
+        response.raise_for_status()
+
+    return await run(session.target, operation, session.args.requests, session.args.concurrency)
+
+
+async def annotation_update(session: Session):
+    # Seeded annotations, picked at random in projects that have some
+    projects = [project for project in session.dataset["projects"] if project["annotations"][0] is not None]
+    rng = random.Random(session.args.seed)
+    picks = []
+    for i in range(session.args.requests):
+        project = projects[i % len(projects)]
+        picks.append((project, rng.randint(*project["annotations"])))
+
+    async def operation(i):
+        project, annotation_id = picks[i]
+        response = await session.http.put(
+            f"/annotations/{annotation_id}", json=annotation(i), headers=session.headers(project["owner"])
+        )
+        response.raise_for_status()
+
+    return await run(session.target, operation, session.args.requests, session.args.concurrency)
+
+
+async def upload(session: Session):
+    # Distinct contents each time, or the blob store would only link them
+    body = bytearray(random.Random(session.args.seed).randbytes(session.args.upload_size * 1024 * 1024))
+    run_id = uuid.uuid4().bytes
+
+    async def operation(i):
+        project = session.project(i)
+        content = run_id + i.to_bytes(8, "big") + bytes(body)
+        response = await session.http.post(
+            f"/projects/{project['id']}/files",
+            files={"file": (f"upload-{i}.bin", content)},
+            headers=session.headers(project["owner"]),
+        )
+        response.raise_for_status()
+        if "id" not in response.json():
+            raise RuntimeError(response.json())
+        return len(content)
+
+    return await run(session.target, operation, session.args.uploads, min(session.args.concurrency, session.args.uploads))
+
+
+async def download(session: Session):
+    files = session.dataset["files"]
+    if not files:
+        return None
+
+    owners = {project["id"]: project["owner"] for project in session.dataset["projects"]}
+
+    async def operation(i):
+        file = files[i % len(files)]
+        size = 0
+        async with session.http.stream("GET", f"/files/{file['id']}", headers=session.headers(owners[file["project"]])) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                size += len(chunk)
+        return size
+
+    return await run(session.target, operation, session.args.downloads, min(session.args.concurrency, session.args.downloads))
+
+
+async def websocket(session: Session):
+    # --ws-clients sockets on one project; each probe is an annotation
+    # created over REST, timed until every socket has received it
+    live = session.dataset["live_project"]
+    users = session.dataset["users"]
+    path = f"/projects/{live['id']}/annotations"
+    connect_times = []
+
+    async def connect(i):
+        started = time.perf_counter()
+        ws = await session.target.websocket(f"{path}?token={session.tokens[users[i % len(users)]]}")
+        await ws.recv()  # initial snapshot
+        connect_times.append(time.perf_counter() - started)
+        return ws
+
+    with MemorySampler(session.target) as memory:
+        sockets = []
+        for start in range(0, session.args.ws_clients, session.args.concurrency):
+            count = min(session.args.concurrency, session.args.ws_clients - start)
+            sockets += await asyncio.gather(*(connect(start + i) for i in range(count)))
+        connected = rss(session.target.pids())
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        try:
+            for i in range(session.args.ws_probes):
+                note = f"probe-{uuid.uuid4().hex}"
+                sent_at = time.perf_counter()
+                waiters = [asyncio.create_task(wait_for_note(ws, note, sent_at)) for ws in sockets]
+                response = await session.http.post(f"{path}/", json=annotation(i, note), headers=session.headers(live["owner"]))
+                if response.is_error:
+                    errors += 1
+                    for waiter in waiters:
+                        waiter.cancel()
+                    continue
+                done = await asyncio.gather(*waiters, return_exceptions=True)
+                latencies += [value for value in done if isinstance(value, float)]
+                errors += sum(not isinstance(value, float) for value in done)
+            elapsed = time.perf_counter() - started
+        finally:
+            await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+    result = summary(latencies, elapsed, errors, 0, memory.result())
+    connect_times.sort()
+    result.update(
+        clients=len(sockets),
+        connect_p50_ms=round(percentile(connect_times, 0.5) * 1000, 2),
+        connect_p99_ms=round(percentile(connect_times, 0.99) * 1000, 2),
+        memory_per_client_kb=round((connected - memory.samples[0]) / len(sockets) / 1024, 1) if sockets and connected else None,
+    )
+    return result
+
+
+async def wait_for_note(ws, note: str, sent_at: float):
+    while True:
+        data = await asyncio.wait_for(ws.recv(), DELIVERY_TIMEOUT)
+        message = json.loads(data)
+        changes = message.get("changes") or [message]
+        if any((change.get("annotation") or {}).get("note") == note for change in changes):
+            return time.perf_counter() - sent_at
+
+
+SCENARIOS = {
+    "login": login,
+    "projects": projects,
+    "annotation_list": annotation_list,
+    "annotation_create": annotation_create,
+    "annotation_update": annotation_update,
+    "upload": upload,
+    "download": download,
+    "websocket": websocket,
+}
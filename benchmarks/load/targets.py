@@ -0,0 +1,177 @@
+"""Where the requests go: the app in this process, or a uvicorn server.
+
+Both expose an httpx.AsyncClient, `websocket(path)` returning an object
+with send/recv/close, and `pids()` for memory sampling.
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+TIMEOUT = 300
+
+
+class ASGIWebSocket:
+    # Just enough of a websocket client to talk to the app without a server
+    def __init__(self, app, path: str):
+        url = urlsplit(path)
+        self.scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": url.path,
+            "raw_path": url.path.encode(),
+            "query_string": url.query.encode(),
+            "root_path": "",
+            "headers": [(b"host", b"bench")],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+            "subprotocols": [],
+        }
+        self.app = app
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        self.accepted = asyncio.get_running_loop().create_future()
+        self.task = None
+
+    async def connect(self):
+        await self.incoming.put({"type": "websocket.connect"})
+        self.task = asyncio.create_task(self.app(self.scope, self.incoming.get, self._send))
+        await self.accepted
+        return self
+
+    async def _send(self, message):
+        if message["type"] == "websocket.accept":
+            self.accepted.set_result(True)
+        elif message["type"] == "websocket.close":
+            if not self.accepted.done():
+                self.accepted.set_exception(ConnectionError(f"websocket refused ({message.get('code')})"))
+            await self.outgoing.put(None)
+        else:
+            await self.outgoing.put(message.get("text") if message.get("text") is not None else message.get("bytes"))
+
+    async def send(self, data):
+        key = "bytes" if isinstance(data, bytes) else "text"
+        await self.incoming.put({"type": "websocket.receive", key: data})
+
+    async def recv(self):
+        message = await self.outgoing.get()
+        if message is None:
+            raise ConnectionError("websocket closed")
+        return message
+
+    async def close(self):
+        await self.incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.gather(self.task, return_exceptions=True)
+
+
+class InProcess:
+    name = "inprocess"
+
+    def __init__(self):
+        from aat_backend.main import app
+
+        self.app = app
+        self.lifespan = None
+        self.http = None
+
+    async def start(self):
+        self.lifespan = self.app.router.lifespan_context(self.app)
+        await self.lifespan.__aenter__()
+        transport = httpx.ASGITransport(app=self.app)
+        self.http = httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=TIMEOUT)
+
+    async def websocket(self, path: str):
+        return await ASGIWebSocket(self.app, path).connect()
+
+    def pids(self):
+        return [os.getpid()]
+
+    async def stop(self):
+        await self.http.aclose()
+        await self.lifespan.__aexit__(None, None, None)
+
+
+class Server:
+    # A uvicorn server, started here with --workers (and the dataset's
+    # AAT_* settings) or already running at --url
+    name = "uvicorn"
+
+    def __init__(self, url: str | None = None, workers: int = 1):
+        self.url = url
+        self.workers = workers
+        self.process = None
+        self.http = None
+
+    async def start(self):
+        if self.url is None:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                port = s.getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}"
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "aat_backend.main:app", "--port", str(port),
+                 "--workers", str(self.workers), "--log-level", "warning"],
+                cwd=ROOT, env=os.environ.copy(),
+            )
+        self.http = httpx.AsyncClient(base_url=self.url, timeout=TIMEOUT, limits=httpx.Limits(max_connections=None))
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                await self.http.get("/metrics")
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline or (self.process and self.process.poll() is not None):
+                    raise RuntimeError(f"uvicorn did not come up at {self.url}")
+                await asyncio.sleep(0.2)
+
+    async def websocket(self, path: str):
+        import websockets
+
+        return await websockets.connect(self.url.replace("http", "ws", 1) + path, max_size=None, open_timeout=TIMEOUT)
+
+    def pids(self):
+        if self.process is None:
+            return []
+        return [self.process.pid] + children(self.process.pid)
+
+    async def stop(self):
+        await self.http.aclose()
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def children(pid: int):
+    # Linux only; elsewhere only the parent process is measured
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            direct = [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+    return direct + [grandchild for child in direct for grandchild in children(child)]
+
+
+def rss(pids: list[int]):
+    # Resident memory in bytes, summed over the processes
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            if pid == os.getpid():
+                import resource
+
+                # Peak rather than current, but better than nothing
+                total += resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return total
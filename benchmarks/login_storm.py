@@ -0,0 +1,83 @@
+"""Websocket latency while a burst of logins is being hashed.
+
+Start a single worker (see ws_capacity.py) and run
+
+    python benchmarks/login_storm.py --url http://127.0.0.1:8000 --logins 100
+
+A few sockets keep asking the server for a resync and time the round trip,
+first with no logins in flight and then while --logins logins run
+concurrently. With hashing on the event loop the storm latency grows with
+the number of logins; with the hashing pool it should stay flat. Logins
+rejected with 503 because the pool is saturated are counted separately.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import httpx
+import websockets
+
+
+async def setup(client: httpx.AsyncClient):
+    username = f"bench-{uuid.uuid4().hex[:8]}"
+    await client.post("/user", json={"username": username, "hashed_password": "bench"})
+    token = (await client.post("/token", data={"username": username, "password": "bench"})).json()["access_token"]
+    client.headers["Authorization"] = f"Bearer {token}"
+    project = (await client.post("/projects", json={"name": "login-storm"})).json()
+    return username, project["id"]
+
+
+async def probe(ws_url: str, stop: asyncio.Event, samples: list):
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        await ws.recv()
+        while not stop.is_set():
+            started = time.perf_counter()
+            await ws.send(json.dumps({"version": -1}))
+            await ws.recv()
+            samples.append(time.perf_counter() - started)
+            await asyncio.sleep(0.01)
+
+
+async def login(client: httpx.AsyncClient, username: str, statuses: list):
+    response = await client.post("/token", data={"username": username, "password": "bench"})
+    statuses.append(response.status_code)
+
+
+async def phase(ws_url: str, sockets: int, work):
+    samples, stop = [], asyncio.Event()
+    probes = [asyncio.create_task(probe(ws_url, stop, samples)) for _ in range(sockets)]
+    await asyncio.sleep(0.2)
+    await work()
+    stop.set()
+    await asyncio.gather(*probes)
+    samples.sort()
+    return statistics.median(samples) * 1000, samples[int(len(samples) * 0.99)] * 1000
+
+
+async def main(args):
+    async with httpx.AsyncClient(base_url=args.url, timeout=120) as client:
+        username, project_id = await setup(client)
+        ws_url = args.url.replace("http", "ws", 1) + f"/projects/{project_id}/annotations?token={client.headers['Authorization'].removeprefix('Bearer ')}"
+
+        p50, p99 = await phase(ws_url, args.sockets, lambda: asyncio.sleep(args.idle_seconds))
+        print(f"idle        ws p50={p50:7.1f}ms p99={p99:7.1f}ms")
+
+        statuses = []
+        started = time.perf_counter()
+        storm = lambda: asyncio.gather(*(login(client, username, statuses) for _ in range(args.logins)))
+        p50, p99 = await phase(ws_url, args.sockets, storm)
+        elapsed = time.perf_counter() - started
+        print(f"{args.logins:4d} logins ws p50={p50:7.1f}ms p99={p99:7.1f}ms "
+              f"ok={statuses.count(200)} rejected={statuses.count(503)} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--sockets", type=int, default=5)
+    parser.add_argument("--idle-seconds", type=float, default=2)
+    asyncio.run(main(parser.parse_args()))
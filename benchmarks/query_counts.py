@@ -0,0 +1,65 @@
+"""Fails when a route's SQL query count grows with the number of rows.
+
+    python benchmarks/query_counts.py
+
+Runs against a throwaway SQLite database in a temporary directory. For each
+dataset size the user gets that many projects, half owned and half shared,
+each with files and shared users. Every checked route must issue the same
+number of queries at every size. Exits non-zero otherwise.
+"""
+import os
+import sys
+import tempfile
+
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.testclient import TestClient
+
+from aat_backend import models
+from aat_backend.database import SessionLocal, count_queries, engine
+from aat_backend.main import app, create_access_token
+
+SIZES = (1, 10, 100)
+
+
+def seed(projects: int):
+    with SessionLocal() as db:
+        user = models.User(username=f"user-{projects}", hashed_password="x")
+        other = models.User(username=f"other-{projects}", hashed_password="x")
+        db.add_all([user, other])
+        db.flush()
+        for i in range(projects):
+            owner, member = (other, user) if i % 2 else (user, other)
+            project = models.Project(id=f"{projects:04d}-{i:05d}", name=f"p{i}", owner_id=owner.id)
+            project.shared_users.append(member)
+            project.files = [models.File(path=f"f{i}-{j}", filename=f"f{j}.png") for j in range(3)]
+            db.add(project)
+        db.commit()
+        return user.username, f"{projects:04d}-00000"
+
+
+def main():
+    models.Base.metadata.create_all(bind=engine)
+    routes = {}
+    with TestClient(app) as client:
+        for size in SIZES:
+            username, project_id = seed(size)
+            headers = {"Authorization": f"Bearer {create_access_token({'sub': username})}"}
+            client.get("/user", headers=headers)  # warm the user cache
+            for route in ("/projects", "/projects?limit=50", f"/projects/{project_id}"):
+                with count_queries() as statements:
+                    response = client.get(route, headers=headers)
+                assert response.status_code == 200, response.text
+                routes.setdefault(route.replace(project_id, "{project_id}"), []).append(len(statements))
+
+    failed = False
+    for route, counts in routes.items():
+        status = "ok" if len(set(counts)) == 1 else "GROWS"
+        failed |= status != "ok"
+        print(f"{status:5s} {route:25s} " + " ".join(f"{size}:{count}" for size, count in zip(SIZES, counts)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
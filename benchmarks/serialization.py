@@ -0,0 +1,96 @@
+"""Cost of encoding annotation lists, old path against the serialization layer.
+
+    python benchmarks/serialization.py --sizes 1000 10000 100000 --sockets 50
+
+For each list size it times:
+
+* REST, before: schemas.Annotation validation of every ORM row followed by
+  FastAPI's jsonable_encoder and json.dumps (what response_model did);
+* REST, after: serialization.dumps of the rows' dict();
+* websocket, before: one json.dumps per socket (send_json);
+* websocket, after: one encode shared by every socket;
+* gzip (and brotli when installed) of the encoded body, with the sizes.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.encoders import jsonable_encoder
+
+from aat_backend import models, schemas, serialization
+
+
+def make_annotations(count: int):
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    return [
+        models.Annotation(
+            id=i,
+            note=f"cell {i}",
+            coordinates={"points": [[rng.uniform(0, 1e5), rng.uniform(0, 1e5)] for _ in range(8)]},
+            color="#ff0000",
+            revision=i,
+            updated_at=now,
+            deleted=False,
+        )
+        for i in range(count)
+    ]
+
+
+def timed(function, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def validate(annotation):
+    if hasattr(schemas.Annotation, "model_validate"):
+        return schemas.Annotation.model_validate(annotation, from_attributes=True)
+    return schemas.Annotation.from_orm(annotation)
+
+
+def main(args):
+    print(f"encoder: {'orjson' if serialization.orjson else 'json'}, brotli: {'yes' if serialization.brotli else 'no'}\n")
+    for size in args.sizes:
+        annotations = make_annotations(size)
+        repeat = max(1, args.repeat if size < 100_000 else 1)
+        before_ms, before = timed(
+            lambda: json.dumps(jsonable_encoder([validate(a) for a in annotations])).encode(), repeat
+        )
+        after_ms, body = timed(lambda: serialization.dumps(serialization.annotation_list(annotations)), repeat)
+        message = {"type": "snapshot", "version": size, "annotations": serialization.annotation_list(annotations)}
+        ws_before_ms, _ = timed(
+            lambda: [json.dumps(message, separators=(",", ":")) for _ in range(args.sockets)], repeat
+        )
+        ws_after_ms, _ = timed(lambda: serialization.dumps(message).decode(), repeat)
+
+        print(f"{size} annotations")
+        print(f"  REST encode:       {before_ms:9.1f}ms -> {after_ms:7.1f}ms ({before_ms / after_ms:.1f}x)")
+        print(
+            f"  websocket x{args.sockets}:    {ws_before_ms:9.1f}ms -> {ws_after_ms:7.1f}ms"
+            f" ({ws_before_ms / ws_after_ms:.1f}x)"
+        )
+        print(f"  body:              {len(before) / 1e6:9.2f}MB -> {len(body) / 1e6:7.2f}MB")
+        for encoding in ("gzip", "br"):
+            if encoding == "br" and serialization.brotli is None:
+                continue
+            ms, compressed = timed(lambda: serialization.compress(body, encoding), repeat)
+            print(f"  {encoding:<5}              {ms:9.1f}ms, {len(compressed) / 1e6:.2f}MB ({len(body) / len(compressed):.1f}x smaller)")
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--sockets", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,192 @@
+"""Fails when a fresh worker takes longer than its budget to become useful.
+
+    python benchmarks/startup.py --runs 5
+    python benchmarks/startup.py --server --workers 4 --imports 15
+
+Every run starts a new interpreter, as each uvicorn worker (and every scale
+out) does, against a throwaway SQLite database migrated with alembic, and
+times:
+
+  import         `import aat_backend.main`
+  startup        the lifespan startup
+  first_request  an authenticated GET /projects right after startup
+  first_login    the first POST /token; mostly bcrypt, which costs the
+                 same on every login
+
+--server also times a real uvicorn from spawn to its first answered
+GET /projects. The median of each phase is checked against its budget and
+the script exits non-zero when one is over. --imports lists the slowest
+imports of one more run (python -X importtime).
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+USERNAME = "startup"
+PASSWORD = "startup"
+
+
+def child(token: str):
+    # Runs in the fresh interpreter; prints the timings as JSON
+    import asyncio
+
+    import httpx
+
+    started = time.perf_counter()
+    from aat_backend.main import app
+
+    timings = {"import": time.perf_counter() - started}
+
+    async def run():
+        started = time.perf_counter()
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+        timings["startup"] = time.perf_counter() - started
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+            started = time.perf_counter()
+            response = await client.get("/projects", headers={"Authorization": f"Bearer {token}"})
+            response.raise_for_status()
+            timings["first_request"] = time.perf_counter() - started
+            started = time.perf_counter()
+            response = await client.post("/token", data={"username": USERNAME, "password": PASSWORD})
+            response.raise_for_status()
+            timings["first_login"] = time.perf_counter() - started
+        await lifespan.__aexit__(None, None, None)
+
+    asyncio.run(run())
+    print(json.dumps(timings))
+
+
+def prepare(directory: str):
+    # Migrated database with one user and a project; returns a token
+    os.environ.update(
+        AAT_DATABASE_URL=f"sqlite:///{os.path.join(directory, 'aat.db')}",
+        AAT_DATA_DIR=os.path.join(directory, "data"),
+        AAT_JOB_WORKERS="0",
+        AAT_LOG_LEVEL=os.environ.get("AAT_LOG_LEVEL", "WARNING"),
+    )
+    subprocess.run([sys.executable, "-m", "alembic", "upgrade", "head"], cwd=ROOT, check=True, capture_output=True)
+    from aat_backend import hashing, models
+    from aat_backend.database import SessionLocal
+    from aat_backend.main import create_access_token
+
+    with SessionLocal() as db:
+        user = models.User(username=USERNAME, hashed_password=hashing.context().hash(PASSWORD))
+        db.add(user)
+        db.flush()
+        db.add(models.Project(id="startup", name="startup", owner_id=user.id))
+        db.commit()
+    return create_access_token({"sub": USERNAME})
+
+
+def in_process(token: str):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", token], cwd=ROOT, capture_output=True, text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def server(token: str, workers: int):
+    # Spawn to first answered request, through every worker's startup
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    import httpx
+
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "aat_backend.main:app", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=ROOT,
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", headers={"Authorization": f"Bearer {token}"}) as client:
+            while True:
+                try:
+                    client.get("/projects").raise_for_status()
+                    return {"ready": time.perf_counter() - started}
+                except httpx.TransportError:
+                    if process.poll() is not None or time.perf_counter() - started > 120:
+                        raise RuntimeError("uvicorn did not come up")
+                    time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def slowest_imports(count: int):
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import aat_backend.main"], cwd=ROOT, capture_output=True, text=True,
+    ).stderr
+    packages = {}
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if "." not in name or name.startswith("aat_backend."):
+            packages[name] = max(packages.get(name, 0), int(parts[1]))
+    print("\nslowest imports (cumulative, each includes what it imports):")
+    for name, micros in sorted(packages.items(), key=lambda item: -item[1])[:count]:
+        print(f"  {micros / 1000:8.1f} ms  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--server", action="store_true", help="also time a uvicorn server from spawn to first response")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--imports", type=int, default=0, metavar="N", help="list the N slowest imports")
+    parser.add_argument("--import-budget", type=float, default=2.5)
+    parser.add_argument("--startup-budget", type=float, default=0.25)
+    parser.add_argument("--first-request-budget", type=float, default=0.25)
+    parser.add_argument("--first-login-budget", type=float, default=1.0)
+    parser.add_argument("--ready-budget", type=float, default=5.0)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    budgets = {
+        "import": args.import_budget,
+        "startup": args.startup_budget,
+        "first_request": args.first_request_budget,
+        "first_login": args.first_login_budget,
+        "ready": args.ready_budget,
+    }
+    samples = {}
+    with tempfile.TemporaryDirectory() as directory:
+        token = prepare(directory)
+        for _ in range(args.runs):
+            for phase, seconds in in_process(token).items():
+                samples.setdefault(phase, []).append(seconds)
+            if args.server:
+                samples.setdefault("ready", []).append(server(token, args.workers)["ready"])
+        if args.imports:
+            slowest_imports(args.imports)
+
+    print(f"\n{'phase':<15}{'median ms':>12}{'max ms':>12}{'budget ms':>12}")
+    failed = False
+    for phase, values in samples.items():
+        median = statistics.median(values)
+        over = median > budgets[phase]
+        failed |= over
+        print(f"{phase:<15}{median * 1000:>12.1f}{max(values) * 1000:>12.1f}{budgets[phase] * 1000:>12.0f}"
+              + ("  OVER" if over else ""))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
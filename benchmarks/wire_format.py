@@ -0,0 +1,110 @@
+"""Size and speed of the MessagePack wire format against JSON.
+
+    python benchmarks/wire_format.py --annotations 10000 --points 200
+
+Builds segmentation-like annotations (closed polygons of float and of integer
+pixel coordinates), checks that both encodings round-trip (integers exactly,
+floats to float32 precision) and prints payload sizes, raw and gzipped, with
+encode/decode times and annotations per second.
+
+With the defaults, MessagePack is about 4.6x smaller than JSON for float
+points (1.7x for integer points; 3x and 1.5x gzipped). It encodes about 2x
+slower (4x for integer points) and decodes in about the same time, 0.8x to
+1.2x between runs. That is why JSON stays the default: MessagePack is for
+clients that pay for bytes more than for CPU.
+"""
+import argparse
+import gzip
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aat_backend import serialization
+
+if serialization.msgpack is None:
+    sys.exit("msgpack is not installed")
+
+
+def polygon(rng: random.Random, points: int, integer: bool):
+    cx, cy, radius = rng.uniform(0, 1e5), rng.uniform(0, 1e5), rng.uniform(5, 50)
+    result = []
+    for i in range(points):
+        angle = 2 * math.pi * i / points
+        x, y = cx + radius * math.cos(angle), cy + radius * math.sin(angle)
+        result.append([round(x), round(y)] if integer else [x, y])
+    return result
+
+
+def make_annotations(count: int, points: int, integer: bool):
+    rng = random.Random(0)
+    return [
+        {
+            "id": i,
+            "note": "",
+            "coordinates": {"points": polygon(rng, points, integer)},
+            "color": "#00ff00",
+            "revision": i,
+            "updated_at": "2026-10-18T08:00:00.000000",
+            "deleted": False,
+        }
+        for i in range(count)
+    ]
+
+
+def check_round_trip(annotations: list, integer: bool):
+    for media_type in (serialization.JSON, serialization.MSGPACK):
+        decoded = serialization.decode(serialization.encode(annotations, media_type), media_type)
+        assert len(decoded) == len(annotations)
+        for before, after in zip(annotations, decoded):
+            assert {k: v for k, v in before.items() if k != "coordinates"} == {
+                k: v for k, v in after.items() if k != "coordinates"
+            }
+            for (x0, y0), (x1, y1) in zip(before["coordinates"]["points"], after["coordinates"]["points"], strict=True):
+                if integer or media_type == serialization.JSON:
+                    assert (x0, y0) == (x1, y1)
+                else:
+                    assert math.isclose(x0, x1, rel_tol=1e-7) and math.isclose(y0, y1, rel_tol=1e-7)
+
+
+def timed(function, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(args):
+    for integer in (False, True):
+        annotations = make_annotations(args.annotations, args.points, integer)
+        check_round_trip(annotations, integer)
+        print(f"{args.annotations} annotations x {args.points} {'integer' if integer else 'float'} points (round trip ok)")
+        sizes, encodes, decodes = {}, {}, {}
+        for media_type in (serialization.JSON, serialization.MSGPACK):
+            body = serialization.encode(annotations, media_type)
+            sizes[media_type] = len(body)
+            encode = encodes[media_type] = timed(lambda: serialization.encode(annotations, media_type), args.repeat)
+            decode = decodes[media_type] = timed(lambda: serialization.decode(body, media_type), args.repeat)
+            print(
+                f"  {media_type:<20} {len(body) / 1e6:7.2f}MB, gzip {len(gzip.compress(body, 1)) / 1e6:6.2f}MB,"
+                f" encode {encode * 1000:6.0f}ms ({len(annotations) / encode:7.0f}/s),"
+                f" decode {decode * 1000:6.0f}ms ({len(annotations) / decode:7.0f}/s)"
+            )
+        print(
+            f"  msgpack is {sizes[serialization.JSON] / sizes[serialization.MSGPACK]:.1f}x smaller,"
+            f" encodes in {encodes[serialization.MSGPACK] / encodes[serialization.JSON]:.1f}x"
+            f" and decodes in {decodes[serialization.MSGPACK] / decodes[serialization.JSON]:.1f}x the time of JSON\n"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annotations", type=int, default=10_000)
+    parser.add_argument("--points", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,96 @@
+"""How many annotation websockets one worker can hold.
+
+Start a single worker, e.g.
+
+    uvicorn aat_backend.main:app --port 8000 --workers 1
+
+then run
+
+    python benchmarks/ws_capacity.py --url http://127.0.0.1:8000 --max-sockets 2000
+
+Sockets are opened in steps. After each step the benchmark saves annotations
+over REST and measures how long it takes until every socket has seen the
+delta. It stops when the p99 delivery latency exceeds --budget-ms, and the
+last step under budget is the worker's capacity. Run it on two commits to
+compare them.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import httpx
+import websockets
+
+
+async def setup(client: httpx.AsyncClient):
+    username = f"bench-{uuid.uuid4().hex[:8]}"
+    await client.post("/user", json={"username": username, "hashed_password": "bench"})
+    token = (await client.post("/token", data={"username": username, "password": "bench"})).json()["access_token"]
+    client.headers["Authorization"] = f"Bearer {token}"
+    project = (await client.post("/projects", json={"name": "ws-capacity"})).json()
+    return project["id"]
+
+
+async def open_socket(ws_url: str):
+    ws = await websockets.connect(ws_url, max_size=None)
+    await ws.recv()  # initial snapshot
+    return ws
+
+
+async def wait_for_note(ws, note: str, sent_at: float):
+    while True:
+        message = json.loads(await ws.recv())
+        annotation = message.get("annotation") or {}
+        if annotation.get("note") == note:
+            return time.perf_counter() - sent_at
+
+
+async def measure(client: httpx.AsyncClient, sockets: list, project_id: str, rounds: int):
+    latencies = []
+    for i in range(rounds):
+        note = f"probe-{uuid.uuid4().hex}"
+        sent_at = time.perf_counter()
+        waiters = [asyncio.create_task(wait_for_note(ws, note, sent_at)) for ws in sockets]
+        await client.post(
+            f"/projects/{project_id}/annotations/",
+            json={"note": note, "coordinates": {"points": [[0, 0], [i, i]]}, "color": "red"},
+        )
+        latencies.extend(await asyncio.gather(*waiters))
+    latencies.sort()
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+async def main(args):
+    async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+        project_id = await setup(client)
+        ws_url = args.url.replace("http", "ws", 1) + f"/projects/{project_id}/annotations?token={client.headers['Authorization'].removeprefix('Bearer ')}"
+        sockets = []
+        capacity = 0
+        try:
+            while len(sockets) < args.max_sockets:
+                target = min(args.max_sockets, len(sockets) + args.step)
+                sockets += await asyncio.gather(*(open_socket(ws_url) for _ in range(target - len(sockets))))
+                result = await measure(client, sockets, project_id, args.rounds)
+                print(f"sockets={len(sockets):6d} p50={result['p50_ms']:8.1f}ms p99={result['p99_ms']:8.1f}ms")
+                if result["p99_ms"] > args.budget_ms:
+                    break
+                capacity = len(sockets)
+        finally:
+            await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+        print(f"capacity: {capacity} sockets under a {args.budget_ms:.0f}ms p99 budget")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--max-sockets", type=int, default=2000)
+    parser.add_argument("--step", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=250)
+    asyncio.run(main(parser.parse_args()))